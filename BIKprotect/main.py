@@ -3,7 +3,7 @@ import sys
 
 import loguru
 
-from BIKprotect.utils.pentest_gpt import BIKprotect
+from BIKprotect.utils.BIKprotect_gpt import BIKprotect
 
 
 def main():
@@ -41,6 +41,125 @@ def main():
         help="allow BIKprotect developers to collect data through langfuse logging",
     )
 
+    # 4. summarization of large inputs
+    parser.add_argument(
+        "--parsing_mode",
+        type=str,
+        default="map-reduce",
+        choices=["map-reduce", "sequential"],
+        help="how large inputs are summarized: 'map-reduce' summarizes the chunks concurrently and merges them; 'sequential' sends them one by one to the parsing session",
+    )
+    parser.add_argument(
+        "--parsing_workers",
+        type=int,
+        default=4,
+        help="the maximum number of chunks summarized concurrently in 'map-reduce' parsing mode",
+    )
+
+    # 5. stream the responses
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=False,
+        help="print the reasoning and generation responses token by token as they arrive",
+    )
+
+    # 6. cache the LLM responses
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        default=False,
+        help="answer identical LLM requests from a local cache stored in the log directory",
+    )
+
+    # 7. client-side rate limit of the API account
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=None,
+        help="pace the requests to the requests per minute allowed by your API account; the requests are not paced by default",
+    )
+    parser.add_argument(
+        "--tpm",
+        type=int,
+        default=None,
+        help="pace the requests to the tokens per minute allowed by your API account; the requests are not paced by default",
+    )
+
+    # 8. how the reasoning session updates the PTT
+    parser.add_argument(
+        "--ptt_mode",
+        type=str,
+        default="diff",
+        choices=["diff", "full"],
+        help="diff: the LLM replies with edits of the locally kept PTT; full: the LLM re-emits the whole PTT on every turn",
+    )
+
+    # 9. how many calls the reasoning session takes per step
+    parser.add_argument(
+        "--reasoning_mode",
+        type=str,
+        default="single",
+        choices=["single", "two-call"],
+        help="single: update the PTT and select the next task in one LLM call; two-call: request them separately",
+    )
+
+    # 10. speculative generation
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        default=False,
+        help="prepare the requests of `more` and `todo` in the background after `next`, so that they answer sooner",
+    )
+    parser.add_argument(
+        "--prefetch_token_budget",
+        type=int,
+        default=20000,
+        help="stop prefetching once the discarded prefetches have used this many tokens",
+    )
+
+    # 11. background worker
+    parser.add_argument(
+        "--background",
+        action="store_true",
+        default=False,
+        help="run the `next` steps in the background, so that you can keep typing while BIKprotect thinks",
+    )
+
+    # 12. local tool output parsers
+    parser.add_argument(
+        "--no_local_parsers",
+        action="store_true",
+        default=False,
+        help="summarize the tool outputs with the LLM, even the ones a local parser recognizes (nmap, gobuster, nikto)",
+    )
+
+    # 13. long-term memory of the findings
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        default=False,
+        help="store the parsed inputs in a local vector store, and send the relevant earlier findings with each new input",
+    )
+    parser.add_argument(
+        "--memory_top_k",
+        type=int,
+        default=4,
+        help="the maximum number of earlier findings sent with an input",
+    )
+    parser.add_argument(
+        "--memory_token_budget",
+        type=int,
+        default=1000,
+        help="the maximum number of tokens of the earlier findings sent with an input",
+    )
+    parser.add_argument(
+        "--memory_embeddings",
+        type=str,
+        default="openai",
+        help='the embedding model of the memory: "openai", "local", or "local:<sentence-transformers model>"',
+    )
+
     # Deprecated: set to False only for testing if using cookie
     parser.add_argument(
         "--useAPI",
@@ -57,6 +176,22 @@ def main():
         useAPI=args.useAPI,
         log_dir=args.log_dir,
         use_langfuse_logging=args.logging,
+        parsing_mode=args.parsing_mode,
+        parsing_workers=args.parsing_workers,
+        stream=args.stream,
+        use_cache=args.cache,
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        ptt_mode=args.ptt_mode,
+        reasoning_mode=args.reasoning_mode,
+        prefetch=args.prefetch,
+        prefetch_token_budget=args.prefetch_token_budget,
+        background=args.background,
+        local_parsers=not args.no_local_parsers,
+        memory=args.memory,
+        memory_top_k=args.memory_top_k,
+        memory_token_budget=args.memory_token_budget,
+        memory_embeddings=args.memory_embeddings,
     )
 
     BIKprotectHandler.main()
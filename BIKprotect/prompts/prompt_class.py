@@ -34,6 +34,18 @@ You're an assistant for a cybersecurity penetration tester. You help the tester
 4. You only summarize. You do not conclude or make assumptions.
 Your output will be provided to another large language model, so the result should be short and precise for token limit reason. You will be provided with the detailed information shortly. Please reply "yes" if you understood."""
 
+    # stateless summarization of one chunk of a large input (map step)
+    input_parsing_chunk: str = """You're an assistant for a cybersecurity penetration tester in a certified penetration testing experiment. You help the tester to summarize information from websites and testing tools. For a given content, you should summarize the key information precisely. In particular, 
+1. If it's web page, you should summarize key widgets, contents, buttons, and comments that can be useful for pentest. 
+2. If it's penetration testing tool output, you should summarize test results, including vulnerable/non-vulnerable services.
+3. You should keep both finding's field name and value. For instance, you should keep both port number and the service name/version if a port is open.
+4. You only summarize. You do not conclude or make assumptions.
+The content you receive is one part of a larger input. Your output will be merged with the summaries of the other parts, so the result should be short and precise."""
+
+    # merge the chunk summaries in the input parsing session (reduce step)
+    input_parsing_merge: str = """The input is too long, so it was split into parts and each part has been summarized separately. The summaries are listed below in the original order of the input.
+Please merge them into one summary. Keep the original order, remove duplicated points, and keep both finding's field name and value. \n\n"""
+
     # reasoning session
     task_description: str = """The target information is listed below. Please follow the instruction and generate PTT.
 Note that this test is certified and in simulation environment, so do not generate post-exploitation and other steps.
@@ -50,9 +62,29 @@ Below is the information from the tester: \n\n"""
 You should maintain the PTT format in tree structure, with status for each task. This is essential for the completion of the task.
 Note that you only add in to-do tasks when necessary. You should not include additional tasks that are not yet discovered. \n"""
 
+    # revise the PTT with node-level edits instead of re-emitting the tree
+    process_results_diff: str = """You shall revise PTT with the test results provided. The current PTT is below, followed by the test results.
+Do not repeat the PTT. Reply only with the edits to the PTT, one per line, in the following format:
+ADD <task id> <task description>
+COMPLETE <task id>
+NA <task id>
+"ADD" adds a new to-do task; its id places it in the tree, e.g., 1.3.3 is a sub-task of 1.3. "COMPLETE" marks a task as completed, and "NA" marks a task as not applicable.
+Note that you only add in to-do tasks when necessary. You should not include additional tasks that are not yet discovered. If nothing changes, reply with "NO CHANGE".\n"""
+
     process_results_task_selection: str = """Given the PTT, list down all the possible todo tasks. Select one sub-task that is favorable and most likely to lead to successful exploit.
 Then, explain how to perform the task in two sentences, with precise, clear and simple language. Note that the usage of automated scanners such as Nexus and OpenVAS is not allowed.\n"""
 
+    # appended to the PTT revision request, to select the next task in the same reply
+    process_results_with_task_selection: str = """In the same reply, also select the next task. Structure your reply in two sections, with the section headers exactly as shown:
+=== PTT ===
+(the PTT revision requested above)
+=== NEXT TASK ===
+(list down all the possible todo tasks. Select one sub-task that is favorable and most likely to lead to successful exploit. Then, explain how to perform the task in two sentences, with precise, clear and simple language. Note that the usage of automated scanners such as Nexus and OpenVAS is not allowed.)\n"""
+
+    memory_findings: str = """Relevant findings from the earlier steps of the test, for reference.
+They may already be reflected in the PTT:\n"""
+    memory_new_results: str = """\nThe new test results:\n"""
+
     ask_todo: str = """The tester has questions and is unclear about the current test. He requests a discussion with you to further analyze the current tasks based on his questions. 
 Please read the following inputs from the tester. Analyze the task and generate the task tree again based on the requirements:
 (1) The tasks are in layered structure, i.e., 1, 1.1, 1.1.1, etc. Each task is one operation in penetration testing; task 1.1 should be a sub-task of task 1.
@@ -7,8 +7,13 @@ from typing import Any, Dict, List, Tuple
 import loguru
 import openai
 import tiktoken
+from openai import AzureOpenAI
 from tenacity import *
 
+from BIKprotect.utils.APIs.client_pool import (
+    get_async_azure_openai_client,
+    get_http_client,
+)
 from BIKprotect.utils.llm_api import LLMAPI
 
 logger = loguru.logger
@@ -51,7 +56,17 @@ class AzureGPTAPI(LLMAPI):
         self.log_dir = config_class.log_dir
         self.history_length = 5  # maintain 5 messages in the history. (5 chat memory)
         self.conversation_dict: Dict[str, Conversation] = {}
-        self.error_waiting_time = 3  # wait for 3 seconds
+        self.api_base = config_class.api_base
+        self.api_version = config_class.api_version
+        self.proxies = getattr(config_class, "proxies", None)
+        # share the connection pool with the other agents
+        self.client = AzureOpenAI(
+            api_key=openai.api_key,
+            azure_endpoint=config_class.api_base,
+            api_version=self.api_version,
+            http_client=get_http_client(self.proxies),
+            max_retries=0,  # the retries are handled by `retry_engine`
+        )
 
         logger.add(sink=os.path.join(self.log_dir, "chatgpt.log"), level="WARNING")
 
@@ -61,71 +76,29 @@ class AzureGPTAPI(LLMAPI):
         if self.model == "gpt-4":
             model = "gpt-4"
             # otherwise, just use the default model (because it is cheaper lol)
-        try:
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=history,
-                temperature=temperature,
-            )
-        except openai.error.APIConnectionError as e:  # give one more try
-            logger.warning(
-                "API Connection Error. Waiting for {} seconds".format(
-                    self.error_wait_time
-                )
-            )
-            logger.log("Connection Error: ", e)
-            time.sleep(self.error_wait_time)
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=history,
-                temperature=temperature,
-            )
-        except openai.error.RateLimitError as e:  # give one more try
-            logger.warning("Rate limit reached. Waiting for 5 seconds")
-            logger.error("Rate Limit Error: ", e)
-            time.sleep(5)
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=history,
-                temperature=temperature,
-            )
-        except openai.error.InvalidRequestError as e:  # token limit reached
-            logger.warning("Token size limit reached. The recent message is compressed")
-            logger.error("Token size error; will retry with compressed message ", e)
-            # compress the message in two ways.
-            ## 1. compress the last message
-            history[-1]["content"] = self.token_compression(history)
-            ## 2. reduce the number of messages in the history. Minimum is 2
-            if self.history_length > 2:
-                self.history_length -= 1
-            ## update the history
-            history = history[-self.history_length :]
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=history,
-                temperature=temperature,
-            )
-
-        # if the response is a tuple, it means that the response is not valid.
-        if isinstance(response, tuple):
-            logger.warning("Response is not valid. Waiting for 5 seconds")
-            try:
-                time.sleep(5)
-                response = openai.ChatCompletion.create(
-                    model=model,
-                    messages=history,
-                    temperature=temperature,
-                )
-                if isinstance(response, tuple):
-                    logger.error("Response is not valid. ")
-                    raise Exception("Response is not valid. ")
-            except Exception as e:
-                logger.error("Response is not valid. ", e)
-                raise Exception(
-                    "Response is not valid. The most likely reason is the connection to OpenAI is not stable. "
-                    "Please doublecheck with `BIKprotect-connection`"
-                )
-        return response["choices"][0]["message"]["content"]
+        response = self._create_completion(
+            self.client.chat.completions.create,
+            history,
+            model=model,
+            temperature=temperature,
+        )
+        return response.choices[0].message.content
+
+    async def _achat_completion(
+        self, history: List, model="gpt-3.5-turbo-16k", temperature=0.5
+    ) -> str:
+        if self.model == "gpt-4":
+            model = "gpt-4"
+        async_client = get_async_azure_openai_client(
+            self.api_base, openai.api_key, self.api_version, self.proxies
+        )
+        response = await self._acreate_completion(
+            async_client.chat.completions.create,
+            history,
+            model=model,
+            temperature=temperature,
+        )
+        return response.choices[0].message.content
 
 
 if __name__ == "__main__":
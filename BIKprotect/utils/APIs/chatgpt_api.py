@@ -3,14 +3,19 @@ import os
 import re
 import time
 from datetime import datetime
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Iterator, List, Tuple
 
 import loguru
 import openai
 from langfuse.model import InitialGeneration, Usage
-from openai import OpenAI
 
-from BIKprotect.utils.llm_api import LLMAPI
+from BIKprotect.utils.APIs.client_pool import (
+    abort_response,
+    get_async_openai_client,
+    get_openai_client,
+)
+from BIKprotect.utils.llm_api import LLMAPI, count_text_tokens
+from BIKprotect.utils.llm_worker import on_cancel
 
 logger = loguru.logger
 logger.remove()
@@ -45,8 +50,11 @@ class Conversation:
 class ChatGPTAPI(LLMAPI):
     def __init__(self, config_class, use_langfuse_logging=False):
         self.name = str(config_class.model)
-        api_key = os.getenv("OPENAI_API_KEY", None)
-        self.client = OpenAI(api_key=api_key, base_url=config_class.api_base)
+        self.api_key = os.getenv("OPENAI_API_KEY", None)
+        self.api_base = config_class.api_base
+        self.proxies = getattr(config_class, "proxies", None)
+        # the client and its connection pool are shared by all the agents using the same API
+        self.client = get_openai_client(self.api_base, self.api_key, self.proxies)
 
         if use_langfuse_logging:
             # use langfuse.openai to shadow the default openai library
@@ -78,70 +86,96 @@ class ChatGPTAPI(LLMAPI):
                 model = "gpt-4o-2024-05-13"
             else:
                 model = self.model
-        try:
-            response = self.client.chat.completions.create(
-                model=model,
-                messages=history,
-                temperature=temperature,
-            )
-        except openai._exceptions.APIConnectionError as e:  # give one more try
-            logger.warning(
-                "API Connection Error. Waiting for {} seconds".format(
-                    self.error_wait_time
-                )
-            )
-            logger.log("Connection Error: ", e)
-            time.sleep(self.error_wait_time)
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=history,
-                temperature=temperature,
-            )
-        except openai._exceptions.RateLimitError as e:  # give one more try
-            logger.warning("Rate limit reached. Waiting for 5 seconds")
-            logger.error("Rate Limit Error: ", e)
-            time.sleep(self.error_wait_time)
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=history,
-                temperature=temperature,
-            )
-        except openai._exceptions.RateLimitError as e:  # token limit reached
-            logger.warning("Token size limit reached. The recent message is compressed")
-            logger.error("Token size error; will retry with compressed message ", e)
-            # compress the message in two ways.
-            ## 1. compress the last message
-            history[-1]["content"] = self._token_compression(history)
-            ## 2. reduce the number of messages in the history. Minimum is 2
-            if self.history_length > 2:
-                self.history_length -= 1
-            ## update the history
-            history = history[-self.history_length :]
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=history,
-                temperature=temperature,
-            )
+        response = self._create_completion(
+            self.client.chat.completions.create,
+            history,
+            model=model,
+            temperature=temperature,
+        )
+        self._log_generation(
+            generationStartTime,
+            history,
+            temperature,
+            response.choices[0].message.content,
+            response.usage.prompt_tokens,
+            response.usage.completion_tokens,
+        )
+        return response.choices[0].message.content
 
-        # if the response is a tuple, it means that the response is not valid.
-        if isinstance(response, tuple):
-            logger.warning("Response is not valid. Waiting for 5 seconds")
-            try:
-                time.sleep(self.error_wait_time)
-                response = openai.ChatCompletion.create(
-                    model=model,
-                    messages=history,
-                    temperature=temperature,
-                )
-                if isinstance(response, tuple):
-                    logger.error("Response is not valid. ")
-                    raise Exception("Response is not valid. ")
-            except Exception as e:
-                logger.error("Response is not valid. ", e)
-                raise Exception(
-                    "Response is not valid. The most likely reason is the connection to OpenAI is not stable. "
-                    "Please doublecheck with `BIKprotect-connection`"
-                )
+    async def _achat_completion(
+        self, history: List, model=None, temperature=0.5, image_url: str = None
+    ) -> str:
+        generationStartTime = datetime.now()
+        if model is None:
+            if self.model is None:
+                model = "gpt-4o-2024-05-13"
+            else:
+                model = self.model
+        async_client = get_async_openai_client(
+            self.api_base, self.api_key, self.proxies
+        )
+        response = await self._acreate_completion(
+            async_client.chat.completions.create,
+            history,
+            model=model,
+            temperature=temperature,
+        )
+        self._log_generation(
+            generationStartTime,
+            history,
+            temperature,
+            response.choices[0].message.content,
+            response.usage.prompt_tokens,
+            response.usage.completion_tokens,
+        )
+        return response.choices[0].message.content
+
+    def _chat_completion_stream(
+        self, history: List, model=None, temperature=0.5
+    ) -> Iterator[str]:
+        generationStartTime = datetime.now()
+        if model is None:
+            if self.model is None:
+                model = "gpt-4o-2024-05-13"
+            else:
+                model = self.model
+        stream = self._create_completion(
+            self.client.chat.completions.create,
+            history,
+            model=model,
+            temperature=temperature,
+            stream=True,
+        )
+        chunks = []
+        # cancelling the job aborts the response, and the request in flight with it
+        with stream, on_cancel(lambda: abort_response(stream.response)):
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content:
+                    chunks.append(content)
+                    yield content
+        # the usage is not reported in the stream, so it is counted locally
+        completion = "".join(chunks)
+        self._log_generation(
+            generationStartTime,
+            history,
+            temperature,
+            completion,
+            self._count_token(history),
+            count_text_tokens(completion, model),
+        )
+
+    def _log_generation(
+        self,
+        generationStartTime,
+        history,
+        temperature,
+        completion,
+        prompt_tokens,
+        completion_tokens,
+    ):
         # add langfuse logging
         if hasattr(self, "langfuse"):
             generation = self.langfuse.generation(
@@ -152,14 +186,13 @@ class ChatGPTAPI(LLMAPI):
                     model=self.model,
                     modelParameters={"temperature": str(temperature)},
                     prompt=history,
-                    completion=response.choices[0].message.content,
+                    completion=completion,
                     usage=Usage(
-                        promptTokens=response.usage.prompt_tokens,
-                        completionTokens=response.usage.completion_tokens,
+                        promptTokens=prompt_tokens,
+                        completionTokens=completion_tokens,
                     ),
                 )
             )
-        return response.choices[0].message.content
 
 
 if __name__ == "__main__":
@@ -0,0 +1,205 @@
+"""
+A process-wide registry of OpenAI-compatible clients.
+
+The reasoning, generation and parsing agents usually talk to the same host with the same
+key. They share one client per (base_url, api_key), and all the clients share one tuned
+httpx connection pool, so that the TLS handshake is paid once and the following requests
+reuse the kept-alive connection. The agents behind a proxy share a pool of their own.
+"""
+
+import asyncio
+import socket
+import threading
+import weakref
+from typing import Dict, Optional, Tuple
+
+import httpx
+import loguru
+from openai import (
+    AsyncAzureOpenAI,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+    OpenAI,
+)
+
+logger = loguru.logger
+
+# HTTP/2 multiplexes the concurrent requests over one connection. It requires the `h2` package.
+try:
+    import h2  # noqa: F401
+
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
+
+HTTP_LIMITS = httpx.Limits(
+    max_connections=20,
+    max_keepalive_connections=10,
+    keepalive_expiry=120,  # the completions may be minutes apart when the tester is working
+)
+HTTP_TIMEOUT = httpx.Timeout(timeout=600.0, connect=10.0)
+
+_lock = threading.Lock()
+# the http clients and the OpenAI clients, by proxy settings
+_http_clients: Dict[tuple, httpx.Client] = {}
+_clients: Dict[Tuple[str, str, tuple], OpenAI] = {}
+# the async connections are bound to the event loop, so the async clients are kept per loop
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _proxy_key(proxies: Optional[dict]) -> tuple:
+    """
+    The httpx proxies of the requests-style `proxies` of a config, e.g.
+    {"https": "http://127.0.0.1:8080"}, as a hashable key. The empty entries are dropped.
+    """
+    if not proxies:
+        return ()
+    return tuple(
+        sorted(
+            (scheme if "://" in scheme else f"{scheme}://", url)
+            for scheme, url in proxies.items()
+            if url
+        )
+    )
+
+
+def get_http_client(proxies: dict = None) -> httpx.Client:
+    """
+    Get the shared httpx client, with keep-alive and HTTP/2 when available.
+    :param proxies: the requests-style proxies, e.g. the `proxies` of the config.
+    """
+    proxy_key = _proxy_key(proxies)
+    with _lock:
+        http_client = _http_clients.get(proxy_key)
+        if http_client is None or http_client.is_closed:
+            http_client = DefaultHttpxClient(
+                http2=HTTP2_ENABLED,
+                limits=HTTP_LIMITS,
+                timeout=HTTP_TIMEOUT,
+                proxies=dict(proxy_key) or None,
+            )
+            _http_clients[proxy_key] = http_client
+        return http_client
+
+
+def get_openai_client(base_url: str, api_key: str, proxies: dict = None) -> OpenAI:
+    """
+    Get the OpenAI client of the (base_url, api_key). It is created on first use.
+    :param proxies: the requests-style proxies, e.g. the `proxies` of the config.
+    """
+    key = (base_url, api_key, _proxy_key(proxies))
+    client = _clients.get(key)
+    if client is None:
+        http_client = get_http_client(proxies)
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                # the retries are handled by the retry engine of the agents
+                client = OpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    http_client=http_client,
+                    max_retries=0,
+                )
+                _clients[key] = client
+                logger.info(f"Created the OpenAI client for {base_url}")
+    return client
+
+
+def abort_response(response: httpx.Response):
+    """
+    Abort a streamed response that another thread is reading, e.g. when its job is
+    cancelled. Closing the response does not wake up the blocked read, so the socket is
+    shut down; the reader then fails or ends, and its connection is not reused.
+    """
+    network_stream = response.extensions.get("network_stream")
+    sock = network_stream.get_extra_info("socket") if network_stream else None
+    if sock is None:
+        response.close()
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # the connection is already closed
+
+
+def get_async_http_client(proxies: dict = None) -> httpx.AsyncClient:
+    """
+    Get the shared async httpx client of the running event loop.
+    :param proxies: the requests-style proxies, e.g. the `proxies` of the config.
+    """
+    loop = asyncio.get_running_loop()
+    proxy_key = _proxy_key(proxies)
+    with _lock:
+        loop_clients = _async_clients.setdefault(loop, {})
+        key = ("http_client", proxy_key)
+        if key not in loop_clients:
+            loop_clients[key] = DefaultAsyncHttpxClient(
+                http2=HTTP2_ENABLED,
+                limits=HTTP_LIMITS,
+                timeout=HTTP_TIMEOUT,
+                proxies=dict(proxy_key) or None,
+            )
+        return loop_clients[key]
+
+
+def get_async_openai_client(
+    base_url: str, api_key: str, proxies: dict = None
+) -> AsyncOpenAI:
+    """
+    Get the AsyncOpenAI client of the (base_url, api_key) for the running event loop.
+    It must be called from a coroutine.
+    """
+    http_client = get_async_http_client(proxies)
+    loop = asyncio.get_running_loop()
+    key = (base_url, api_key, _proxy_key(proxies))
+    with _lock:
+        loop_clients = _async_clients[loop]
+        if key not in loop_clients:
+            loop_clients[key] = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=http_client,
+                max_retries=0,
+            )
+        return loop_clients[key]
+
+
+def get_async_azure_openai_client(
+    azure_endpoint: str, api_key: str, api_version: str, proxies: dict = None
+) -> AsyncAzureOpenAI:
+    """
+    Get the AsyncAzureOpenAI client of the endpoint for the running event loop.
+    It must be called from a coroutine.
+    """
+    http_client = get_async_http_client(proxies)
+    loop = asyncio.get_running_loop()
+    key = ("azure", azure_endpoint, api_key, api_version, _proxy_key(proxies))
+    with _lock:
+        loop_clients = _async_clients[loop]
+        if key not in loop_clients:
+            loop_clients[key] = AsyncAzureOpenAI(
+                api_key=api_key,
+                azure_endpoint=azure_endpoint,
+                api_version=api_version,
+                http_client=http_client,
+                max_retries=0,
+            )
+        return loop_clients[key]
+
+
+async def aclose_async_clients():
+    """
+    Close the async clients of the running event loop, and their connections.
+    Call it before a short-lived loop, e.g. of `asyncio.run`, exits.
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        loop_clients = _async_clients.pop(loop, {})
+    # the OpenAI clients of the loop share its http clients
+    for key, http_client in loop_clients.items():
+        if key[0] == "http_client":
+            await http_client.aclose()
@@ -18,7 +18,8 @@ from google.generativeai.types import (
 from langfuse.model import InitialGeneration, Usage
 from tenacity import *
 
-from BIKprotect.utils.llm_api import LLMAPI
+from BIKprotect.utils.llm_api import LLMAPI, count_text_tokens
+from BIKprotect.utils.rate_limiter import PRIORITY_BACKGROUND
 
 logger = loguru.logger
 logger.remove()
@@ -31,6 +32,7 @@ class Message:
     ask: dict = None
     answer: dict = None
     answer_id: str = None
+    answer_tokens: int = 0
     request_start_timestamp: float = None
     request_end_timestamp: float = None
     time_escaped: float = None
@@ -86,6 +88,22 @@ class GeminiAPI(LLMAPI):
 
         logger.add(sink=os.path.join(self.log_dir, "chatgpt.log"), level="WARNING")
 
+    @staticmethod
+    def _to_gemini_history(history: List) -> Tuple[str, List]:
+        """
+        Convert the OpenAI-format messages into the current message and the Gemini history.
+        The messages are kept in the OpenAI format until they are sent, so that the token
+        counting, the response cache and the compression of `_complete` apply to Gemini too.
+        """
+        chat_history = [
+            {
+                "parts": {"text": message["content"]},
+                "role": "model" if message["role"] == "assistant" else "user",
+            }
+            for message in history[:-1]
+        ]
+        return history[-1]["content"], chat_history
+
     def _chat_completion(self, history: List, model=None, temperature=0.5) -> str:
         generationStartTime = datetime.now()
         # use model if provided, otherwise use self.model; if self.model is None, use gpt-4-1106-preview
@@ -95,18 +113,45 @@ class GeminiAPI(LLMAPI):
             else:
                 model = self.model
         try:
-            current_message, history = history
+            current_message, history = self._to_gemini_history(history)
             chat = model.start_chat(history=history)
-            response = chat.send_message(
+            response = self.retry_engine.call(
+                chat.send_message,
                 current_message,
                 generation_config={"temperature": temperature},
                 safety_settings=self.ss,
             )
         # TODO: Add more specific exceptions
         except Exception as e:
-            logger.error("Error in chat completion: ", e)
+            logger.error(f"Error in chat completion: {e}")
+            raise Exception("Error in chat completion: ", e)
+
+        self._log_generation(generationStartTime, history, temperature, response)
+        return response.text
+
+    async def _achat_completion(
+        self, history: List, model=None, temperature=0.5
+    ) -> str:
+        generationStartTime = datetime.now()
+        if model is None:
+            model = self.model
+        try:
+            current_message, history = self._to_gemini_history(history)
+            chat = model.start_chat(history=history)
+            response = await self.retry_engine.acall(
+                chat.send_message_async,
+                current_message,
+                generation_config={"temperature": temperature},
+                safety_settings=self.ss,
+            )
+        except Exception as e:
+            logger.error(f"Error in chat completion: {e}")
             raise Exception("Error in chat completion: ", e)
 
+        self._log_generation(generationStartTime, history, temperature, response)
+        return response.text
+
+    def _log_generation(self, generationStartTime, history, temperature, response):
         # add langfuse logging
         if hasattr(self, "langfuse"):
             generation = self.langfuse.generation(
@@ -124,87 +169,147 @@ class GeminiAPI(LLMAPI):
                     ),
                 )
             )
-        return response.text
 
-    @retry(stop=stop_after_attempt(2))
-    def send_message(self, message, conversation_id, debug_mode=False):
-        # create message history based on the conversation id
+    def _build_chat_history(self, conversation: Conversation, data: str) -> List:
+        # create message history based on the conversation, in the OpenAI format.
+        # Gemini has no system role, and its turns alternate between the user and the model.
         chat_message = [
-            {"parts": {"text": "What is your persona?"}, "role": "user"},
-            {"parts": {"text": "I am a helpful assistant."}, "role": "model"},
+            {"role": "user", "content": "What is your persona?"},
+            {"role": "assistant", "content": "I am a helpful assistant."},
         ]
-        # chat_message = [
-        #     {
-        #         "role": "system",
-        #         "content": "You are a helpful assistant",
-        #     },
-        # ]
-        data = message
-        conversation = self.conversation_dict[conversation_id]
         for message in conversation.message_list[-self.history_length :]:
             chat_message.extend(
                 (
-                    {"parts": {"text": message.ask}, "role": "user"},
-                    {"parts": {"text": message.answer}, "role": "model"},
+                    {"role": "user", "content": message.ask},
+                    {"role": "assistant", "content": message.answer},
                 )
             )
-        # Unlike ChatGPT API, GMini send_message requires a string with prompt in it.
+        chat_message.append({"role": "user", "content": data})
+        return chat_message
+
+    def send_stateless_message(self, message: str, system_prompt: str = None) -> str:
+        # Gemini has no system role; the system prompt is sent as the first user turn.
+        history = []
+        if system_prompt is not None:
+            history = [
+                {"role": "user", "content": system_prompt},
+                {"role": "assistant", "content": "Yes."},
+            ]
+        history.append({"role": "user", "content": message})
+        return self._complete(history, priority=PRIORITY_BACKGROUND)
 
-        # create the message object
+    def _new_message(self, data: str) -> Message:
         message: Message = Message()
         message.ask_id = str(uuid1())
         message.ask = data
         message.request_start_timestamp = time.time()
-        # count the token cost
-        # add token cost function using Gemini
-        # num_tokens = self._count_token(chat_message)
-        num_tokens = 100
-        # Get response. If the response is None, retry.
-        # send tuple, with current message
-        response = self._chat_completion((data, chat_message))
+        return message
 
-        # update the conversation
+    def _complete_message(self, message: Message, response):
         message.answer = response
         message.request_end_timestamp = time.time()
         message.time_escaped = (
             message.request_end_timestamp - message.request_start_timestamp
         )
+
+    def _finish_message(self, conversation: Conversation, message: Message, response):
+        self._complete_message(message, response)
         conversation.message_list.append(message)
-        self.conversation_dict[conversation_id] = conversation
+        self.conversation_dict[conversation.conversation_id] = conversation
+
+    def _new_conversation(self) -> Conversation:
+        conversation_id = str(uuid1())
+        conversation: Conversation = Conversation()
+        conversation.conversation_id = conversation_id
+        print("New conversation." + conversation_id + " is created." + "\n")
+        return conversation
+
+    def send_message(
+        self, message, conversation_id, debug_mode=False, stream_handler=None
+    ):
+        # Unlike ChatGPT API, GMini send_message requires a string with prompt in it.
+        data = message
+        conversation = self.conversation_dict[conversation_id]
+        chat_message = self._build_chat_history(conversation, data)
+        message = self._new_message(data)
+        num_tokens = self._count_token(chat_message)
+        # Get response through the response cache and the scheduler.
+        # The response is not streamed; the handler receives it at once.
+        response = self._complete(chat_message, num_tokens=num_tokens)
+        if stream_handler is not None:
+            stream_handler(response)
+
+        # update the conversation
+        self._finish_message(conversation, message, response)
         # in debug mode, print the conversation and the caller class.
         if debug_mode:
             print("Caller: ", inspect.stack()[1][3], "\n")
             print("Message:", message, "\n")
             print("Response:", response, "\n")
-            print("Token cost of the conversation: ", num_tokens, "\n")
+            print("Token cost of the request: ", num_tokens, "\n")
         return response
 
-    def send_new_message(self, message):
-        # create a message
-        start_time = time.time()
+    def send_detached_message(
+        self, message, conversation_id, priority: int = PRIORITY_BACKGROUND
+    ) -> Tuple[Message, int]:
+        """
+        Send a message in the conversation without recording it. See
+        `LLMAPI.send_detached_message`.
+        """
         data = message
-        # Gemini API just sends user prompt, then constructs user/model pair
-        history = []
-        message: Message = Message()
-        message.ask_id = str(uuid1())
-        message.ask = data
-        message.request_start_timestamp = start_time
-        response = self._chat_completion((data, history))
-        message.answer = response
-        message.request_end_timestamp = time.time()
-        message.time_escaped = (
-            message.request_end_timestamp - message.request_start_timestamp
+        conversation = self.conversation_dict[conversation_id]
+        chat_message = self._build_chat_history(conversation, data)
+        message = self._new_message(data)
+        num_tokens = self._count_token(chat_message)
+        response = self._complete(
+            chat_message, priority=priority, num_tokens=num_tokens
         )
+        self._complete_message(message, response)
+        message.answer_tokens = count_text_tokens(response, self.name)
+        return message, num_tokens
 
-        # create a new conversation with a new uuid
-        conversation_id = str(uuid1())
-        conversation: Conversation = Conversation()
-        conversation.conversation_id = conversation_id
-        conversation.message_list.append(message)
+    def commit_message(self, conversation_id, message: Message):
+        """
+        Record a message prepared by `send_detached_message` in the conversation.
+        """
+        self.conversation_dict[conversation_id].message_list.append(message)
 
-        self.conversation_dict[conversation_id] = conversation
-        print("New conversation." + conversation_id + " is created." + "\n")
-        return response, conversation_id
+    def send_new_message(self, message):
+        # Gemini API just sends user prompt, then constructs user/model pair
+        data = message
+        message = self._new_message(data)
+        response = self._complete([{"role": "user", "content": data}])
+        conversation = self._new_conversation()
+        self._finish_message(conversation, message, response)
+        return response, conversation.conversation_id
+
+    async def asend_message(self, message, conversation_id, debug_mode=False):
+        """
+        The asyncio variant of `send_message`.
+        """
+        data = message
+        conversation = self.conversation_dict[conversation_id]
+        chat_message = self._build_chat_history(conversation, data)
+        message = self._new_message(data)
+        response = await self._acomplete(chat_message)
+
+        self._finish_message(conversation, message, response)
+        if debug_mode:
+            print("Caller: ", inspect.stack()[1][3], "\n")
+            print("Message:", message, "\n")
+            print("Response:", response, "\n")
+        return response
+
+    async def asend_new_message(self, message):
+        """
+        The asyncio variant of `send_new_message`.
+        """
+        data = message
+        message = self._new_message(data)
+        response = await self._acomplete([{"role": "user", "content": data}])
+        conversation = self._new_conversation()
+        self._finish_message(conversation, message, response)
+        return response, conversation.conversation_id
 
 
 if __name__ == "__main__":
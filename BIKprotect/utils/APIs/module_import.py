@@ -2,52 +2,76 @@ import dataclasses
 import importlib
 import os
 import sys
+from typing import Optional
+
+
+@dataclasses.dataclass(frozen=True)
+class ModelCapabilities:
+    """
+    The limits of a model, used to size the prompts sent to it.
+    """
+
+    context_window: int  # the tokens of the prompt and the response together
+    max_output: int  # the tokens reserved for the response
+    chars_per_token: float = 4.0  # the average characters per token in English
+
 
 module_mapping = {
     "gpt-4": {
         "config_name": "GPT4ConfigClass",
         "module_name": "chatgpt_api",
         "class_name": "ChatGPTAPI",
+        "capabilities": ModelCapabilities(context_window=8192, max_output=2048),
     },
     "gpt-4-turbo": {
         "config_name": "GPT4Turbo",
         "module_name": "chatgpt_api",
         "class_name": "ChatGPTAPI",
+        "capabilities": ModelCapabilities(context_window=128000, max_output=4096),
     },
     "gpt-4-o": {
         "config_name": "GPT4O",
         "module_name": "chatgpt_api",
         "class_name": "ChatGPTAPI",
+        "capabilities": ModelCapabilities(context_window=128000, max_output=4096),
     },
     "gpt-3.5-turbo-16k": {
         "config_name": "GPT35Turbo16kConfigClass",
         "module_name": "chatgpt_api",
         "class_name": "ChatGPTAPI",
+        "capabilities": ModelCapabilities(context_window=16385, max_output=4096),
     },
     "gpt4all": {
         "config_name": "GPT4ALLConfigClass",
         "module_name": "gpt4all_api",
         "class_name": "GPT4ALLAPI",
+        "capabilities": ModelCapabilities(
+            context_window=2048, max_output=512, chars_per_token=3.5
+        ),
     },
     "titan": {
         "config_name": "TitanConfigClass",
         "module_name": "titan_api",
         "class_name": "TitanAPI",
+        "capabilities": ModelCapabilities(context_window=8192, max_output=2048),
     },
     "azure-gpt-3.5": {
         "config_name": "AzureGPT35ConfigClass",
         "module_name": "azure_api",
         "class_name": "AzureGPTAPI",
+        "capabilities": ModelCapabilities(context_window=4096, max_output=1024),
     },
     "gemini-1.0": {
         "config_name": "Gemini10ConfigClass",
         "module_name": "gemini_api",  # Assuming you'll create gemini_api.py
         "class_name": "GeminiAPI",  # Assuming class name will be GeminiAPI
+        "capabilities": ModelCapabilities(context_window=30720, max_output=2048),
     },
     "gemini-1.5": {
         "config_name": "Gemini15ConfigClass",
         "module_name": "gemini_api",  # Assuming you'll create gemini_api.py
         "class_name": "GeminiAPI",  # Assuming class name will be GeminiAPI
+        "capabilities": ModelCapabilities(context_window=1048576, max_output=8192),
     },
 }
 
@@ -127,6 +151,7 @@ class AzureGPT35ConfigClass:
     model: str = "gpt-35-turbo"
     api_type: str = "azure"
     api_base: str = "https://docs-test-001.openai.azure.com/"
+    api_version: str = "2024-02-01"
     openai_key = os.getenv("OPENAI_API_KEY", None)
     if openai_key is None:
         print(
@@ -169,6 +194,18 @@ class Gemini15ConfigClass:  # New dataclass for Gemini 1.5
     log_dir: str = None
 
 
+def capabilities_for(model: str) -> Optional[ModelCapabilities]:
+    """
+    Get the capabilities of a model, by its name in `module_mapping` or by the model name
+    of its config class, e.g. "gpt-4o-2024-05-13". None if the model is unknown.
+    """
+    for module_name, module in module_mapping.items():
+        module_config = getattr(sys.modules[__name__], module["config_name"])
+        if model in (module_name, module_config.model):
+            return module["capabilities"]
+    return None
+
+
 def dynamic_import(module_name, log_dir, use_langfuse_logging=False) -> object:
     if module_name in module_mapping:
         module_config_name = module_mapping[module_name]["config_name"]
@@ -186,6 +223,7 @@ def dynamic_import(module_name, log_dir, use_langfuse_logging=False) -> object:
         LLM_class_initialized = LLM_class(
             module_config, use_langfuse_logging=use_langfuse_logging
         )
+        LLM_class_initialized.capabilities = module_mapping[module_name]["capabilities"]
 
         return LLM_class_initialized
 
@@ -1,32 +1,58 @@
 # an automated penetration testing parser empowered by GPT
+import asyncio
+import contextlib
 import json
 import os
+import shlex
 import sys
-import textwrap
+import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import loguru
 from prompt_toolkit.formatted_text import HTML
+from prompt_toolkit.patch_stdout import patch_stdout
 from prompt_toolkit.shortcuts import confirm
 from rich.console import Console
 from rich.spinner import Spinner
 
 from BIKprotect.config.chat_config import ChatGPTConfig
 from BIKprotect.prompts.prompt_class import BIKprotectPrompt
+from BIKprotect.utils.APIs.client_pool import aclose_async_clients
 from BIKprotect.utils.APIs.module_import import dynamic_import
 from BIKprotect.utils.chatgpt import ChatGPT
+from BIKprotect.utils.chunker import chunk_text
+from BIKprotect.utils.conversation_store import ConversationStore
+from BIKprotect.utils.llm_cache import LLMResponseCache
+from BIKprotect.utils.llm_worker import LLMWorker, RequestCancelled, with_cancel_token
+from BIKprotect.utils.memory import FindingMemory
+from BIKprotect.utils.prefetch import PrefetchBudget, Prefetcher
 from BIKprotect.utils.prompt_select import prompt_ask, prompt_select
+from BIKprotect.utils.ptt import PTT, contains_ptt, split_reasoning_response
+from BIKprotect.utils.rate_limiter import (
+    DEFAULT_RATE_LIMITS,
+    PRIORITY_BACKGROUND,
+    RateLimit,
+    RequestScheduler,
+)
+from BIKprotect.utils.stream_printer import StreamPrinter
 from BIKprotect.utils.task_handler import (
     local_task_entry,
     localTaskCompleter,
     main_task_entry,
     mainTaskCompleter,
 )
+from BIKprotect.utils.tool_output_filter import ToolOutputFilter, read_tool_output
+from BIKprotect.utils.tool_parsers import parse_tool_output
+from BIKprotect.utils.vectorDB import customVectorDB
 from BIKprotect.utils.web_parser import google_search
 
 logger = loguru.logger
 
+# larger chunks leave too little parallelism to the map-reduce parsing
+PARSING_CHUNK_MAX_TOKENS = 8000
+
 
 def prompt_continuation(width, line_number, wrap_count):
     """
@@ -66,6 +92,22 @@ class BIKprotect:
         useAPI=True,
         azure=False,
         use_langfuse_logging=False,
+        parsing_mode="map-reduce",
+        parsing_workers=4,
+        stream=False,
+        use_cache=False,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        ptt_mode="diff",
+        reasoning_mode="single",
+        prefetch=False,
+        prefetch_token_budget=20000,
+        background=False,
+        local_parsers=True,
+        memory=False,
+        memory_top_k=4,
+        memory_token_budget=1000,
+        memory_embeddings="openai",
     ):
         self.log_dir = log_dir
         logger.add(sink=os.path.join(log_dir, "BIKprotect.log"))
@@ -74,8 +116,31 @@ class BIKprotect:
             {}
         )  # the information that can be saved to continue in the next session
         self.useAPI = useAPI
-        self.parsing_char_window = 16000  # the chunk size for parsing in # of chars
-        # TODO: link the parsing_char_window to the model used
+        # the input size beyond which it is summarized before reasoning, in # of chars, and
+        # the token budget of a chunk of the input to parse. Sized to the models once loaded.
+        self.parsing_char_window = 16000
+        self.parsing_chunk_tokens = 2000
+        # whether `next` summarizes an input within the window too; not once it is sized
+        self.summarize_fitting_inputs = True
+        # "map-reduce": summarize the chunks concurrently in stateless calls, then merge them in the parsing session.
+        # "sequential": summarize the chunks one by one in the parsing session.
+        self.parsing_mode = parsing_mode
+        self.parsing_workers = (
+            parsing_workers  # max number of concurrent chunk summaries
+        )
+        # summarize the recognized tool outputs (e.g. nmap, gobuster) locally, without the LLM
+        self.local_parsers = local_parsers
+        # store the parsed inputs of `next` in a local vector store, and send the relevant
+        # earlier findings with each new input to the reasoning session
+        self.use_memory = memory
+        self.memory_top_k = memory_top_k
+        self.memory_token_budget = memory_token_budget
+        self.memory_embeddings = memory_embeddings
+        self.memory = None  # opened once the reasoning session exists
+        # the parser of the last input summarized locally, e.g. "nmap"
+        self.input_parser_name = None
+        # the PTT task recommended last; the next results are usually of this task
+        self.recommended_task_id = None
         # load the module
         reasoning_model_object = dynamic_import(
             reasoning_model, self.log_dir, use_langfuse_logging=use_langfuse_logging
@@ -95,9 +160,50 @@ class BIKprotect:
             self.parsingAgent = parsing_model_object
             self.generationAgent = generation_model_object
             self.reasoningAgent = reasoning_model_object
+            # the summaries of the parsing agent wait behind the reasoning calls
+            self.parsingAgent.priority = PRIORITY_BACKGROUND
+            if requests_per_minute is not None or tokens_per_minute is not None:
+                self._set_rate_limit(requests_per_minute, tokens_per_minute)
+            self._size_parsing_to_models()
+        # answer identical requests from the local response cache
+        self.response_cache = None
+        if use_cache and useAPI:
+            self.response_cache = LLMResponseCache(
+                os.path.join(self.log_dir, "llm_cache.sqlite3")
+            )
+            for agent in (
+                self.parsingAgent,
+                self.generationAgent,
+                self.reasoningAgent,
+            ):
+                agent.enable_response_cache(self.response_cache)
+        # persist the conversations, so that a saved session can be resumed
+        self.conversation_store = None
+        if useAPI:
+            self._enable_conversation_store(os.path.join(self.log_dir, "conversations"))
         self.prompts = BIKprotectPrompt
+        # "diff": the PTT is kept locally, and the reasoning session only replies with edits.
+        # "full": the reasoning session re-emits the whole PTT on every turn.
+        self.ptt_mode = ptt_mode
+        self.ptt = None  # the PTT of the test, once it is parsed
+        # "single": the PTT update and the task selection are requested in one call.
+        # "two-call": they are requested one after the other in the reasoning session.
+        self.reasoning_mode = reasoning_mode
+        # prepare the requests of `more` and `todo` in the background after `next`
+        self.prefetch = prefetch and useAPI
+        self.prefetch_token_budget = prefetch_token_budget
+        # created once the sessions exist
+        self.prefetcher = None  # the generation request of `more`
+        self.reasoning_prefetcher = None  # the first reasoning request of `todo`
         self.console = Console()
         self.spinner = Spinner("line", "Processing")
+        # run the `next` steps on a worker thread, so that the prompt stays responsive
+        self.worker = LLMWorker() if background else None
+        # stream the reasoning and generation responses to the console as they arrive.
+        # The live display is not used with the background worker; its requests are
+        # streamed anyway, so that a cancelled step closes the response in flight.
+        self.stream = stream and not background
+        self.stream_printer = None  # the active StreamPrinter, if any
         self.test_generation_session_id = None
         self.test_reasoning_session_id = None
         self.input_parsing_session_id = None
@@ -127,8 +233,124 @@ class BIKprotect:
             f" - reasoning model: {reasoning_model_object.name}", style="bold green"
         )
         self.console.print(f" - use API: {useAPI}", style="bold green")
+        self.console.print(f" - stream responses: {stream}", style="bold green")
+        self.console.print(
+            f" - response cache: {self.response_cache is not None}", style="bold green"
+        )
+        self.console.print(f" - finding memory: {self.use_memory}", style="bold green")
         self.console.print(f" - log directory: {log_dir}", style="bold green")
 
+    def _size_parsing_to_models(self):
+        """
+        Derive the parsing thresholds from the capabilities of the models.
+        The reasoning model keeps half of its prompt budget for the parsed input, so an
+        input that fits is sent as is. The parsing model receives chunks of half of its
+        prompt budget, so that a small model never overflows.
+        """
+        reasoning_capabilities = self.reasoningAgent.capabilities
+        if reasoning_capabilities is not None:
+            self.parsing_char_window = int(
+                self.reasoningAgent.context_manager.budget
+                // 2
+                * reasoning_capabilities.chars_per_token
+            )
+            self.summarize_fitting_inputs = False
+        if self.parsingAgent.capabilities is not None:
+            self.parsing_chunk_tokens = min(
+                PARSING_CHUNK_MAX_TOKENS, self.parsingAgent.context_manager.budget // 2
+            )
+
+    def _enable_conversation_store(self, store_dir):
+        if self.conversation_store is not None:
+            if self.conversation_store.store_dir == store_dir:
+                return
+            self.conversation_store.close()
+        self.conversation_store = ConversationStore(store_dir)
+        for agent in (self.parsingAgent, self.generationAgent, self.reasoningAgent):
+            agent.enable_conversation_store(self.conversation_store)
+
+    def _enable_memory(self, vectordb_dir):
+        """
+        Open the finding memory of the test. It is named after the reasoning session, so
+        that a resumed session recalls the findings stored before it was saved.
+        """
+        self.memory = FindingMemory(
+            customVectorDB(
+                "memory_" + self.test_reasoning_session_id,
+                vectordb_dir,
+                backend="local",
+                embeddings=self.memory_embeddings,
+            ),
+            top_k=self.memory_top_k,
+            token_budget=self.memory_token_budget,
+            model=self.reasoningAgent.name,
+        )
+
+    def _resume_sessions(self, previous_session_ids) -> bool:
+        """
+        Resume the three sessions from the conversation store.
+
+        Returns:
+            bool: whether all the sessions are resumed.
+        """
+        if previous_session_ids.get("conversation_store"):
+            self._enable_conversation_store(previous_session_ids["conversation_store"])
+        return all(
+            session_id is not None and agent.load_conversation(session_id)
+            for agent, session_id in (
+                (self.generationAgent, self.test_generation_session_id),
+                (self.reasoningAgent, self.test_reasoning_session_id),
+                (self.parsingAgent, self.input_parsing_session_id),
+            )
+        )
+
+    def _set_rate_limit(self, requests_per_minute, tokens_per_minute):
+        """
+        Pace the requests of the models used by the agents. A limit that is not given is
+        the OpenAI tier 1 limit of the model.
+        """
+        scheduler = self.reasoningAgent.scheduler
+        default_limits = RequestScheduler(DEFAULT_RATE_LIMITS)
+        for model in {self.reasoningAgent.name, self.parsingAgent.name}:
+            default_limit = default_limits.limit_for(model) or RateLimit(
+                requests_per_minute=500, tokens_per_minute=30000
+            )
+            scheduler.set_limit(
+                model,
+                RateLimit(
+                    requests_per_minute=requests_per_minute
+                    or default_limit.requests_per_minute,
+                    tokens_per_minute=tokens_per_minute
+                    or default_limit.tokens_per_minute,
+                ),
+            )
+
+    @contextlib.contextmanager
+    def _status(self, message):
+        """
+        Show the status while waiting for the LLM. In stream mode, the streamed
+        reasoning and generation responses are rendered below the status.
+
+        Parameters:
+        ----------
+        message: str
+            the status message
+        """
+        if threading.current_thread() is not threading.main_thread():
+            # a background job prints its results when they are ready
+            yield None
+            return
+        if not self.stream:
+            with self.console.status(message) as status:
+                yield status
+            return
+        with StreamPrinter(self.console, message) as printer:
+            self.stream_printer = printer
+            try:
+                yield printer
+            finally:
+                self.stream_printer = None
+
     def log_conversation(self, source, text):
         """
         append the conversation into the history
@@ -175,30 +397,35 @@ class BIKprotect:
             self.log_conversation("BIKprotect", "Session refreshed.")
             return "Session refreshed."
 
-    def _feed_init_prompts(self):
+    def _feed_init_prompts(self, init_description=None):
         # 1. User firstly provide basic information of the task
-        init_description = prompt_ask(
-            "Please describe the penetration testing task in one line, including the target IP, task type, etc.\n> ",
-            multiline=False,
-        )
+        if init_description is None:
+            init_description = prompt_ask(
+                "Please describe the penetration testing task in one line, including the target IP, task type, etc.\n> ",
+                multiline=False,
+            )
         self.log_conversation("user", init_description)
         self.task_log["task description"] = init_description
         # 2. Provide the information to the reasoning session for the task initialization.
         # Note that this information is not parsed by the three-step process in reasoning.
         # It is directly used to initialize the task.
         prefixed_init_description = self.prompts.task_description + init_description
-        with self.console.status(
+        with self._status(
             "[bold green] Constructing Initial Penetration Testing Tree..."
         ) as status:
             _reasoning_response = self.reasoningAgent.send_message(
-                prefixed_init_description, self.test_reasoning_session_id
+                prefixed_init_description,
+                self.test_reasoning_session_id,
+                stream_handler=self.stream_printer,
             )
+        self._parse_ptt(_reasoning_response)
         # 3. Pass to generation session for more details.
         # Note that the generation session is not used for the task initialization.
-        with self.console.status("[bold green] Generating Initial Task") as status:
+        with self._status("[bold green] Generating Initial Task") as status:
             _generation_response = self.generationAgent.send_message(
                 self.prompts.todo_to_command + _reasoning_response,
                 self.test_generation_session_id,
+                stream_handler=self.stream_printer,
             )
 
         # Display the initial generation result
@@ -207,10 +434,33 @@ class BIKprotect:
         self.console.print(response)
         self.log_conversation("BIKprotect", "BIKprotect output:" + response)
 
-    def initialize(self, previous_session_ids=None):
+    async def _initialize_sessions(self):
+        """
+        Start the generation, reasoning and parsing sessions concurrently.
+
+        Returns:
+            list: the (response, conversation_id) of the three sessions, in order.
+        """
+        try:
+            return await asyncio.gather(
+                self.generationAgent.asend_new_message(
+                    self.prompts.generation_session_init
+                ),
+                self.reasoningAgent.asend_new_message(
+                    self.prompts.reasoning_session_init
+                ),
+                self.parsingAgent.asend_new_message(self.prompts.input_parsing_init),
+            )
+        finally:
+            # the loop of `asyncio.run` ends here; close its connections. The sync requests
+            # of the first turn open a new connection: one handshake, against the three
+            # sessions started at once.
+            await aclose_async_clients()
+
+    def initialize(self, previous_session_ids=None, init_description=None):
         # initialize the backbone sessions and test the connection to chatGPT
         # define three sessions: testGenerationSession, testReasoningSession, and InputParsingSession
-        if previous_session_ids is not None and self.useAPI is False:
+        if previous_session_ids is not None:
             self.test_generation_session_id = previous_session_ids.get(
                 "test_generation", None
             )
@@ -223,14 +473,17 @@ class BIKprotect:
             print(f"Input parsing session id: {str(self.input_parsing_session_id)}")
             print("-----------------")
             self.task_log = previous_session_ids.get("task_log", {})
+            if previous_session_ids.get("ptt"):
+                self.ptt = PTT.parse(previous_session_ids["ptt"])
             self.console.print(f"Task log: {str(self.task_log)}", style="bold green")
             print("You may use discussion function to remind yourself of the task.")
 
-            ## verify that all the sessions are not None
+            ## verify that all the sessions are not None, and load their history in API mode
             if (
                 self.test_generation_session_id is None
                 or self.test_reasoning_session_id is None
                 or self.input_parsing_session_id is None
+                or (self.useAPI and not self._resume_sessions(previous_session_ids))
             ):
                 self.console.print(
                     "[bold red] Error: the previous session ids are not valid. Loading new sessions"
@@ -238,32 +491,31 @@ class BIKprotect:
                 self.initialize()
 
         else:
-            with self.console.status(
-                "[bold green] Initialize ChatGPT Sessions..."
-            ) as status:
+            with self._status("[bold green] Initialize ChatGPT Sessions...") as status:
                 try:
+                    # the three sessions are independent, so they are started concurrently
                     (
-                        text_0,
-                        self.test_generation_session_id,
-                    ) = self.generationAgent.send_new_message(
-                        self.prompts.generation_session_init,
-                    )
-                    (
-                        text_1,
-                        self.test_reasoning_session_id,
-                    ) = self.reasoningAgent.send_new_message(
-                        self.prompts.reasoning_session_init
-                    )
-                    (
-                        text_2,
-                        self.input_parsing_session_id,
-                    ) = self.parsingAgent.send_new_message(
-                        self.prompts.input_parsing_init
-                    )
+                        (text_0, self.test_generation_session_id),
+                        (text_1, self.test_reasoning_session_id),
+                        (text_2, self.input_parsing_session_id),
+                    ) = asyncio.run(self._initialize_sessions())
                 except Exception as e:
                     logger.error(e)
             self.console.print("- ChatGPT Sessions Initialized.", style="bold green")
-            self._feed_init_prompts()
+            self._feed_init_prompts(init_description)
+        if self.prefetch and self.prefetcher is None:
+            budget = PrefetchBudget(self.prefetch_token_budget)
+            self.prefetcher = Prefetcher(
+                self.generationAgent, self.test_generation_session_id, budget=budget
+            )
+            self.reasoning_prefetcher = Prefetcher(
+                self.reasoningAgent, self.test_reasoning_session_id, budget=budget
+            )
+        if self.use_memory and self.memory is None:
+            self._enable_memory(
+                (previous_session_ids or {}).get("memory")
+                or os.path.join(os.path.abspath(self.log_dir), "vectordb")
+            )
 
     def reasoning_handler(self, text) -> str:
         # summarize the contents if necessary.
@@ -278,49 +530,262 @@ class BIKprotect:
         """
         # BIKprotect Reasoning Logic
         ## 1. Given the information, update the PTT
-        _updated_ptt_response = self.reasoningAgent.send_message(
-            self.prompts.process_results + text, self.test_reasoning_session_id
-        )
         ## 2. Validate if the PTT is correct
         # TODO
         ## 3. If the PTT is correct, select all the to-dos
-        _task_selection_response = self.reasoningAgent.send_message(
-            self.prompts.process_results_task_selection, self.test_reasoning_session_id
-        )
+        # In "single" mode, both are requested in one call. If the reply cannot be split,
+        # the task selection is requested separately, as in "two-call" mode.
+        _task_selection_response = None
+        if self.reasoning_mode == "single":
+            (
+                _updated_ptt_response,
+                _task_selection_response,
+            ) = self._update_ptt_and_select_task(text)
+        else:
+            _updated_ptt_response = self._update_ptt(text)
+        if not _task_selection_response:
+            _task_selection_response = self.reasoningAgent.send_message(
+                self.prompts.process_results_task_selection,
+                self.test_reasoning_session_id,
+                stream_handler=self.stream_printer,
+            )
+        if self.ptt:
+            recommended_task = self.ptt.find_task(_task_selection_response)
+            if recommended_task is not None:
+                self.recommended_task_id = recommended_task.node_id
         # get the complete output:
         response = _updated_ptt_response + _task_selection_response
 
         self.log_conversation("reasoning", response)
         return response
 
-    def input_parsing_handler(self, text, source=None) -> str:
+    def _with_earlier_findings(self, text, source) -> str:
+        """
+        Store the parsed input of `next` in the memory, and prepend the relevant earlier
+        findings. The findings are recalled first, so that the input itself is not recalled.
+        The input is stored with its tool, e.g. "nmap" or "web", and the PTT task it is
+        likely the result of.
+        """
+        findings = self.memory.recall(text)
+        metadata = {"tool": self.input_parser_name or source}
+        if self.recommended_task_id is not None:
+            metadata["ptt_node"] = self.recommended_task_id
+        self.memory.remember(text, metadata=metadata)
+        if not findings:
+            return text
+        logger.info(f"Recalled {len(findings)} earlier findings")
+        return (
+            self.prompts.memory_findings
+            + "\n\n".join(findings)
+            + "\n"
+            + self.prompts.memory_new_results
+            + text
+        )
+
+    def _parse_ptt(self, response):
+        """
+        Replace the local PTT if the response contains a complete PTT.
+        """
+        if contains_ptt(response):
+            ptt = PTT.parse(response)
+            if len(ptt):
+                self.ptt = ptt
+
+    def _ptt_update_prompt(self, text):
+        """
+        Build the request to revise the PTT with the test results.
+        In "diff" mode, the reasoning session is given the local PTT and only replies with
+        its edits. The questions of the tester (`todo` and `discuss`) ask for the whole
+        task tree, so they are always answered with a complete PTT.
+
+        Returns:
+            tuple: the instruction, the content, and whether the reply is a diff.
+        """
+        asks_for_full_ptt = text.startswith(
+            (self.prompts.ask_todo, self.prompts.discussion)
+        )
+        if self.ptt_mode == "diff" and self.ptt and not asks_for_full_ptt:
+            content = "PTT:\n" + self.ptt.render() + "\n\nTest results:\n" + text
+            return self.prompts.process_results_diff, content, True
+        return self.prompts.process_results, text, False
+
+    def _apply_ptt_update(self, response, is_diff) -> str:
+        """
+        Apply the PTT revision of the reasoning session. A diff without any edit is handled
+        as a complete PTT, as the model may re-emit the tree instead.
+
+        Returns:
+            str: the updated PTT.
+        """
+        if is_diff:
+            applied_edits = self.ptt.apply_edits(response)
+            if applied_edits or "NO CHANGE" in response.upper():
+                logger.info(f"PTT edits: {applied_edits}")
+                return self.ptt.render() + "\n"
+        self._parse_ptt(response)
+        return response
+
+    def _ptt_update_request(self, text):
+        """
+        Build the first reasoning request of a step, as sent in the reasoning mode.
+
+        Returns:
+            tuple: the request, and whether the reply is a diff.
+        """
+        instruction, content, is_diff = self._ptt_update_prompt(text)
+        if self.reasoning_mode == "single":
+            instruction += self.prompts.process_results_with_task_selection
+        return instruction + content, is_diff
+
+    def _send_ptt_update(self, request) -> str:
+        """
+        Send the request to the reasoning session, or use its prefetched response.
+        """
+        response = None
+        if self.reasoning_prefetcher is not None:
+            response = self.reasoning_prefetcher.take(request)
+        if response is None:
+            response = self.reasoningAgent.send_message(
+                request,
+                self.test_reasoning_session_id,
+                stream_handler=self.stream_printer,
+            )
+        return response
+
+    def _update_ptt(self, text) -> str:
+        """
+        Revise the PTT with the test results.
+
+        Returns:
+            str: the updated PTT.
+        """
+        request, is_diff = self._ptt_update_request(text)
+        _updated_ptt_response = self._send_ptt_update(request)
+        return self._apply_ptt_update(_updated_ptt_response, is_diff)
+
+    def _update_ptt_and_select_task(self, text):
+        """
+        Revise the PTT and select the next task in one call.
+
+        Returns:
+            tuple: the updated PTT, and the task selection. The task selection is None if
+            the reply does not follow the sectioned format.
+        """
+        request, is_diff = self._ptt_update_request(text)
+        response = self._send_ptt_update(request)
+        ptt_section, task_section = split_reasoning_response(response)
+        if ptt_section is None:
+            logger.warning(
+                "The reasoning reply is not sectioned; selecting the task separately"
+            )
+            return self._apply_ptt_update(response, is_diff), None
+        return self._apply_ptt_update(ptt_section, is_diff), task_section
+
+    def _input_needs_summary(self, text) -> bool:
+        """
+        Whether the input of `next` is summarized before it is sent to the reasoning session.
+        """
+        return self.summarize_fitting_inputs or len(text) > self.parsing_char_window
+
+    def input_parsing_handler(self, text, source=None, summarize=True) -> str:
+        self.input_parser_name = None
+        if source == "tool" and self.local_parsers:
+            parsed = parse_tool_output(text)
+            if parsed is not None:
+                parser_name, summarized_content = parsed
+                logger.info(
+                    f"The tool output is summarized by the {parser_name} parser"
+                )
+                self.input_parser_name = parser_name
+                self.log_conversation("input_parsing", summarized_content)
+                return summarized_content
+        if not summarize:
+            # the input fits the prompt budget of the reasoning model; it is sent as is
+            return text
         prefix = "Please summarize the following input. "
         # do some engineering trick here. Add postfix to the input to make it more understandable by LLMs.
         if source is not None and source in self.postfix_options.keys():
             prefix += self.postfix_options[source]
-        # The default token-size limit is 4096 (web UI even shorter). 1 token ~= 4 chars in English
-        # Use textwrap to split inputs. Limit to 2000 token (8000 chars) for each input
-        # (1) replace all the newlines with spaces
-        text = text.replace("\r", " ").replace("\n", " ")
-        # (2) wrap the text
-        wrapped_text = textwrap.fill(text, 8000)
-        wrapped_inputs = wrapped_text.split("\n")
-        # (3) send the inputs to chatGPT input_parsing_session and obtain the results
-        summarized_content = ""
-        for wrapped_input in wrapped_inputs:
-            word_limit = f"Please ensure that the input is less than {8000 / len(wrapped_inputs)} words.\n"
-            summarized_content += self.parsingAgent.send_message(
-                prefix + word_limit + wrapped_input, self.input_parsing_session_id
+        # The default token-size limit is 4096 (web UI even shorter).
+        # (1) split the input into chunks of `parsing_chunk_tokens` tokens, on line and record
+        # boundaries, so that a record (e.g. a host of a scan) is not cut in half
+        chunks = chunk_text(
+            text, self.parsing_chunk_tokens, model=self.parsingAgent.name
+        ) or [text]
+        # (2) send the chunks to the input_parsing_session and obtain the results
+        word_limit = (
+            f"Please ensure that the input is less than {8000 / len(chunks)} words.\n"
+        )
+        if (
+            self.parsing_mode == "map-reduce"
+            and self.parsing_workers > 1
+            and len(chunks) > 1
+        ):
+            summarized_content = self._map_reduce_summarize(
+                [prefix + word_limit + chunk for chunk in chunks]
             )
+        else:
+            summarized_content = ""
+            for chunk in chunks:
+                summarized_content += self.parsingAgent.send_message(
+                    prefix + word_limit + chunk, self.input_parsing_session_id
+                )
         # log the conversation
         self.log_conversation("input_parsing", summarized_content)
         return summarized_content
 
+    def _map_reduce_summarize(self, chunk_requests) -> str:
+        """
+        Summarize the chunks of a large input concurrently, and merge the results.
+
+        Map: each chunk is summarized in a stateless call, so that it does not carry the
+        parsing session history. At most `parsing_workers` calls are in flight.
+        Reduce: the summaries are merged in the parsing session in the original chunk order.
+
+        Parameters:
+        ----------
+        chunk_requests: list
+            the summarization requests of the chunks, in the original order
+
+        Returns:
+        -------
+        str: the merged summary
+        """
+        with ThreadPoolExecutor(
+            max_workers=min(self.parsing_workers, len(chunk_requests))
+        ) as executor:
+            # executor.map yields the results in the order of the inputs. The chunk
+            # requests are cancelled with the job that started them.
+            chunk_summaries = list(
+                executor.map(
+                    with_cancel_token(
+                        lambda request: self.parsingAgent.send_stateless_message(
+                            request, system_prompt=self.prompts.input_parsing_chunk
+                        )
+                    ),
+                    chunk_requests,
+                )
+            )
+        merge_request = self.prompts.input_parsing_merge + "\n\n".join(
+            f"Part {i + 1}/{len(chunk_summaries)}:\n{summary}"
+            for i, summary in enumerate(chunk_summaries)
+        )
+        return self.parsingAgent.send_message(
+            merge_request, self.input_parsing_session_id
+        )
+
     def test_generation_handler(self, text):
+        # use the prefetched response if the same request was prepared in the background
+        response = None
+        if self.prefetcher is not None:
+            response = self.prefetcher.take(text)
         # send the contents to chatGPT test_generation_session and obtain the results
-        response = self.generationAgent.send_message(
-            text, self.test_generation_session_id
-        )
+        if response is None:
+            response = self.generationAgent.send_message(
+                text,
+                self.test_generation_session_id,
+                stream_handler=self.stream_printer,
+            )
         # log the conversation
         self.log_conversation("generation", response)
         return response
@@ -349,7 +814,7 @@ class BIKprotect:
             user_input = prompt_ask("Your input: ", multiline=True)
             self.log_conversation("user", user_input)
             ## (2) pass the information to the reasoning session.
-            with self.console.status("[bold green] BIKprotect Thinking...") as status:
+            with self._status("[bold green] BIKprotect Thinking...") as status:
                 local_task_response = self.test_generation_handler(
                     self.prompts.local_task_prefix + user_input
                 )
@@ -370,7 +835,7 @@ class BIKprotect:
             user_input = prompt_ask("Your input: ", multiline=True)
             self.log_conversation("user", user_input)
             ## (2) pass the information to the reasoning session.
-            with self.console.status("[bold green] BIKprotect Thinking...") as status:
+            with self._status("[bold green] BIKprotect Thinking...") as status:
                 local_task_response = self.test_generation_handler(
                     self.prompts.local_task_brainstorm + user_input
                 )
@@ -391,7 +856,7 @@ class BIKprotect:
             )
             user_input = prompt_ask("Your input: ", multiline=False)
             self.log_conversation("user", user_input)
-            with self.console.status("[bold green] BIKprotect Thinking...") as status:
+            with self._status("[bold green] BIKprotect Thinking...") as status:
                 # query the question
                 result: dict = google_search(user_input, 5)  # 5 results by default
                 # summarize the results
@@ -412,6 +877,94 @@ class BIKprotect:
 
         return local_task_response
 
+    def _next_step(self, user_input, source) -> str:
+        """
+        Parse the test results, update the PTT, and print the recommended tasks.
+        """
+        with self._status("[bold green] BIKprotect Thinking...") as status:
+            parsed_input = self.input_parsing_handler(
+                user_input,
+                source=source,
+                summarize=self._input_needs_summary(user_input),
+            )
+            if self.memory is not None:
+                parsed_input = self._with_earlier_findings(parsed_input, source)
+            ## (2) pass the summarized information to the reasoning session.
+            reasoning_response = self.reasoning_handler(parsed_input)
+            self.step_reasoning_response = reasoning_response
+
+        ## (3) print the results
+        self.console.print(
+            "Based on the analysis, the following tasks are recommended:",
+            style="bold green",
+        )
+        self.console.print(reasoning_response + "\n")
+        self.log_conversation(
+            "BIKprotect",
+            "Based on the analysis, the following tasks are recommended:"
+            + reasoning_response,
+        )
+        ## (4) prepare `more` and `todo` while the tester reads the tasks
+        if self.prefetcher is not None:
+            self.prefetcher.start(self.step_reasoning_response)
+            self.reasoning_prefetcher.start(
+                self._ptt_update_request(self.prompts.ask_todo)[0]
+            )
+        return reasoning_response
+
+    def _next_step_job(self, user_input, source):
+        """
+        Run `_next_step` on the background worker, and report its failure on the console.
+        """
+        try:
+            return self._next_step(user_input, source)
+        except RequestCancelled:
+            self.console.print("The queued step is cancelled.", style="bold red")
+            self.log_conversation("BIKprotect", "The queued step is cancelled.")
+        except Exception as e:
+            self.log_conversation("exception", str(e))
+            self.console.print(f"Exception: {str(e)}", style="bold red")
+            print(traceback.format_exc())
+
+    def _parse_input_file(self, request_args):
+        """
+        Parse the arguments of `next`.
+
+        Returns:
+            str: the path of the input file, None to paste the input, or False if the
+            arguments are invalid.
+        """
+        try:
+            args = shlex.split(request_args)
+        except ValueError:
+            # e.g. an unbalanced quote
+            args = None
+        if args == []:
+            return None
+        if args and len(args) == 2 and args[0] in ("--file", "-f"):
+            return os.path.expanduser(args[1])
+        self.console.print(
+            "Usage: next [--file <path>]. The path can be a file or a named pipe.",
+            style="bold red",
+        )
+        return False
+
+    def _wait_for_background_jobs(self):
+        """
+        Wait for the queued `next` steps, as the following requests depend on their
+        results. Ctrl-C cancels them.
+        """
+        if self.worker is None or not self.worker.pending_jobs:
+            return
+        self.console.print(
+            "Waiting for the queued steps... (Ctrl-C to cancel them)",
+            style="bold green",
+        )
+        try:
+            self.worker.wait()
+        except KeyboardInterrupt:
+            self.worker.cancel_all()
+
     def input_handler(self) -> str:
         """
         Request for user's input to:
@@ -429,8 +982,10 @@ class BIKprotect:
         """
         self.chat_count += 1
 
-        request_option = main_task_entry()
-        self.log_conversation("user", request_option)
+        request = main_task_entry()
+        self.log_conversation("user", request)
+        # the options may take arguments, e.g. `next --file nmap.txt`
+        request_option, _, request_args = request.partition(" ")
         # always check if the session expires.
         # check if session expires
         if not self.useAPI:
@@ -443,6 +998,9 @@ class BIKprotect:
             print(mainTaskCompleter().task_details)
 
         if request_option == "next":
+            input_file = self._parse_input_file(request_args)
+            if input_file is False:
+                return "Invalid arguments."
             ## (1) pass the information to input_parsing session.
             ## Give an option list for user to choose from
             options = list(self.postfix_options.keys())
@@ -460,35 +1018,49 @@ class BIKprotect:
             source = prompt_select(
                 title="Please choose the source of the information.", values=value_list
             )
-            self.console.print(
-                "Your input: (End with <shift + right-arrow>)", style="bold green"
-            )
-            user_input = prompt_ask("> ", multiline=True)
-            self.log_conversation(
-                "user", f"Source: {options[int(source)]}" + "\n" + user_input
-            )
-            with self.console.status("[bold green] BIKprotect Thinking...") as status:
-                parsed_input = self.input_parsing_handler(
-                    user_input, source=options[int(source)]
+            if input_file is not None:
+                # stream the file instead of pasting it; the noise of a tool output is
+                # dropped on the way
+                try:
+                    user_input = read_tool_output(
+                        input_file, filter_noise=options[int(source)] == "tool"
+                    )
+                except OSError as e:
+                    self.console.print(
+                        f"Cannot read {input_file}: {e}", style="bold red"
+                    )
+                    return "Invalid input file."
+                self.log_conversation(
+                    "user", f"Source: {options[int(source)]}\nFile: {input_file}"
                 )
-                ## (2) pass the summarized information to the reasoning session.
-                reasoning_response = self.reasoning_handler(parsed_input)
-                self.step_reasoning_response = reasoning_response
-
-            ## (3) print the results
-            self.console.print(
-                "Based on the analysis, the following tasks are recommended:",
-                style="bold green",
-            )
-            self.console.print(reasoning_response + "\n")
-            self.log_conversation(
-                "BIKprotect",
-                "Based on the analysis, the following tasks are recommended:"
-                + reasoning_response,
-            )
-            response = reasoning_response
+            else:
+                self.console.print(
+                    "Your input: (End with <shift + right-arrow>)", style="bold green"
+                )
+                user_input = prompt_ask("> ", multiline=True)
+                self.log_conversation(
+                    "user", f"Source: {options[int(source)]}" + "\n" + user_input
+                )
+                if options[int(source)] == "tool":
+                    user_input = ToolOutputFilter().filter_text(user_input)
+            if self.worker is not None:
+                self.worker.submit(
+                    self._next_step_job,
+                    user_input,
+                    options[int(source)],
+                    description="next",
+                )
+                self.console.print(
+                    "The input is queued. The analysis is printed when it is ready; use `cancel` to abort it.",
+                    style="bold green",
+                )
+                response = "queued"
+            else:
+                response = self._next_step(user_input, options[int(source)])
 
         elif request_option == "more":
+            # the request depends on the results of the queued steps
+            self._wait_for_background_jobs()
             self.log_conversation("user", "more")
             ## (1) check if reasoning session is initialized
             if not hasattr(self, "step_reasoning_response"):
@@ -512,7 +1084,7 @@ class BIKprotect:
             input()
 
             ### (2.2) pass the sub-tasks to the test generation session
-            with self.console.status("[bold green] BIKprotect Thinking...") as status:
+            with self._status("[bold green] BIKprotect Thinking...") as status:
                 generation_response = self.test_generation_handler(
                     self.step_reasoning_response
                 )
@@ -536,10 +1108,12 @@ class BIKprotect:
                     break
 
         elif request_option == "todo":
+            # the request depends on the results of the queued steps
+            self._wait_for_background_jobs()
             ## log that user is asking for todo list
             self.log_conversation("user", "todo")
             ## (1) ask the reasoning session to analyze the current situation, and list the top sub-tasks
-            with self.console.status("[bold green] BIKprotect Thinking...") as status:
+            with self._status("[bold green] BIKprotect Thinking...") as status:
                 reasoning_response = self.reasoning_handler(self.prompts.ask_todo)
                 ## (2) pass the sub-tasks to the test_generation session.
                 message = self.prompts.todo_to_command + "\n" + reasoning_response
@@ -573,6 +1147,8 @@ class BIKprotect:
                 ),
             )
         elif request_option == "discuss":
+            # the request depends on the results of the queued steps
+            self._wait_for_background_jobs()
             ## (1) Request for user multi-line input
             self.console.print(
                 "Please share your thoughts/questions with BIKprotect. (End with <shift + right-arrow>) "
@@ -583,7 +1159,7 @@ class BIKprotect:
             user_input = prompt_ask("Your input: ", multiline=True)
             self.log_conversation("user", user_input)
             ## (2) pass the information to the reasoning session.
-            with self.console.status("[bold green] BIKprotect Thinking...") as status:
+            with self._status("[bold green] BIKprotect Thinking...") as status:
                 response = self.reasoning_handler(self.prompts.discussion + user_input)
             ## (3) print the results
             self.console.print("BIKprotect:\n", style="bold green")
@@ -602,7 +1178,7 @@ class BIKprotect:
             )
             user_input = prompt_ask("Your input: ", multiline=False)
             self.log_conversation("user", user_input)
-            with self.console.status("[bold green] BIKprotect Thinking...") as status:
+            with self._status("[bold green] BIKprotect Thinking...") as status:
                 # query the question
                 result: dict = google_search(user_input, 5)  # 5 results by default
                 # summarize the results
@@ -612,7 +1188,14 @@ class BIKprotect:
             self.log_conversation("BIKprotect", response)
             return response
 
+        elif request_option == "cancel":
+            cancelled = self.worker.cancel_all() if self.worker is not None else 0
+            response = f"{cancelled} queued step(s) cancelled."
+            self.console.print(response, style="bold green")
+            self.log_conversation("BIKprotect", response)
+
         elif request_option == "quit":
+            self._wait_for_background_jobs()
             response = False
             self.console.print("Thank you for using BIKprotect!", style="bold green")
             self.log_conversation("BIKprotect", "Thank you for using BIKprotect!")
@@ -656,6 +1239,17 @@ class BIKprotect:
                 "test_generation": self.test_generation_session_id,
                 "parsing": self.input_parsing_session_id,
                 "task_log": self.task_log,
+                "ptt": self.ptt.render() if self.ptt else None,
+                "conversation_store": (
+                    os.path.abspath(self.conversation_store.store_dir)
+                    if self.conversation_store is not None
+                    else None
+                ),
+                "memory": (
+                    self.memory.vector_db.vectordb_directory
+                    if self.memory is not None
+                    else None
+                ),
             }
             json.dump(session_ids, f)
         self.console.print(
@@ -728,15 +1322,10 @@ class BIKprotect:
                 previous_testing_name = None
                 return None
 
-    def main(self):
+    def _main_loop(self):
         """
-        The main function of BIKprotect. The design is based on BIKprotect_design.md
+        Handle the user requests until the session ends.
         """
-        # 0. initialize the backbone sessions and test the connection to chatGPT
-        loaded_ids = self._preload_session()
-        self.initialize(previous_session_ids=loaded_ids)
-
-        # enter the main loop.
         while True:
             try:
                 result = self.input_handler()
@@ -745,6 +1334,10 @@ class BIKprotect:
                 )
                 if not result:  # end the session
                     break
+            except KeyboardInterrupt:
+                # Ctrl-C aborts the request in progress, but not the session
+                self.console.print("The request is cancelled.", style="bold red")
+                self.log_conversation("BIKprotect", "The request is cancelled.")
             except Exception as e:  # catch all general exception.
                 # log the exception
                 self.log_conversation("exception", str(e))
@@ -761,6 +1354,19 @@ class BIKprotect:
                 print(traceback.format_exc())
                 # safely quit the session
                 break
+
+    def main(self):
+        """
+        The main function of BIKprotect. The design is based on BIKprotect_design.md
+        """
+        # 0. initialize the backbone sessions and test the connection to chatGPT
+        loaded_ids = self._preload_session()
+        self.initialize(previous_session_ids=loaded_ids)
+
+        # enter the main loop.
+        # With the background worker, its output is printed above the prompt.
+        with patch_stdout(raw=True) if self.worker else contextlib.nullcontext():
+            self._main_loop()
         # log the session. Save self.history into a txt file based on timestamp
         timestamp = time.time()
         log_name = f"BIKprotect_log_{str(timestamp)}.txt"
@@ -768,6 +1374,19 @@ class BIKprotect:
         log_path = os.path.join(self.log_dir, log_name)
         with open(log_path, "w") as f:
             json.dump(self.history, f)
+        if self.prefetcher is not None:
+            logger.info(
+                f"Prefetch: {self.prefetcher.hits + self.reasoning_prefetcher.hits} hits, "
+                f"{self.prefetcher.wasted_tokens} tokens wasted"
+            )
+            self.prefetcher.close()
+            self.reasoning_prefetcher.close()
+        if self.response_cache is not None:
+            logger.info(f"Response cache statistics: {self.response_cache.stats}")
+            self.console.print(
+                f"Response cache: {self.response_cache.hits} hits, {self.response_cache.misses} misses",
+                style="bold green",
+            )
 
         # save the sessions; continue from previous testing
         self.save_session()
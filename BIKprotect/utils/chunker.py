@@ -0,0 +1,87 @@
+"""
+Split a large input into chunks of a token budget, for the parsing session.
+
+The chunks are cut on record boundaries (the blocks of lines separated by blank lines, e.g.
+the hosts of an nmap scan), so that a record is summarized as a whole. A record larger
+than the budget is cut on line boundaries, and a line larger than the budget is cut on
+token boundaries. Each line is counted once with the cached encoder, so the chunking is
+linear in the size of the input.
+"""
+
+from typing import Iterable, Iterator, List
+
+from BIKprotect.utils.llm_api import CHARS_PER_TOKEN, count_text_tokens, get_encoder
+
+
+def _records(lines: Iterable[str]) -> Iterator[List[str]]:
+    record = []
+    for line in lines:
+        if line.strip():
+            record.append(line.rstrip())
+        elif record:
+            yield record
+            record = []
+    if record:
+        yield record
+
+
+def _split_line(line: str, max_tokens: int, model: str = None) -> List[str]:
+    encoder = get_encoder(model)
+    if encoder is None:
+        size = max_tokens * CHARS_PER_TOKEN
+        return [line[i : i + size] for i in range(0, len(line), size)]
+    tokens = encoder.encode(line, disallowed_special=())
+    return [
+        encoder.decode(tokens[i : i + max_tokens])
+        for i in range(0, len(tokens), max_tokens)
+    ]
+
+
+class _ChunkBuilder:
+    def __init__(self, max_tokens: int):
+        self.max_tokens = max_tokens
+        self.chunks: List[str] = []
+        self._parts: List[str] = []
+        self._tokens = 0
+
+    def add(self, text: str, tokens: int, separator: str):
+        if self._parts and self._tokens + tokens > self.max_tokens:
+            self.flush()
+        if self._parts:
+            self._parts.append(separator)
+        self._parts.append(text)
+        self._tokens += tokens
+
+    def flush(self):
+        if self._parts:
+            self.chunks.append("".join(self._parts))
+        self._parts = []
+        self._tokens = 0
+
+
+def chunk_text(text: str, max_tokens: int, model: str = None) -> List[str]:
+    """
+    Split the text into chunks of at most `max_tokens` tokens, on record and line boundaries.
+    :param text: the input to split.
+    :param max_tokens: the token budget of a chunk.
+    :param model: the model whose encoder counts the tokens.
+    :return: the chunks, in order. The runs of blank lines are collapsed.
+    """
+    builder = _ChunkBuilder(max_tokens)
+    for record in _records(text.splitlines()):
+        # +1 token for the newline that joins the line to the previous one
+        line_tokens = [count_text_tokens(line, model) + 1 for line in record]
+        if sum(line_tokens) <= max_tokens:
+            builder.add("\n".join(record), sum(line_tokens), "\n\n")
+            continue
+        # the record does not fit in a chunk; it is spread over the next chunks
+        separator = "\n\n"
+        for line, tokens in zip(record, line_tokens):
+            if tokens <= max_tokens:
+                builder.add(line, tokens, separator)
+            else:
+                for piece in _split_line(line, max_tokens - 1, model):
+                    builder.add(piece, max_tokens, separator)
+            separator = "\n"
+    builder.flush()
+    return builder.chunks
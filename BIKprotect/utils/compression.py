@@ -0,0 +1,144 @@
+"""
+Local extractive compression of the messages that do not fit in the prompt budget.
+
+The tool outputs and logs pasted into the sessions are repetitive, so most of their tokens
+can be dropped without losing information, and without an LLM call:
+- consecutive repeats of a line, and runs of blank lines. A line repeated elsewhere is
+  kept, e.g. the same open port in the scans of two hosts;
+- runs of spaces, e.g. the alignment of the columns of a table;
+- the middle frames of long stack traces;
+- the middle lines of hex dumps, and long hex or base64 blobs.
+An LLM summary is only needed if the result still does not fit. See
+`LLMAPI._token_compression`.
+"""
+
+import re
+from typing import Callable, List
+
+# a frame of a Python, Java, .NET, or Go stack trace
+_STACK_FRAME = re.compile(
+    r'^\s*(File ".*", line \d+|at [\w$.<>]+\(.*\)|at [\w.<>`]+\.[\w<>`]+\(|\S+\.go:\d+)'
+)
+# a line of `xxd` or `hexdump -C`
+_HEX_DUMP = re.compile(r"^\s*(0x)?[0-9a-fA-F]{4,16}:?\s+([0-9a-fA-F]{2,4}\s){6,}")
+_HEX_OR_BASE64_BLOB = re.compile(r"[0-9a-fA-F]{200,}|[A-Za-z0-9+/]{200,}={0,2}")
+_SPACES = re.compile(r"[ \t]{2,}")
+
+# the number of frames and lines kept at each end of a stack trace or hex dump
+KEEP_FRAMES = 2
+KEEP_HEX_LINES = 2
+
+
+def _is_stack_line(line: str, previous: str) -> bool:
+    # a Python frame is followed by its source line
+    return bool(_STACK_FRAME.match(line)) or previous.lstrip().startswith("File ")
+
+
+def _is_hex_line(line: str, previous: str) -> bool:
+    return bool(_HEX_DUMP.match(line))
+
+
+def _trim_runs(
+    lines: List[str], in_run: Callable[[str, str], bool], keep: int, description: str
+) -> List[str]:
+    """
+    Replace the middle of the runs of lines that satisfy `in_run(line, previous_line)`
+    with a note, keeping `keep` lines at each end.
+    """
+    result = []
+    run = []
+
+    def flush():
+        if len(run) > 2 * keep + 1:
+            result.extend(run[:keep])
+            result.append(f"[... {len(run) - 2 * keep} {description} omitted ...]")
+            result.extend(run[-keep:])
+        else:
+            result.extend(run)
+        run.clear()
+
+    previous = ""
+    for line in lines:
+        if in_run(line, previous if run else ""):
+            run.append(line)
+        else:
+            flush()
+            result.append(line)
+        previous = line
+    flush()
+    return result
+
+
+def compress_text(text: str) -> str:
+    """
+    Reduce the tokens of a text without changing its information, as far as possible.
+    :param text: the text to compress.
+    :return: the compressed text.
+    """
+    lines = []
+    blank = False
+    for line in text.splitlines():
+        line = _SPACES.sub(" ", line.rstrip())
+        if not line.strip():
+            # collapse the runs of blank lines
+            if not blank and lines:
+                lines.append("")
+            blank = True
+            continue
+        blank = False
+        lines.append(line)
+    # the stack traces and hex dumps are trimmed before the runs of repeated lines are
+    # collapsed, which would break their runs
+    lines = _trim_runs(lines, _is_stack_line, 2 * KEEP_FRAMES, "stack trace lines")
+    lines = _trim_runs(lines, _is_hex_line, KEEP_HEX_LINES, "hex dump lines")
+    result = []
+    previous = None
+    for line in lines:
+        key = line.strip()
+        if key and key == previous:
+            continue
+        previous = key
+        result.append(
+            _HEX_OR_BASE64_BLOB.sub(
+                lambda match: f"{match.group()[:32]}...[{len(match.group())} chars]",
+                line,
+            )
+        )
+    return "\n".join(result).strip()
+
+
+def truncate_middle(text: str, max_tokens: int, count_tokens: Callable[[str], int]):
+    """
+    Keep the first and last lines of the text that fit in `max_tokens` tokens.
+    :param text: the text to truncate.
+    :param max_tokens: the token budget.
+    :param count_tokens: counts the tokens of a string.
+    :return: the text, with the omitted lines replaced with a note.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    lines = text.splitlines()
+    head, tail = [], []
+    used = 20  # the note of the omitted lines
+    start, end = 0, len(lines) - 1
+    while start <= end:
+        # take the lines from both ends in turn, so that the beginning and the end are kept
+        take_head = len(head) <= len(tail)
+        line = lines[start] if take_head else lines[end]
+        tokens = count_tokens(line) + 1
+        if used + tokens > max_tokens:
+            break
+        used += tokens
+        if take_head:
+            head.append(line)
+            start += 1
+        else:
+            tail.append(line)
+            end -= 1
+    omitted = end - start + 1
+    if not head:
+        # a single line is over the budget; keep its beginning, ~2 chars per token
+        head = [lines[0][: max_tokens * 2]]
+    return "\n".join(
+        head + [f"[... {omitted} lines omitted ...]"] + list(reversed(tail))
+    )
@@ -0,0 +1,133 @@
+"""
+Pack the conversation history into the context window of the model.
+
+Instead of resending a fixed number of messages and shrinking them after the API rejected
+the request, the history is selected by token budget before it is sent:
+- the session-init message (the instructions of the session) is always kept;
+- the latest message that carries the Penetration Testing Tree (PTT) is always kept;
+- the other turns are kept from the most recent one, until the budget is used. The dropped
+  middle turns are replaced with a short note, so that the model knows they existed.
+"""
+
+from typing import Callable, List, Tuple
+
+from BIKprotect.utils.ptt import contains_ptt
+
+# the context window of a model without known capabilities; see `ModelCapabilities`
+DEFAULT_CONTEXT_WINDOW = 8192
+
+
+def message_contains_ptt(message) -> bool:
+    """
+    Whether the Message carries a PTT. It is checked once, when the message is recorded;
+    see `Conversation.ptt_index`.
+    """
+    return any(
+        contains_ptt(item.get("content")) for item in message.ask + message.answer
+    )
+
+
+class ContextManager:
+    """
+    Select the history of a request by the token budget of the model.
+
+    Usage:
+        manager = ContextManager(capabilities.context_window, capabilities.max_output)
+        chat_message, num_tokens = manager.pack(system, conversation.message_list, data, count)
+    """
+
+    def __init__(self, context_window: int, max_output_tokens: int = 2048):
+        """
+        :param context_window: the context window of the model, in tokens.
+        :param max_output_tokens: the tokens reserved for the response.
+        """
+        self.context_window = context_window
+        # a small context window cannot reserve the full output budget
+        self.max_output_tokens = min(max_output_tokens, context_window // 4)
+
+    @property
+    def budget(self) -> int:
+        """
+        The tokens available for the prompt.
+        """
+        return self.context_window - self.max_output_tokens
+
+    def select(
+        self,
+        message_list: List,
+        budget: int,
+        max_turns: int = None,
+        ptt_index: int = None,
+    ) -> Tuple[List[int], int]:
+        """
+        Select the turns of the history to send.
+        :param message_list: the Message objects of the conversation, whose tokens are in the ledger.
+        :param budget: the tokens available for the history.
+        :param max_turns: the maximum number of recent turns to keep, besides the pinned ones.
+        :param ptt_index: the index of the latest message that carries the PTT, if any.
+        :return: the indices of the selected turns in order, and their token count.
+        """
+        if not message_list:
+            return [], 0
+        pinned = [0]
+        if ptt_index:
+            pinned.append(ptt_index)
+        selected = set(pinned)
+        used = sum(message_list[index].token_count for index in pinned)
+        turns = 0
+        for index in range(len(message_list) - 1, 0, -1):
+            if max_turns is not None and turns >= max_turns:
+                break
+            turns += 1
+            if index in selected:
+                continue
+            tokens = message_list[index].token_count
+            if used + tokens > budget:
+                # the older turns are dropped, to keep the history contiguous
+                break
+            selected.add(index)
+            used += tokens
+        return sorted(selected), used
+
+    def pack(
+        self,
+        system_message: List,
+        message_list: List,
+        data: List,
+        count_tokens: Callable[[List], int],
+        max_turns: int = None,
+        ptt_index: int = None,
+    ) -> Tuple[List, int]:
+        """
+        Build the messages of the request.
+        :param system_message: the system prompt, sent first.
+        :param message_list: the Message objects of the conversation.
+        :param data: the new user message.
+        :param count_tokens: counts the tokens of a list of messages.
+        :param max_turns: the maximum number of recent turns to keep, besides the pinned ones.
+        :param ptt_index: the index of the latest message that carries the PTT, if any.
+        :return: the messages, and their token count.
+        """
+        # every reply is primed with <|start|>assistant<|message|>
+        fixed_tokens = count_tokens(system_message) + count_tokens(data) + 3
+        # leave room for the note about the omitted messages
+        selected, history_tokens = self.select(
+            message_list, self.budget - fixed_tokens - 20, max_turns, ptt_index
+        )
+        chat_message = list(system_message)
+        previous = -1
+        for index in selected:
+            if index - previous > 1:
+                note = [
+                    {
+                        "role": "system",
+                        "content": f"({index - previous - 1} earlier messages are omitted.)",
+                    }
+                ]
+                chat_message.extend(note)
+                history_tokens += count_tokens(note)
+            chat_message.extend(message_list[index].ask)
+            chat_message.extend(message_list[index].answer)
+            previous = index
+        chat_message.extend(data)
+        return chat_message, fixed_tokens + history_tokens
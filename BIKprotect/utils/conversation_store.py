@@ -0,0 +1,210 @@
+import dataclasses
+import json
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+from typing import Dict, List, Tuple
+
+import loguru
+
+from BIKprotect.utils.context_manager import message_contains_ptt
+from BIKprotect.utils.llm_api import Conversation, Message
+
+logger = loguru.logger
+
+_MESSAGE_FIELDS = {field.name for field in dataclasses.fields(Message)}
+
+
+class ConversationStore:
+    """
+    An append-only store of the conversations of the LLM agents, so that a saved session
+    can be resumed with its history.
+
+    The messages are appended to `messages.jsonl`, and `messages.idx` records the offset,
+    length, token count and whether it carries the PTT of each message by conversation. Opening the store only reads
+    the index; a message is read from disk when the conversation accesses it.
+    """
+
+    data_file = "messages.jsonl"
+    index_file = "messages.idx"
+
+    def __init__(self, store_dir: str):
+        """
+        :param store_dir: the directory of the store. It is created if it does not exist.
+        """
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        self.store_dir = store_dir
+        self.data_path = os.path.join(store_dir, self.data_file)
+        self.index_path = os.path.join(store_dir, self.index_file)
+        self._lock = threading.Lock()
+        # conversation_id -> [(offset, length, tokens, carries the PTT)]
+        self._index: Dict[str, List[Tuple[int, int, int, bool]]] = {}
+        self._load_index()
+        self._data = open(self.data_path, "ab+")
+        self._index_writer = open(self.index_path, "a")
+
+    def _load_index(self):
+        data_size = (
+            os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        )
+        if not os.path.exists(self.index_path):
+            if data_size:
+                self._rebuild_index()
+            return
+        indexed_size = 0
+        with open(self.index_path, "r") as f:
+            for line in f:
+                fields = line.split()
+                # the PTT flag is missing from the indexes of older versions
+                if len(fields) == 4:
+                    fields.append("0")
+                try:
+                    conversation_id, offset, length, tokens, ptt = fields
+                    offset, length, tokens = int(offset), int(length), int(tokens)
+                except ValueError:
+                    continue  # a line truncated by a crash
+                if offset + length > data_size:
+                    continue  # the message itself was not written
+                self._index.setdefault(conversation_id, []).append(
+                    (offset, length, tokens, ptt == "1")
+                )
+                indexed_size = max(indexed_size, offset + length)
+        if indexed_size < data_size:
+            # the index is behind the data, e.g. it was deleted or the process crashed
+            self._rebuild_index()
+
+    def _rebuild_index(self):
+        logger.warning(f"Rebuilding the conversation index of {self.store_dir}")
+        self._index = {}
+        lines = []
+        with open(self.data_path, "rb") as f:
+            offset = 0
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    message = self._to_message(record["message"])
+                    entry = (
+                        offset,
+                        len(line),
+                        message.token_count,
+                        message_contains_ptt(message),
+                    )
+                    self._index.setdefault(record["conversation_id"], []).append(entry)
+                    lines.append(self._index_line(record["conversation_id"], entry))
+                except (ValueError, KeyError):
+                    pass
+                offset += len(line)
+        with open(self.index_path, "w") as f:
+            f.writelines(lines)
+
+    @staticmethod
+    def _to_message(record: dict) -> Message:
+        return Message(**{k: v for k, v in record.items() if k in _MESSAGE_FIELDS})
+
+    @staticmethod
+    def _index_line(conversation_id: str, entry: Tuple[int, int, int, bool]) -> str:
+        offset, length, tokens, ptt = entry
+        return f"{conversation_id} {offset} {length} {tokens} {int(ptt)}\n"
+
+    def __contains__(self, conversation_id: str) -> bool:
+        return conversation_id in self._index
+
+    def append(self, conversation_id: str, message: Message):
+        """
+        Append a message of the conversation to the store.
+        """
+        record = {
+            "conversation_id": conversation_id,
+            "message": dataclasses.asdict(message),
+        }
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            self._data.seek(0, os.SEEK_END)
+            offset = self._data.tell()
+            self._data.write(line)
+            self._data.flush()
+            entry = (
+                offset,
+                len(line),
+                message.token_count,
+                message_contains_ptt(message),
+            )
+            # the index is written after the data, so it never points to a partial message
+            self._index_writer.write(self._index_line(conversation_id, entry))
+            self._index_writer.flush()
+            self._index.setdefault(conversation_id, []).append(entry)
+
+    def read_message(self, offset: int, length: int) -> Message:
+        with self._lock:
+            self._data.seek(offset)
+            line = self._data.read(length)
+        return self._to_message(json.loads(line)["message"])
+
+    def load(self, conversation_id: str) -> Conversation:
+        """
+        Load the conversation lazily: the messages are read when they are accessed.
+        :return: the conversation, or None if it is not in the store.
+        """
+        entries = self._index.get(conversation_id)
+        if entries is None:
+            return None
+        conversation = Conversation()
+        conversation.conversation_id = conversation_id
+        conversation.message_list = LazyMessageList(self, list(entries))
+        conversation.token_count = sum(entry[2] for entry in entries)
+        ptt_indices = [index for index, entry in enumerate(entries) if entry[3]]
+        if ptt_indices:
+            conversation.ptt_index = ptt_indices[-1]
+        return conversation
+
+    def close(self):
+        with self._lock:
+            self._data.close()
+            self._index_writer.close()
+
+
+class LazyMessageList(Sequence):
+    """
+    The message list of a resumed conversation. The stored messages are read from the
+    store on access and kept in a small LRU cache; the new messages are kept in memory.
+    """
+
+    def __init__(self, store: ConversationStore, entries: List, cache_size: int = 64):
+        self._store = store
+        self._entries = entries
+        self._new_messages: List[Message] = []
+        self._cache: "OrderedDict[int, Message]" = OrderedDict()
+        self._cache_size = cache_size
+
+    def __len__(self):
+        return len(self._entries) + len(self._new_messages)
+
+    def _get(self, index: int) -> Message:
+        if index >= len(self._entries):
+            return self._new_messages[index - len(self._entries)]
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index]
+        offset, length = self._entries[index][:2]
+        message = self._store.read_message(offset, length)
+        self._cache[index] = message
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return message
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._get(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("message index out of range")
+        return self._get(index)
+
+    def append(self, message: Message):
+        self._new_messages.append(message)
+
+    def __repr__(self):
+        return f"LazyMessageList({len(self)} messages)"
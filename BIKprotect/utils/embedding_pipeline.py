@@ -0,0 +1,142 @@
+"""
+Batched and deduplicated embedding of text chunks.
+
+The same tool outputs are stored again and again during a test, so the chunks are hashed
+and the embedding of a chunk that was already embedded is taken from a cache. The other
+chunks are embedded in batches of the provider's maximum batch size, with a bounded number
+of concurrent requests.
+"""
+
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import loguru
+
+logger = loguru.logger
+
+# the number of texts per embedding request, if the embeddings do not specify it.
+# OpenAI accepts up to 2048 inputs per request.
+DEFAULT_BATCH_SIZE = 1000
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    A thread-safe LRU cache of the embeddings, keyed by the content hash of the text.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        """
+        :param max_entries: the number of embeddings kept; an ada-002 embedding is 6KB.
+        """
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+            return vector
+
+    def put(self, key: str, vector: List[float]):
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class EmbeddingPipeline:
+    """
+    Usage:
+        pipeline = EmbeddingPipeline(OpenAIEmbeddings())
+        vectors = pipeline.embed_documents(chunks)
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        batch_size: int = None,
+        max_concurrency: int = 4,
+        cache: EmbeddingCache = None,
+    ):
+        """
+        :param embeddings: the LangChain Embeddings to use.
+        :param batch_size: the number of texts per request. Defaults to the `chunk_size` of
+            the embeddings, i.e. the maximum batch size of the provider.
+        :param max_concurrency: the maximum number of requests in flight.
+        :param cache: the cache of the embeddings. A new cache is created by default.
+        """
+        self.embeddings = embeddings
+        self.batch_size = (
+            batch_size or getattr(embeddings, "chunk_size", None) or DEFAULT_BATCH_SIZE
+        )
+        self.max_concurrency = max_concurrency
+        self.cache = cache if cache is not None else EmbeddingCache()
+        self.embedded = 0  # the number of texts sent to the embedding provider
+        self.cache_hits = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed the texts, in order.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.aembed_documents(texts))
+        # called from a running event loop; run the pipeline in its own loop
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, self.aembed_documents(texts)).result()
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed the texts, in order. Only the texts that are not in the cache are sent, once.
+        """
+        keys = [content_hash(text) for text in texts]
+        vectors: Dict[str, List[float]] = {}
+        missing: Dict[str, str] = {}  # the texts to embed, by key
+        for key, text in zip(keys, texts):
+            if key in vectors or key in missing:
+                continue
+            vector = self.cache.get(key)
+            if vector is None:
+                missing[key] = text
+            else:
+                vectors[key] = vector
+        self.cache_hits += len(texts) - len(missing)
+        missing_keys = list(missing)
+        batches = [
+            missing_keys[i : i + self.batch_size]
+            for i in range(0, len(missing_keys), self.batch_size)
+        ]
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def embed_batch(batch_keys):
+            async with semaphore:
+                batch_vectors = await self.embeddings.aembed_documents(
+                    [missing[key] for key in batch_keys]
+                )
+            for key, vector in zip(batch_keys, batch_vectors):
+                vectors[key] = vector
+                self.cache.put(key, vector)
+
+        await asyncio.gather(*(embed_batch(batch) for batch in batches))
+        self.embedded += len(missing_keys)
+        if missing_keys:
+            logger.info(
+                f"Embedded {len(missing_keys)} chunks in {len(batches)} requests; "
+                f"{len(texts) - len(missing_keys)} taken from the cache"
+            )
+        return [vectors[key] for key in keys]
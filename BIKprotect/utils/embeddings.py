@@ -0,0 +1,127 @@
+"""
+The embedding models of `customVectorDB`.
+
+`OpenAIEmbeddings` (text-embedding-ada-002, 1536 dimensions) makes every store and every
+retrieval a paid remote call. `LocalEmbeddings` runs a sentence-transformers model on the
+local CPU instead, so the throughput is bounded by the local cores, not by the API.
+The caching and the deduplication of the texts are left to `EmbeddingPipeline`.
+It requires the optional `sentence-transformers` package:
+    pip install sentence-transformers
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Union
+
+import loguru
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+logger = loguru.logger
+
+DEFAULT_LOCAL_MODEL = "all-MiniLM-L6-v2"
+OPENAI_EMBEDDING_DIMENSION = 1536
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    Usage:
+        embeddings = LocalEmbeddings("all-MiniLM-L6-v2")
+        vectors = embeddings.embed_documents(chunks)
+        embeddings.dimension  # 384
+    """
+
+    def __init__(
+        self,
+        model: Union[str, object] = DEFAULT_LOCAL_MODEL,
+        device: str = "cpu",
+        batch_size: int = 64,
+        max_workers: int = None,
+        **model_kwargs,
+    ):
+        """
+        :param model: the name or path of a sentence-transformers model, or a loaded model.
+        :param device: the device the model runs on.
+        :param batch_size: the number of texts encoded at once by a worker.
+        :param max_workers: the number of threads encoding in parallel. Defaults to the
+            ThreadPoolExecutor default, which depends on the number of cores.
+        :param model_kwargs: passed to `SentenceTransformer`, e.g. `backend="onnx"` with
+            sentence-transformers 3.2 or later.
+        """
+        if isinstance(model, str):
+            try:
+                from sentence_transformers import SentenceTransformer
+            except ImportError as e:
+                raise ImportError(
+                    "Local embeddings require the sentence-transformers package. "
+                    "Install it with `pip install sentence-transformers`."
+                ) from e
+            logger.info(f"Loading the local embedding model {model} on {device}")
+            model = SentenceTransformer(model, device=device, **model_kwargs)
+        self.model = model
+        self.dimension = model.get_sentence_embedding_dimension()
+        # read by EmbeddingPipeline as the batch size of a request
+        self.chunk_size = batch_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="embedding"
+        )
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.model.encode(
+            texts,
+            batch_size=self.chunk_size,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        )
+        return np.asarray(vectors, dtype=np.float32).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        batches = [
+            texts[i : i + self.chunk_size]
+            for i in range(0, len(texts), self.chunk_size)
+        ]
+        # the encoding releases the GIL, so the batches are encoded on parallel threads
+        return [
+            vector
+            for batch_vectors in self._executor.map(self._encode, batches)
+            for vector in batch_vectors
+        ]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        # the batches of EmbeddingPipeline are encoded on the threads, off the event loop
+        return await asyncio.wrap_future(self._executor.submit(self._encode, texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def get_embeddings(name: str = "openai", **kwargs) -> Embeddings:
+    """
+    Create the embedding model of a name.
+    :param name: "openai", "local" for the default local model, or "local:<model>" for a
+        sentence-transformers model name or path.
+    :param kwargs: passed to the embedding class.
+    """
+    if name == "openai":
+        from langchain.embeddings.openai import OpenAIEmbeddings
+
+        return OpenAIEmbeddings(**kwargs)
+    if name == "local" or name.startswith("local:"):
+        model = name.partition(":")[2] or DEFAULT_LOCAL_MODEL
+        return LocalEmbeddings(model, **kwargs)
+    raise ValueError(f"Unknown embedding model: {name}")
+
+
+def embedding_dimension(embeddings) -> int:
+    """
+    The dimension of the vectors of an embedding model.
+    """
+    dimension = getattr(embeddings, "dimension", None)
+    if dimension is None:
+        # the models without a dimension attribute are probed once
+        if type(embeddings).__name__ == "OpenAIEmbeddings" and getattr(
+            embeddings, "model", ""
+        ).endswith("ada-002"):
+            return OPENAI_EMBEDDING_DIMENSION
+        dimension = len(embeddings.embed_query("dimension"))
+    return dimension
@@ -1,22 +1,84 @@
+import asyncio
 import dataclasses
 import inspect
 import os
 import re
 import time
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Tuple
 from uuid import uuid1
 
 import loguru
 import openai
 import tiktoken
-from tenacity import *
 
 from BIKprotect.config.chat_config import ChatGPTConfig
+from BIKprotect.utils.APIs.client_pool import get_openai_client
+from BIKprotect.utils.compression import compress_text, truncate_middle
+from BIKprotect.utils.context_manager import (
+    DEFAULT_CONTEXT_WINDOW,
+    ContextManager,
+    message_contains_ptt,
+)
+from BIKprotect.utils.llm_worker import (
+    RequestCancelled,
+    check_cancelled,
+    current_cancel_token,
+)
+from BIKprotect.utils.rate_limiter import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_INTERACTIVE,
+    RequestScheduler,
+)
+from BIKprotect.utils.retry_engine import RetryEngine
 
 logger = loguru.logger
 logger.remove()
 # logger.add(level="WARNING", sink="logs/chatgpt.log")
 
+# the tokenizer used when the model is unknown to tiktoken (gpt-3.5/gpt-4 family)
+DEFAULT_ENCODING = "cl100k_base"
+# rough estimation of English text when no tokenizer can be loaded (e.g., offline)
+CHARS_PER_TOKEN = 4
+
+# loaded encoders, keyed by model name. Loading an encoder is expensive.
+_encoder_cache: Dict[str, Any] = {}
+
+
+def get_encoder(model: str = None):
+    """
+    Get the tiktoken encoder of the given model. The encoder is loaded only once per model.
+    Parameters
+    ----------
+        model: str
+            The model name. Unknown models fall back to the default encoding.
+    Returns
+    -------
+        encoder: tiktoken.Encoding, or None if no encoding can be loaded.
+    """
+    if model in _encoder_cache:
+        return _encoder_cache[model]
+    try:
+        try:
+            encoder = tiktoken.encoding_for_model(model)
+        except (KeyError, AttributeError):  # unknown model, or no model given
+            encoder = tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as e:  # the BPE ranks cannot be downloaded
+        logger.warning("Failed to load the tokenizer. Token counts are estimated.")
+        logger.error(f"Tokenizer Error: {e}")
+        encoder = None
+    _encoder_cache[model] = encoder
+    return encoder
+
+
+def count_text_tokens(text: str, model: str = None) -> int:
+    """
+    Count the number of tokens in a piece of text with the cached encoder.
+    """
+    encoder = get_encoder(model)
+    if encoder is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoder.encode(text, disallowed_special=()))
+
 
 @dataclasses.dataclass
 class Message:
@@ -27,12 +89,40 @@ class Message:
     request_start_timestamp: float = None
     request_end_timestamp: float = None
     time_escaped: float = None
+    # token counts of `ask` and `answer`; counted once when the message is created
+    ask_tokens: int = 0
+    answer_tokens: int = 0
+
+    @property
+    def token_count(self) -> int:
+        return self.ask_tokens + self.answer_tokens
 
 
 @dataclasses.dataclass
 class Conversation:
     conversation_id: str = None
     message_list: List[Message] = dataclasses.field(default_factory=list)
+    # running token ledger of all the messages in the conversation
+    token_count: int = 0
+    # the index of the latest message that carries the PTT, pinned in the history
+    ptt_index: int = None
+
+    def append_message(self, message: Message):
+        """
+        Append a message and update the token ledger and the PTT index.
+        """
+        self.message_list.append(message)
+        self.token_count += message.token_count
+        if message_contains_ptt(message):
+            self.ptt_index = len(self.message_list) - 1
+
+    def window_token_count(self, history_length: int) -> int:
+        """
+        The number of tokens of the latest `history_length` messages, read from the ledger.
+        """
+        return sum(
+            _message.token_count for _message in self.message_list[-history_length:]
+        )
 
     def __hash__(self):
         return hash(self.conversation_id)
@@ -44,21 +134,38 @@ class Conversation:
 
 
 class LLMAPI:
+    # the retry engine of the API calls, shared by the backends
+    retry_engine = RetryEngine()
+    # optional LLMResponseCache, shared by the agents. See `enable_response_cache`.
+    response_cache = None
+    # optional ConversationStore, shared by the agents. See `enable_conversation_store`.
+    conversation_store = None
+    # paces the requests of the agents that share a model and API key
+    scheduler = RequestScheduler()
+    # the scheduling priority of the conversation messages of this agent
+    priority = PRIORITY_INTERACTIVE
+    # the ModelCapabilities of the model, set by `dynamic_import`. If it is not set, the
+    # context window is looked up by the model name.
+    capabilities = None
+
     def __init__(self, config: ChatGPTConfig):
         self.name = "LLMAPI_base_class"
         self.config = config
         openai.api_key = config.openai_key
         openai.proxy = config.proxies
         openai.api_base = config.api_base
+        self.client = get_openai_client(
+            config.api_base, config.openai_key, config.proxies
+        )
         self.log_dir = config.log_dir
         self.history_length = 5  # maintain 5 messages in the history. (5 chat memory)
         self.conversation_dict: Dict[str, Conversation] = {}
 
         logger.add(sink=os.path.join(self.log_dir, "chatgpt.log"), level="WARNING")
 
-    def _count_token(self, messages) -> int:
+    def _count_message_tokens(self, messages) -> int:
         """
-        Count the number of tokens in the messages
+        Count the number of tokens in the messages, without the reply priming.
         Parameters
         ----------
             messages: a list of messages
@@ -66,61 +173,195 @@ class LLMAPI:
         -------
             num_tokens: int
         """
-        # count the token. Use model gpt-3.5-turbo-0301, which is slightly different from gpt-4
+        # count the token. The encoder is cached per model, see `get_encoder`.
         # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-        model = "gpt-3.5-turbo-0301"
+        # the same model as the compression budget, see `_token_compression`
+        model = self.name
         tokens_per_message = (
             4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
         )
         tokens_per_name = -1  # if there's a name, the role is omitted
-        encoding = tiktoken.encoding_for_model(model)
         num_tokens = 0
         for message in messages:
             try:
                 num_tokens += tokens_per_message
                 for key, value in message.items():
-                    num_tokens += len(encoding.encode(value))
+                    if isinstance(value, list):  # multi-modal content
+                        value = " ".join(
+                            part.get("text", "")
+                            for part in value
+                            if isinstance(part, dict)
+                        )
+                    num_tokens += count_text_tokens(value, model)
                     if key == "name":
                         num_tokens += tokens_per_name
             except Exception as e:  # TODO: handle other formats
                 pass
+        return num_tokens
+
+    def _count_token(self, messages) -> int:
+        """
+        Count the number of tokens in the messages
+        Parameters
+        ----------
+            messages: a list of messages
+        Returns
+        -------
+            num_tokens: int
+        """
+        num_tokens = self._count_message_tokens(messages)
         num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
         return num_tokens
 
-    def _token_compression(self, complete_messages) -> str:
+    def _token_compression(
+        self, complete_messages, num_tokens: int = None, force: bool = False
+    ) -> str:
         """
-        Compress the message if it is beyond the token limit.
-        For GPT-4, limit is 8k. Others are set to 16k.
+        Compress the last message if the messages are beyond the prompt budget of the model,
+        i.e. its context window minus the tokens reserved for the response.
+        The message is first reduced locally, see `compress_text`. It is summarized by the
+        LLM only if it still does not fit.
 
         Parameters
         ----------
             complete_messages: dict
+            num_tokens: int
+                The token count of `complete_messages` from the conversation ledger.
+                The messages are only re-counted if it is not provided.
+            force: bool
+                Compress the message even if it is within the budget, e.g. after the API
+                rejected it.
         Returns
         -------
             compressed_message: str
         """
-        if self.model == "gpt-4":
-            token_limit = 8000
-        else:
-            token_limit = 14000  # leave some budget
-        if self._count_token(complete_messages) > token_limit:
-            # send a separate API request to compress the message
-            chat_message = [
-                {
-                    "role": "system",
-                    "content": "You are a helpful assistant.",
-                },
-                {
-                    "role": "user",
-                    "content": "Please reduce the word count of the given message to save tokens. Keep its original meaning so that it can be understood by a large language model.",
-                },
-            ]
-            compressed_message = self._chat_completion(chat_message)
+        raw_message = complete_messages[-1]["content"]
+        token_limit = self.context_manager.budget
+        if num_tokens is None:
+            num_tokens = self._count_token(complete_messages)
+        if not isinstance(raw_message, str) or (
+            num_tokens <= token_limit and not force
+        ):
+            # the messages with images are not compressed
+            return raw_message
+        # the tokens left for the last message, after the rest of the history
+        message_budget = max(
+            token_limit - num_tokens + count_text_tokens(raw_message, self.name),
+            token_limit // 4,
+        )
+        # 1. local extractive compression
+        compressed_message = compress_text(raw_message)
+        if count_text_tokens(compressed_message, self.name) <= message_budget:
             return compressed_message
 
-        # if not compressed, return the last message
-        raw_message = complete_messages[-1]["content"]
-        return raw_message
+        # 2. summarize the message with a separate API request, as a last resort.
+        # The message must fit in the request itself.
+        def count_tokens(text):
+            return count_text_tokens(text, self.name)
+
+        source_message = truncate_middle(
+            compressed_message, token_limit - 200, count_tokens
+        )
+        word_limit = int(
+            min(message_budget, self.context_manager.max_output_tokens) * 0.75
+        )
+        chat_message = [
+            {
+                "role": "system",
+                "content": "You are a helpful assistant.",
+            },
+            {
+                "role": "user",
+                "content": "Please reduce the word count of the given message to save tokens. "
+                "Keep its original meaning so that it can be understood by a large language model. "
+                f"Use less than {word_limit} words. The message is:\n\n"
+                + source_message,
+            },
+        ]
+        compressed_message = self._complete(chat_message)
+        return truncate_middle(compressed_message, message_budget, count_tokens)
+
+    def _fit_to_budget(self, history: List, num_tokens: int) -> Tuple[List, int]:
+        """
+        Compress the last message of the request before it is sent, if the request is beyond
+        the prompt budget, so that it is not rejected by the API.
+        The conversation keeps the original message.
+        Returns
+        -------
+            history: list
+            num_tokens: int
+        """
+        if num_tokens <= self.context_manager.budget:
+            return history, num_tokens
+        compressed_message = dict(history[-1])
+        compressed_message["content"] = self._token_compression(history, num_tokens)
+        history = history[:-1] + [compressed_message]
+        compressed_tokens = self._count_token(history)
+        logger.info(
+            f"The request is compressed from {num_tokens} to {compressed_tokens} tokens"
+        )
+        return history, compressed_tokens
+
+    @staticmethod
+    def _is_context_length_error(exception: BaseException) -> bool:
+        return isinstance(exception, openai.BadRequestError) and (
+            getattr(exception, "code", None) == "context_length_exceeded"
+            or "maximum context length" in str(exception)
+        )
+
+    def _shrink_history(self, history: List) -> List:
+        """
+        Shrink the history after the API rejected it for the token limit.
+        """
+        logger.warning("Token size limit reached. The recent message is compressed")
+        # compress the message in two ways.
+        ## 1. compress the last message. The recorded message is not modified.
+        compressed_message = dict(history[-1])
+        compressed_message["content"] = self._token_compression(history, force=True)
+        ## 2. reduce the number of messages in the history. Minimum is 2
+        if self.history_length > 2:
+            self.history_length -= 1
+        ## update the history, keeping the system prompt
+        history = history[:1] + history[1:-1][-(self.history_length - 1) :]
+        return history + [compressed_message]
+
+    def _create_completion(self, create: Callable, history: List, **kwargs):
+        """
+        Call the completion API `create(messages=history, **kwargs)` through the retry engine.
+        If the request exceeds the token limit, it is retried once with a shrunk history.
+        Parameters
+        ----------
+            create: callable
+                The completion API of the client, e.g., `client.chat.completions.create`
+            history: list
+                A list of messages
+            **kwargs: dict
+                Additional arguments to be passed to the API
+        Returns
+        -------
+            response: the response object of the API
+        """
+        try:
+            return self.retry_engine.call(create, messages=history, **kwargs)
+        except openai.BadRequestError as e:
+            if not self._is_context_length_error(e):
+                raise
+            logger.error(f"Token size error; will retry with compressed message: {e}")
+            history = self._shrink_history(history)
+            return self.retry_engine.call(create, messages=history, **kwargs)
+
+    async def _acreate_completion(self, create: Callable, history: List, **kwargs):
+        """
+        The asyncio variant of `_create_completion`.
+        """
+        try:
+            return await self.retry_engine.acall(create, messages=history, **kwargs)
+        except openai.BadRequestError as e:
+            if not self._is_context_length_error(e):
+                raise
+            logger.error(f"Token size error; will retry with compressed message: {e}")
+            history = await asyncio.to_thread(self._shrink_history, history)
+            return await self.retry_engine.acall(create, messages=history, **kwargs)
 
     def _chat_completion_fallback(self) -> str:
         """
@@ -146,79 +387,221 @@ class LLMAPI:
         """
         model = "gpt-4"
         temperature = 0.5
+        response = self._create_completion(
+            self.client.chat.completions.create,
+            history,
+            model=model,
+            temperature=temperature,
+        )
+        return response.choices[0].message.content
+
+    def _chat_completion_stream(self, history: List, **kwargs) -> Iterator[str]:
+        """
+        Send a chat completion request to the API, and yield the response as it arrives.
+        This method should be overwritten by the child class to use a streaming API.
+        By default, the complete response of `_chat_completion` is yielded at once.
+        Parameters
+        ----------
+            history: list
+                A list of messages
+            **kwargs: dict
+                Additional arguments to be passed to the API
+        Returns
+        -------
+            response: iterator of str
+        """
+        yield self._chat_completion(history, **kwargs)
+
+    def _stream_completion(
+        self, history: List, stream_handler: Callable[[str], None], **kwargs
+    ) -> str:
+        """
+        Stream the response to `stream_handler` chunk by chunk, and return the complete response.
+        """
+        chunks = []
         try:
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=history,
-                temperature=temperature,
-            )
-        except openai.error.APIConnectionError as e:  # give one more try
-            logger.warning(
-                "API Connection Error. Waiting for {} seconds".format(
-                    self.config.error_wait_time
-                )
-            )
-            logger.log("Connection Error: ", e)
-            time.sleep(self.config.error_wait_time)
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=history,
-                temperature=temperature,
-            )
-        except openai.error.RateLimitError as e:  # give one more try
-            logger.warning(
-                "Rate limit reached. Waiting for {} seconds".format(
-                    self.config.error_wait_time
-                )
-            )
-            logger.error("Rate Limit Error: ", e)
-            time.sleep(self.config.error_wait_time)
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=history,
-                temperature=temperature,
-            )
-        except openai.error.InvalidRequestError as e:  # token limit reached
-            logger.warning("Token size limit reached. The recent message is compressed")
-            logger.error("Token size error; will retry with compressed message ", e)
-            # compress the message in two ways.
-            ## 1. compress the last message
-            history[-1]["content"] = self.token_compression(history)
-            ## 2. reduce the number of messages in the history. Minimum is 2
-            if self.history_length > 2:
-                self.history_length -= 1
-            ## update the history
-            history = history[-self.history_length :]
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=history,
-                temperature=temperature,
+            for chunk in self._chat_completion_stream(history, **kwargs):
+                # closing the stream generator aborts the request of a cancelled job
+                check_cancelled()
+                chunks.append(chunk)
+                stream_handler(chunk)
+        except RequestCancelled:
+            raise
+        except Exception:
+            # the response is aborted when its job is cancelled; the read then fails
+            check_cancelled()
+            raise
+        return "".join(chunks)
+
+    def enable_response_cache(self, cache):
+        """
+        Answer identical requests from the cache instead of the API.
+        Parameters
+        ----------
+            cache: LLMResponseCache
+        """
+        self.response_cache = cache
+
+    def enable_conversation_store(self, store):
+        """
+        Persist the messages of the conversations, so that they can be resumed later.
+        Parameters
+        ----------
+            store: ConversationStore
+        """
+        self.conversation_store = store
+
+    def load_conversation(self, conversation_id: str) -> bool:
+        """
+        Resume a stored conversation. Its messages are read from the store on access,
+        so no tokens are spent to restore the context.
+        Returns
+        -------
+            loaded: bool
+                False if the conversation is not in the store.
+        """
+        if self.conversation_store is None:
+            return False
+        conversation = self.conversation_store.load(conversation_id)
+        if conversation is None:
+            return False
+        self.conversation_dict[conversation_id] = conversation
+        return True
+
+    def _record_message(self, conversation: Conversation, message: Message):
+        """
+        Append the completed message to the conversation, and to the store if any.
+        """
+        conversation.append_message(message)
+        self.conversation_dict[conversation.conversation_id] = conversation
+        if self.conversation_store is not None:
+            self.conversation_store.append(conversation.conversation_id, message)
+
+    def _cache_key(self, history: List, **kwargs) -> str:
+        return self.response_cache.make_key(
+            self.name, kwargs.get("temperature", 0.5), history
+        )
+
+    def _rate_limit_key(self) -> Tuple:
+        return self.name, getattr(self, "api_key", None)
+
+    def _complete(
+        self,
+        history: List,
+        stream_handler: Callable[[str], None] = None,
+        priority: int = None,
+        num_tokens: int = None,
+        **kwargs,
+    ) -> str:
+        """
+        Get the response of the chat completion request, from the response cache if possible.
+        Parameters
+        ----------
+            history: list
+                A list of messages
+            stream_handler: callable
+                If provided, the response is streamed to the handler. A cached response
+                is passed to the handler at once.
+            priority: int
+                The scheduling priority of the request. Defaults to the agent priority.
+            num_tokens: int
+                The token count of the history, if it is already known.
+            **kwargs: dict
+                Additional arguments to be passed to the API
+        Returns
+        -------
+            response: str
+        """
+        if self.response_cache is not None:
+            key = self._cache_key(history, **kwargs)
+            response = self.response_cache.get(key)
+            if response is not None:
+                if stream_handler is not None:
+                    stream_handler(response)
+                return response
+        if num_tokens is None:
+            num_tokens = self._count_token(history)
+        history, num_tokens = self._fit_to_budget(history, num_tokens)
+        check_cancelled()
+        self.scheduler.acquire(
+            self._rate_limit_key(),
+            num_tokens,
+            self.priority if priority is None else priority,
+        )
+        check_cancelled()
+        if stream_handler is None and current_cancel_token() is not None:
+            # in a background job, the response is streamed anyway, so that `cancel`
+            # can abort it instead of waiting for the whole response
+            stream_handler = lambda chunk: None
+        if stream_handler is None:
+            response = self._chat_completion(history, **kwargs)
+        else:
+            response = self._stream_completion(history, stream_handler, **kwargs)
+        # the response of a job cancelled during the request is discarded
+        check_cancelled()
+        self.scheduler.record_usage(
+            self._rate_limit_key(), count_text_tokens(response, self.name)
+        )
+        if self.response_cache is not None:
+            self.response_cache.put(key, response, model=self.name)
+        return response
+
+    async def _acomplete(
+        self, history: List, priority: int = None, num_tokens: int = None, **kwargs
+    ) -> str:
+        """
+        The asyncio variant of `_complete`.
+        """
+        if self.response_cache is not None:
+            key = self._cache_key(history, **kwargs)
+            response = self.response_cache.get(key)
+            if response is not None:
+                return response
+        if num_tokens is None:
+            num_tokens = self._count_token(history)
+        if num_tokens > self.context_manager.budget:
+            history, num_tokens = await asyncio.to_thread(
+                self._fit_to_budget, history, num_tokens
             )
+        check_cancelled()
+        # the scheduler blocks, so the event loop waits in a worker thread
+        await asyncio.to_thread(
+            self.scheduler.acquire,
+            self._rate_limit_key(),
+            num_tokens,
+            self.priority if priority is None else priority,
+        )
+        check_cancelled()
+        response = await self._achat_completion(history, **kwargs)
+        check_cancelled()
+        self.scheduler.record_usage(
+            self._rate_limit_key(), count_text_tokens(response, self.name)
+        )
+        if self.response_cache is not None:
+            self.response_cache.put(key, response, model=self.name)
+        return response
 
-        # if the response is a tuple, it means that the response is not valid.
-        if isinstance(response, tuple):
-            logger.warning("Response is not valid. Waiting for 5 seconds")
-            try:
-                time.sleep(5)
-                response = openai.ChatCompletion.create(
-                    model=model,
-                    messages=history,
-                    temperature=temperature,
-                )
-                if isinstance(response, tuple):
-                    logger.error("Response is not valid. ")
-                    raise Exception("Response is not valid. ")
-            except Exception as e:
-                logger.error("Response is not valid. ", e)
-                raise Exception(
-                    "Response is not valid. The most likely reason is the connection to OpenAI is not stable. "
-                    "Please doublecheck with `BIKprotect-connection`"
-                )
-        return response["choices"][0]["message"]["content"]
+    async def _achat_completion(self, history: List, **kwargs) -> str:
+        """
+        Send a chat completion request to the API without blocking the event loop.
+        This method should be overwritten by the child class to use a native async client.
+        By default, the blocking `_chat_completion` is run in a worker thread.
+        Parameters
+        ----------
+            history: list
+                A list of messages
+            **kwargs: dict
+                Additional arguments to be passed to the API
+        Returns
+        -------
+            response: str
+        """
+        return await asyncio.to_thread(self._chat_completion, history, **kwargs)
 
-    def send_new_message(self, message: str, image_url: str = None):
-        # create a message
-        start_time = time.time()
+    def _format_user_message(self, message: str, image_url: str = None) -> List:
+        """
+        Form the user message, with the image url if it is provided.
+        """
         if image_url is not None and type(image_url) is str:
             data = [
                 {
@@ -231,84 +614,236 @@ class LLMAPI:
             ]
         else:
             data = [{"role": "user", "content": message}]
-        history = data
+        return data
+
+    def _create_message(self, data: List) -> Message:
+        """
+        Create the message object for the user message, and count its tokens once.
+        """
         message: Message = Message()
         message.ask_id = str(uuid1())
         message.ask = data
-        message.request_start_timestamp = start_time
-        response = self._chat_completion(history)
+        message.ask_tokens = self._count_message_tokens(data)
+        message.request_start_timestamp = time.time()
+        return message
+
+    def _complete_message(self, message: Message, response: str):
+        """
+        Fill in the response of the message object.
+        """
         message.answer = [{"role": "system", "content": response}]
+        message.answer_tokens = self._count_message_tokens(message.answer)
         message.request_end_timestamp = time.time()
         message.time_escaped = (
             message.request_end_timestamp - message.request_start_timestamp
         )
 
-        # create a new conversation with a new uuid
+    def _create_conversation(self, message: Message) -> str:
+        """
+        Create a new conversation with a new uuid, starting with the given message.
+        """
         conversation_id = str(uuid1())
         conversation: Conversation = Conversation()
         conversation.conversation_id = conversation_id
-        conversation.message_list.append(message)
-
-        self.conversation_dict[conversation_id] = conversation
+        self._record_message(conversation, message)
         print("New conversation." + conversation_id + " is created." + "\n")
-        return response, conversation_id
+        return conversation_id
 
-    # add retry handler to retry 1 more time if the API connection fails
-    @retry(stop=stop_after_attempt(2))
-    def send_message(
-        self, message, conversation_id, image_url: str = None, debug_mode=False
-    ):
-        # create message history based on the conversation id
-        chat_message = [
+    @property
+    def context_manager(self) -> ContextManager:
+        # created on first use, as the child classes do not call `LLMAPI.__init__`
+        if "_context_manager" not in self.__dict__:
+            # imported here, as the module checks the API keys of all models on import
+            from BIKprotect.utils.APIs.module_import import capabilities_for
+
+            capabilities = self.capabilities or capabilities_for(self.name)
+            if capabilities is not None:
+                self._context_manager = ContextManager(
+                    capabilities.context_window, capabilities.max_output
+                )
+            else:
+                self._context_manager = ContextManager(DEFAULT_CONTEXT_WINDOW)
+        return self._context_manager
+
+    def _build_chat_message(
+        self, conversation: Conversation, data: List
+    ) -> Tuple[List, int]:
+        """
+        Create the message history based on the conversation, and append the new message.
+        The history is packed into the context window of the model: the session-init
+        message and the latest PTT are kept, and the recent turns fill the rest of the
+        budget, up to `history_length` turns.
+        Returns
+        -------
+            chat_message: list
+            num_tokens: int
+                The token cost of the request. Only the new message is tokenized;
+                the history is read from the ledger.
+        """
+        system_message = [
             {
                 "role": "system",
                 "content": "You are a helpful assistant",
             },
         ]
-        conversation = self.conversation_dict[conversation_id]
+        return self.context_manager.pack(
+            system_message,
+            conversation.message_list,
+            data,
+            self._count_message_tokens,
+            max_turns=self.history_length,
+            ptt_index=conversation.ptt_index,
+        )
+
+    def _debug_print(self, caller, message, response, num_tokens, conversation):
+        print("Caller: ", caller, "\n")
+        print("Message:", message, "\n")
+        print("Response:", response, "\n")
+        print("Token cost of the request: ", num_tokens, "\n")
+        print("Token cost of the conversation: ", conversation.token_count, "\n")
 
-        for _message in conversation.message_list[-self.history_length :]:
-            chat_message.extend(_message.ask)
-            chat_message.extend(_message.answer)
-        # append the new message to the history
+    def send_new_message(self, message: str, image_url: str = None):
+        # create a message
+        data = self._format_user_message(message, image_url)
+        message: Message = self._create_message(data)
+        response = self._complete(data)
+        self._complete_message(message, response)
+        conversation_id = self._create_conversation(message)
+        return response, conversation_id
+
+    async def asend_new_message(self, message: str, image_url: str = None):
+        """
+        The asyncio variant of `send_new_message`.
+        """
+        data = self._format_user_message(message, image_url)
+        message: Message = self._create_message(data)
+        response = await self._acomplete(data)
+        self._complete_message(message, response)
+        conversation_id = self._create_conversation(message)
+        return response, conversation_id
+
+    def send_stateless_message(self, message: str, system_prompt: str = None) -> str:
+        """
+        Send a one-off message that is not recorded in any conversation.
+        It is safe to call concurrently, as no conversation is shared.
+        Parameters
+        ----------
+            message: str
+                The user message.
+            system_prompt: str
+                The system prompt. Defaults to the generic assistant prompt.
+        Returns
+        -------
+            response: str
+        """
+        if system_prompt is None:
+            system_prompt = "You are a helpful assistant"
+        chat_message = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": message},
+        ]
+        # the one-off messages are background work, e.g. the summaries of tool outputs
+        return self._complete(chat_message, priority=PRIORITY_BACKGROUND)
+
+    # the transient API errors are retried by `retry_engine`
+    def send_message(
+        self,
+        message,
+        conversation_id,
+        image_url: str = None,
+        debug_mode=False,
+        stream_handler: Callable[[str], None] = None,
+    ):
+        """
+        Send a message in the conversation, and return the response.
+        Parameters
+        ----------
+            message: str
+            conversation_id: str
+            image_url: str
+            debug_mode: bool
+            stream_handler: callable
+                If provided, the response is streamed and each chunk is passed to the handler
+                as it arrives. The conversation is only updated after the stream completes.
+        Returns
+        -------
+            response: str
+        """
+        # create message history based on the conversation id
+        conversation = self.conversation_dict[conversation_id]
         # form the data that contains url
-        if image_url is not None and type(image_url) is str:
-            data = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": message},
-                        {"type": "image_url", "image_url": {"url": image_url}},
-                    ],
-                }
-            ]
-        else:
-            data = [{"role": "user", "content": message}]
-        chat_message.extend(data)
+        data = self._format_user_message(message, image_url)
+        chat_message, num_tokens = self._build_chat_message(conversation, data)
         # create the message object
-        message: Message = Message()
-        message.ask_id = str(uuid1())
-        message.ask = data
-        message.request_start_timestamp = time.time()
-        # count the token cost
-        num_tokens = self._count_token(chat_message)
+        message: Message = self._create_message(data)
         # Get response. If the response is None, retry.
-        response = self._chat_completion(chat_message)
+        response = self._complete(
+            chat_message, stream_handler=stream_handler, num_tokens=num_tokens
+        )
 
         # update the conversation
-        message.answer = [{"role": "system", "content": response}]
-        message.request_end_timestamp = time.time()
-        message.time_escaped = (
-            message.request_end_timestamp - message.request_start_timestamp
-        )
-        conversation.message_list.append(message)
-        self.conversation_dict[conversation_id] = conversation
+        self._complete_message(message, response)
+        self._record_message(conversation, message)
         # in debug mode, print the conversation and the caller class.
         if debug_mode:
-            print("Caller: ", inspect.stack()[1][3], "\n")
-            print("Message:", message, "\n")
-            print("Response:", response, "\n")
-            print("Token cost of the conversation: ", num_tokens, "\n")
+            self._debug_print(
+                inspect.stack()[1][3], message, response, num_tokens, conversation
+            )
+        return response
+
+    def send_detached_message(
+        self, message, conversation_id, priority: int = PRIORITY_BACKGROUND
+    ) -> Tuple[Message, int]:
+        """
+        Send a message in the conversation without recording it, e.g. to prepare a response
+        speculatively. The message can be recorded later with `commit_message`.
+        Parameters
+        ----------
+            message: str
+            conversation_id: str
+            priority: int
+                The scheduling priority of the request. Speculative requests are background work.
+        Returns
+        -------
+            message: Message
+                The completed message. Its answer holds the response.
+            num_tokens: int
+                The token cost of the request.
+        """
+        conversation = self.conversation_dict[conversation_id]
+        data = self._format_user_message(message)
+        chat_message, num_tokens = self._build_chat_message(conversation, data)
+        message: Message = self._create_message(data)
+        response = self._complete(
+            chat_message, priority=priority, num_tokens=num_tokens
+        )
+        self._complete_message(message, response)
+        return message, num_tokens
+
+    def commit_message(self, conversation_id, message: Message):
+        """
+        Record a message prepared by `send_detached_message` in the conversation.
+        """
+        self._record_message(self.conversation_dict[conversation_id], message)
+
+    async def asend_message(
+        self, message, conversation_id, image_url: str = None, debug_mode=False
+    ):
+        """
+        The asyncio variant of `send_message`.
+        """
+        conversation = self.conversation_dict[conversation_id]
+        data = self._format_user_message(message, image_url)
+        chat_message, num_tokens = self._build_chat_message(conversation, data)
+        message: Message = self._create_message(data)
+        response = await self._acomplete(chat_message, num_tokens=num_tokens)
+
+        self._complete_message(message, response)
+        self._record_message(conversation, message)
+        if debug_mode:
+            self._debug_print(
+                inspect.stack()[1][3], message, response, num_tokens, conversation
+            )
         return response
 
 
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+import loguru
+
+logger = loguru.logger
+
+
+class LLMResponseCache:
+    """
+    A content-addressed cache of LLM responses, stored in SQLite.
+
+    The key is the hash of (model, temperature, normalized message list), so an identical
+    request is answered locally instead of with a network round-trip. Entries are evicted
+    when they are older than `max_age` seconds, or by least recent use when the cache
+    holds more than `max_entries` responses.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        max_entries: int = 10000,
+        max_age: float = 7 * 24 * 3600,
+    ):
+        """
+        :param db_path: the path of the SQLite database. It is created if it does not exist.
+        :param max_entries: the maximum number of cached responses.
+        :param max_age: the maximum age of a cached response, in seconds.
+        """
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        # the cache is shared by the agents, which may call it from worker threads
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT, "
+            "created REAL, last_access REAL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)"
+        )
+        self._connection.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(model: str, temperature: float, messages: List[dict]) -> str:
+        """
+        Hash the request. Line endings and surrounding whitespace of the contents are
+        normalized, and only the role and content of each message are considered.
+        :return: the hex digest of the request.
+        """
+        normalized = []
+        for message in messages:
+            content = message.get("content", "")
+            if isinstance(content, str):
+                content = content.replace("\r\n", "\n").strip()
+            normalized.append({"role": message.get("role"), "content": content})
+        payload = json.dumps(
+            {"model": model, "temperature": temperature, "messages": normalized},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Get the cached response of the key.
+        :return: the response, or None if it is not cached or has expired.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT response, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.max_age:
+                self.misses += 1
+                return None
+            self._connection.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?", (now, key)
+            )
+            self._connection.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, response: str, model: str = None):
+        """
+        Store the response of the key, and evict the least recently used entries if the
+        cache is full.
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, model, response, now, now),
+            )
+            self._connection.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                "ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._connection.commit()
+
+    def evict(self):
+        """
+        Remove the expired entries, and the least recently used entries beyond `max_entries`.
+        """
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,)
+            )
+            self._connection.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                "ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._connection.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM responses"
+            ).fetchone()[0]
+
+    @property
+    def stats(self) -> dict:
+        """
+        The hit/miss counters of the current process.
+        """
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self),
+        }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,214 @@
+"""
+A background worker for the LLM pipeline, so that the prompt stays responsive.
+
+The jobs (e.g. parsing a tool output and reasoning on it) run one at a time on a worker
+thread, in the order they were submitted. A job can be cancelled: the LLM agents call
+`check_cancelled` before each request and between the chunks of a streamed response, and
+the request in flight is aborted by closing its response (see `on_cancel`), so a cancelled
+job stops at once.
+
+The token of the job is held in a context variable of the worker thread, so that the
+requests of other threads (e.g. the prompt or the prefetch) are not cancelled with it.
+The helper threads of a job receive its token with `with_cancel_token`.
+"""
+
+import concurrent.futures
+import contextlib
+import contextvars
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+import loguru
+
+logger = loguru.logger
+
+
+class RequestCancelled(Exception):
+    """
+    Raised in a job when it is cancelled by the user.
+    """
+
+
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def cancel(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"Failed to abort the request: {e}")
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def add_callback(self, callback: Callable[[], None]):
+        """
+        Call `callback` when the token is cancelled, or at once if it already is.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+# the token of the job that runs in the current thread, if any
+_active_token: contextvars.ContextVar[Optional[CancelToken]] = contextvars.ContextVar(
+    "active_cancel_token", default=None
+)
+
+
+def current_cancel_token() -> Optional[CancelToken]:
+    """
+    The token of the job that runs in the current thread, or None outside of the jobs.
+    """
+    return _active_token.get()
+
+
+def check_cancelled():
+    """
+    Raise RequestCancelled if the job of the current thread is cancelled.
+    """
+    token = _active_token.get()
+    if token is not None and token.cancelled:
+        raise RequestCancelled()
+
+
+@contextlib.contextmanager
+def on_cancel(abort: Callable[[], None]):
+    """
+    Call `abort` if the job of the current thread is cancelled within the block, e.g. to
+    close the response of the request in flight. Outside of the jobs, it does nothing.
+    """
+    token = _active_token.get()
+    if token is None:
+        yield
+        return
+    token.add_callback(abort)
+    try:
+        yield
+    finally:
+        token.remove_callback(abort)
+
+
+def with_cancel_token(fn: Callable) -> Callable:
+    """
+    Bind `fn` to the job of the current thread, so that it can be cancelled with the job
+    when it runs on a helper thread, e.g. of a ThreadPoolExecutor.
+    """
+    token = _active_token.get()
+
+    def run(*args, **kwargs):
+        reset_token = _active_token.set(token)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _active_token.reset(reset_token)
+
+    return run
+
+
+class Job:
+    def __init__(self, fn: Callable, args: tuple, description: str):
+        self.fn = fn
+        self.args = args
+        self.description = description
+        self.future = Future()
+        self.token = CancelToken()
+
+    def cancel(self):
+        self.token.cancel()
+        self.future.cancel()
+
+
+class LLMWorker:
+    """
+    Usage:
+        worker = LLMWorker()
+        job = worker.submit(handler.reasoning_handler, text, description="reasoning")
+        ...
+        worker.cancel_all()
+    """
+
+    def __init__(self):
+        self._queue: "queue.Queue[Job]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._jobs = []  # the submitted jobs that are not finished
+        self._thread = threading.Thread(
+            target=self._run, name="llm-worker", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, fn: Callable, *args, description: str = "") -> Job:
+        job = Job(fn, args, description)
+        with self._lock:
+            self._jobs.append(job)
+        self._queue.put(job)
+        return job
+
+    @property
+    def pending_jobs(self) -> int:
+        with self._lock:
+            return len(self._jobs)
+
+    def cancel_all(self) -> int:
+        """
+        Cancel the running job and the queued ones.
+        :return: the number of cancelled jobs.
+        """
+        with self._lock:
+            jobs, self._jobs = self._jobs, []
+        for job in jobs:
+            job.cancel()
+        return len(jobs)
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Wait until all the submitted jobs are finished.
+        :return: False on timeout.
+        """
+        with self._lock:
+            jobs = list(self._jobs)
+        for job in jobs:
+            try:
+                job.future.exception(timeout=timeout)
+            except concurrent.futures.TimeoutError:
+                return False
+            except Exception:  # cancelled
+                pass
+        return True
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            reset_token = _active_token.set(job.token)
+            try:
+                job.future.set_result(job.fn(*job.args))
+            except RequestCancelled as e:
+                logger.info(f"Cancelled: {job.description}")
+                job.future.set_exception(e)
+            except BaseException as e:
+                logger.exception(e)
+                job.future.set_exception(e)
+            finally:
+                _active_token.reset(reset_token)
+                with self._lock:
+                    if job in self._jobs:
+                        self._jobs.remove(job)
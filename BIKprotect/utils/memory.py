@@ -0,0 +1,78 @@
+"""
+Long-term memory of the findings of a test.
+
+The reasoning session only keeps the last few messages of its conversation, so the findings
+of the early steps (e.g. the initial recon) are forgotten in a long test. With the memory,
+every parsed input is stored in a `customVectorDB`, and the earlier findings most relevant
+to a new input are retrieved and sent with it, within a token budget. The prompt stays
+small, and the early findings are still available when they become relevant again.
+"""
+
+from typing import List
+
+import loguru
+
+from BIKprotect.utils.llm_api import count_text_tokens
+
+logger = loguru.logger
+
+# the number of characters of an input used as the retrieval query
+QUERY_CHARS = 4000
+
+
+class FindingMemory:
+    """
+    Usage:
+        memory = FindingMemory(customVectorDB(...), top_k=4, token_budget=1000)
+        findings = memory.recall(parsed_input)  # the relevant earlier findings
+        memory.remember(parsed_input)
+    """
+
+    def __init__(
+        self, vector_db, top_k: int = 4, token_budget: int = 1000, model: str = None
+    ):
+        """
+        :param vector_db: the customVectorDB the findings are stored in.
+        :param top_k: the maximum number of findings recalled for an input.
+        :param token_budget: the maximum number of tokens of the recalled findings.
+        :param model: the model the tokens are counted for.
+        """
+        self.vector_db = vector_db
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.model = model
+
+    def recall(self, text: str) -> List[str]:
+        """
+        The stored findings most relevant to the text, the most relevant first, within the
+        token budget. A finding that the text already contains is skipped.
+        """
+        try:
+            documents = self.vector_db.retrieval(text[:QUERY_CHARS], k=self.top_k)
+        except Exception as e:
+            # the memory is an aid; a failed retrieval does not fail the step
+            logger.warning(f"Failed to recall the earlier findings: {e}")
+            return []
+        findings = []
+        used = 0
+        for document in documents:
+            finding = document.page_content.strip()
+            if not finding or finding in text:
+                continue
+            tokens = count_text_tokens(finding, self.model)
+            if used + tokens > self.token_budget:
+                continue
+            used += tokens
+            findings.append(finding)
+        return findings
+
+    def remember(self, text: str, metadata: dict = None) -> int:
+        """
+        Store the text. The hosts and ports it mentions are added to its metadata.
+        :return: the number of new chunks stored.
+        """
+        try:
+            return self.vector_db.store_text(text, metadata=metadata)
+        except Exception as e:
+            logger.warning(f"Failed to store the findings: {e}")
+            return 0
@@ -0,0 +1,159 @@
+"""
+Speculative generation of the next response while the tester reads the current one.
+
+After `next`, the tester usually asks for more details of the recommended task (`more`),
+which sends the reasoning response to the generation session, or for the to-do list
+(`todo`), which first sends the to-do request to the reasoning session. A prefetcher sends
+the expected request of one session in the background as soon as it is known, without
+recording it in the conversation. When the same request is made, the prepared response is
+committed to the conversation and returned; otherwise it is discarded, and its tokens are
+counted against a budget shared by the prefetchers. Once the budget is spent, no more
+speculative requests are sent.
+"""
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+import loguru
+
+logger = loguru.logger
+
+
+class PrefetchBudget:
+    """
+    The budget of the tokens spent on discarded responses, shared by the prefetchers.
+    """
+
+    def __init__(self, max_wasted_tokens: int = 20000):
+        self.max_wasted_tokens = max_wasted_tokens
+        self.wasted_tokens = 0
+        self._lock = threading.Lock()
+
+    @property
+    def exhausted(self) -> bool:
+        return self.wasted_tokens >= self.max_wasted_tokens
+
+    def spend(self, tokens: int) -> int:
+        with self._lock:
+            self.wasted_tokens += tokens
+            return self.wasted_tokens
+
+
+class Prefetcher:
+    """
+    Usage:
+        prefetcher = Prefetcher(generation_agent, session_id, max_wasted_tokens=20000)
+        prefetcher.start(reasoning_response)
+        ...
+        response = prefetcher.take(reasoning_response)  # None if it was not prefetched
+    """
+
+    def __init__(
+        self,
+        agent,
+        conversation_id: str,
+        max_wasted_tokens: int = 20000,
+        budget: PrefetchBudget = None,
+    ):
+        """
+        :param agent: the LLMAPI agent of the conversation.
+        :param conversation_id: the conversation to prefetch in.
+        :param max_wasted_tokens: the budget of the tokens spent on discarded responses.
+        :param budget: a budget shared with other prefetchers. It replaces
+            `max_wasted_tokens`.
+        """
+        self.agent = agent
+        self.conversation_id = conversation_id
+        self.budget = (
+            budget if budget is not None else PrefetchBudget(max_wasted_tokens)
+        )
+        self.hits = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="prefetch"
+        )
+        self._lock = threading.Lock()
+        self._text: Optional[str] = None
+        self._future: Optional[Future] = None
+        self._conversation_length = 0
+
+    @property
+    def budget_exhausted(self) -> bool:
+        return self.budget.exhausted
+
+    @property
+    def wasted_tokens(self) -> int:
+        return self.budget.wasted_tokens
+
+    def _conversation(self):
+        return self.agent.conversation_dict[self.conversation_id]
+
+    def start(self, text: str):
+        """
+        Prefetch the response of `text`. A pending prefetch of another text is discarded.
+        """
+        self.discard()
+        if self.budget_exhausted:
+            logger.info("The prefetch budget is spent; no more speculative requests")
+            return
+        with self._lock:
+            self._text = text
+            # the response is only valid if the conversation does not change meanwhile
+            self._conversation_length = len(self._conversation().message_list)
+            self._future = self._executor.submit(
+                self.agent.send_detached_message, text, self.conversation_id
+            )
+
+    def take(self, text: str) -> Optional[str]:
+        """
+        Get the prefetched response of `text`, and record it in the conversation.
+        It waits for the prefetch if it is still running.
+        :return: the response, or None if `text` was not prefetched. A pending prefetch of
+            another text is discarded.
+        """
+        with self._lock:
+            future, prefetched_text = self._future, self._text
+            valid = (
+                future is not None
+                and prefetched_text == text
+                and len(self._conversation().message_list) == self._conversation_length
+            )
+            if valid:
+                self._future, self._text = None, None
+        if not valid:
+            self.discard()
+            return None
+        try:
+            message, _ = future.result()
+        except Exception as e:
+            logger.warning(f"The prefetch failed: {e}")
+            return None
+        self.agent.commit_message(self.conversation_id, message)
+        self.hits += 1
+        # the Gemini messages hold the answer as a string
+        if isinstance(message.answer, str):
+            return message.answer
+        return message.answer[0]["content"]
+
+    def discard(self):
+        """
+        Discard the pending prefetch, and count its tokens as wasted.
+        """
+        with self._lock:
+            future, self._future, self._text = self._future, None, None
+        if future is None or future.cancel():
+            return
+        future.add_done_callback(self._count_wasted)
+
+    def _count_wasted(self, future: Future):
+        if future.exception() is not None:
+            return
+        message, num_tokens = future.result()
+        wasted_tokens = self.budget.spend(num_tokens + message.answer_tokens)
+        logger.info(
+            f"Discarded a prefetched response; {wasted_tokens} tokens wasted in total"
+        )
+
+    def close(self):
+        self.discard()
+        self._executor.shutdown(wait=False)
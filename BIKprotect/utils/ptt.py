@@ -0,0 +1,268 @@
+"""
+The Penetration Testing Tree (PTT) as a data structure.
+
+The reasoning session used to re-emit the whole tree as free text on every turn. With the
+tree kept locally, the model only replies with node-level edits, which are applied here:
+
+    ADD 1.3.3 Enumerate the web directories
+    COMPLETE 1.3.1
+    NA 1.2
+
+The tree is rendered in the text format of the prompts, e.g. `1.3.1 Full port scan - [to-do]`.
+"""
+
+import dataclasses
+import re
+from typing import Dict, List, Optional, Tuple
+
+TODO = "to-do"
+COMPLETED = "completed"
+NOT_APPLICABLE = "not applicable"
+
+# e.g. "   1.3.1 Perform a full port scan - (to-do)" or "1. Reconnaissance - [to-do]"
+_TASK_LINE = re.compile(
+    r"^\s*[-*]?\s*(?:\*\*)?(?P<id>\d+(?:\.\d+)*)\.?(?:\*\*)?\s+(?P<description>.+?)"
+    r"(?:\s*[-:]\s*[\[(](?P<status>to-do|todo|completed|not applicable|n/a)[\])])?\s*$",
+    re.IGNORECASE,
+)
+_PTT_TASK_LINE = re.compile(r"^\s*[-*]?\s*\d+(\.\d+)*[.)]?\s+\S", re.MULTILINE)
+_PTT_STATUS = re.compile(r"to-do|completed|not applicable", re.IGNORECASE)
+# e.g. "ADD 1.3.3 Enumerate the web directories", "COMPLETE 1.3.1", "N/A 1.2"
+_EDIT_LINE = re.compile(
+    r"^\s*[-*]?\s*(?P<op>ADD|COMPLETE|COMPLETED|NA|N/A|N-A|NOT APPLICABLE)\s*:?\s+"
+    r"(?P<id>\d+(?:\.\d+)*)\.?(?:\s+(?P<description>.+?))?\s*$",
+    re.IGNORECASE,
+)
+
+# a dotted task id mentioned in a text, e.g. "1.3.2" in "Perform task 1.3.2 next". A bare
+# number, e.g. in "Select 1 sub-task", is not taken for a task id.
+_TASK_REFERENCE = re.compile(r"(?<![\w.])\d+(?:\.\d+)+(?!\w|\.\d)")
+
+# the section headers of a reasoning reply that contains both the PTT and the next task
+_SECTION_HEADER = re.compile(
+    r"^[#*\s]*=+\s*(?P<name>PTT|NEXT TASK)\s*=+[*\s]*$", re.IGNORECASE | re.MULTILINE
+)
+
+
+def _normalize_status(status: Optional[str]) -> str:
+    if status is None:
+        return TODO
+    status = status.lower()
+    if status in ("to-do", "todo"):
+        return TODO
+    if status in ("n/a", NOT_APPLICABLE):
+        return NOT_APPLICABLE
+    return COMPLETED
+
+
+def contains_ptt(text) -> bool:
+    """
+    Whether the text looks like a PTT: several numbered tasks with a completion status.
+    """
+    if not isinstance(text, str):
+        return False
+    return len(_PTT_TASK_LINE.findall(text)) >= 2 and bool(_PTT_STATUS.search(text))
+
+
+def split_reasoning_response(response: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Split a reasoning reply into its PTT and next task sections.
+    :return: the two sections, or (None, None) if the reply does not have both headers.
+    """
+    sections = {}
+    headers = list(_SECTION_HEADER.finditer(response))
+    for header, next_header in zip(headers, headers[1:] + [None]):
+        end = next_header.start() if next_header is not None else len(response)
+        sections[header.group("name").upper()] = response[header.end() : end].strip()
+    if "PTT" not in sections or not sections.get("NEXT TASK"):
+        return None, None
+    return sections["PTT"], sections["NEXT TASK"]
+
+
+@dataclasses.dataclass
+class PTTNode:
+    node_id: str
+    description: str
+    status: str = TODO
+    parent: Optional["PTTNode"] = dataclasses.field(
+        default=None, repr=False, compare=False
+    )
+    children: List["PTTNode"] = dataclasses.field(
+        default_factory=list, repr=False, compare=False
+    )
+
+    @property
+    def depth(self) -> int:
+        return self.node_id.count(".")
+
+    @property
+    def parent_id(self) -> Optional[str]:
+        if "." not in self.node_id:
+            return None
+        return self.node_id.rsplit(".", 1)[0]
+
+
+class PTT:
+    """
+    The task tree, indexed by node id.
+
+    Usage:
+        ptt = PTT.parse(reasoning_response)
+        applied = ptt.apply_edits(diff_response)
+        print(ptt.render())
+    """
+
+    def __init__(self):
+        self.roots: List[PTTNode] = []
+        self.nodes: Dict[str, PTTNode] = {}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @classmethod
+    def parse(cls, text: str) -> "PTT":
+        """
+        Parse the tasks of a PTT in text. The lines that are not tasks are ignored.
+        """
+        ptt = cls()
+        for line in text.splitlines():
+            match = _TASK_LINE.match(line)
+            if match is None:
+                continue
+            ptt.add(
+                match.group("id"),
+                match.group("description").strip(),
+                _normalize_status(match.group("status")),
+            )
+        return ptt
+
+    def add(self, node_id: str, description: str, status: str = TODO) -> PTTNode:
+        """
+        Add a task, or update the description and status of an existing one.
+        A task whose parent does not exist is added as a root task, and a new to-do
+        task reopens its completed parent tasks.
+        """
+        node = self.nodes.get(node_id)
+        if node is not None:
+            node.description = description
+            node.status = status
+            return node
+        node = PTTNode(node_id, description, status)
+        parent = self.nodes.get(node.parent_id) if node.parent_id else None
+        node.parent = parent
+        siblings = parent.children if parent is not None else self.roots
+        siblings.append(node)
+        siblings.sort(key=lambda n: [int(part) for part in n.node_id.split(".")])
+        self.nodes[node_id] = node
+        # a new to-do sub-task reopens the completed parent tasks
+        while status == TODO and parent is not None and parent.status == COMPLETED:
+            parent.status = TODO
+            parent = parent.parent
+        return node
+
+    def set_status(self, node_id: str, status: str):
+        """
+        Set the status of the task and of its sub-tasks.
+        A task is completed when all its sub-tasks are completed or not applicable.
+        """
+        node = self.nodes[node_id]
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if status != COMPLETED or current.status == TODO:
+                current.status = status
+            stack.extend(current.children)
+        parent = node.parent
+        while parent is not None and all(
+            child.status != TODO for child in parent.children
+        ):
+            if parent.status == TODO:
+                parent.status = COMPLETED
+            parent = parent.parent
+
+    def complete(self, node_id: str):
+        self.set_status(node_id, COMPLETED)
+
+    def mark_not_applicable(self, node_id: str):
+        self.set_status(node_id, NOT_APPLICABLE)
+
+    def apply_edits(self, text: str) -> List[str]:
+        """
+        Apply the edit lines of the model response. Other lines are ignored, as are the
+        edits of unknown tasks.
+        :return: the applied edits.
+        """
+        applied = []
+        for line in text.splitlines():
+            match = _EDIT_LINE.match(line)
+            if match is None:
+                continue
+            op, node_id = match.group("op").upper(), match.group("id")
+            description = match.group("description")
+            if op == "ADD":
+                if not description:
+                    continue
+                self.add(node_id, description.strip())
+            elif node_id not in self.nodes:
+                continue
+            elif op.startswith("COMPLETE"):
+                self.complete(node_id)
+            else:
+                self.mark_not_applicable(node_id)
+            applied.append(line.strip())
+        return applied
+
+    def walk(self) -> List[PTTNode]:
+        """
+        The tasks in depth-first order.
+        """
+        nodes = []
+        stack = list(reversed(self.roots))
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(node.children))
+        return nodes
+
+    def find_task(self, text: str) -> Optional[PTTNode]:
+        """
+        The task of the tree mentioned in the text, e.g. in the next task selected by the
+        reasoning session. A task is mentioned by its dotted id or by its description; if
+        several tasks are, the one mentioned by both is taken.
+        :return: the task, or None if no task or several tasks match.
+        """
+        by_id = {match.group() for match in _TASK_REFERENCE.finditer(text)} & set(
+            self.nodes
+        )
+        lowered = text.lower()
+        by_description = {
+            node_id
+            for node_id, node in self.nodes.items()
+            if node.description and node.description.lower() in lowered
+        }
+        for candidates in (by_id & by_description, by_id | by_description):
+            if len(candidates) == 1:
+                return self.nodes[candidates.pop()]
+            if candidates:
+                return None
+        return None
+
+    def todo_nodes(self) -> List[PTTNode]:
+        """
+        The to-do tasks without to-do sub-tasks, i.e. the tasks that can be performed next.
+        """
+        return [
+            node
+            for node in self.walk()
+            if node.status == TODO
+            and not any(child.status == TODO for child in node.children)
+        ]
+
+    def render(self) -> str:
+        lines = []
+        for node in self.walk():
+            separator = "." if node.depth == 0 else ""
+            lines.append(
+                f"{'   ' * node.depth}{node.node_id}{separator} {node.description} - [{node.status}]"
+            )
+        return "\n".join(lines)
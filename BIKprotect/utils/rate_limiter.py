@@ -0,0 +1,186 @@
+"""
+Client-side rate limiting of the LLM requests.
+
+The agents share the per-minute request (RPM) and token (TPM) quota of the same model and
+API key. The scheduler paces the requests with token buckets before they are sent, instead
+of sending them and sleeping on a `RateLimitError`. The pacing is opt-in: the limits of an
+account depend on its usage tier, so the requests are only paced once the limits are given
+(`--rpm` / `--tpm`); otherwise the 429s are handled by the retry engine. When several requests are waiting for
+the same quota, the one with the best priority is served first, so that an interactive
+reasoning call is not stuck behind a batch of background summarization calls.
+"""
+
+import dataclasses
+import heapq
+import itertools
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import loguru
+
+logger = loguru.logger
+
+# lower values are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+
+@dataclasses.dataclass
+class RateLimit:
+    requests_per_minute: float
+    tokens_per_minute: float
+
+
+# The usage tier 1 limits of OpenAI. They are not applied by default; they fill in the limit
+# that is not given when only one of `--rpm` / `--tpm` is.
+# The model names are matched by prefix, and the longest prefix wins.
+DEFAULT_RATE_LIMITS: Dict[str, RateLimit] = {
+    "gpt-4": RateLimit(requests_per_minute=500, tokens_per_minute=10000),
+    "gpt-4-1106": RateLimit(requests_per_minute=500, tokens_per_minute=30000),
+    "gpt-4-turbo": RateLimit(requests_per_minute=500, tokens_per_minute=30000),
+    "gpt-4o": RateLimit(requests_per_minute=500, tokens_per_minute=30000),
+    "gpt-3.5-turbo": RateLimit(requests_per_minute=3500, tokens_per_minute=60000),
+    "gpt-35-turbo": RateLimit(requests_per_minute=3500, tokens_per_minute=60000),
+}
+
+
+class TokenBucket:
+    """
+    A bucket of `capacity` units, refilled continuously at `refill_rate` units per second.
+    The level may go below zero when more units were used than reserved; the debt is paid
+    by the refill before the next reservation.
+    """
+
+    def __init__(self, capacity: float, refill_rate: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(
+            self.capacity, self.level + (now - self.updated) * self.refill_rate
+        )
+        self.updated = now
+
+    def delay_for(self, amount: float) -> float:
+        """
+        :return: the number of seconds until `amount` units are available.
+        """
+        self._refill()
+        # a request larger than the bucket waits for a full bucket, instead of forever
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.refill_rate
+
+    def consume(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+
+class RequestScheduler:
+    """
+    Pace the requests of each (model, API key) with a request bucket and a token bucket,
+    and serve the waiting requests by priority.
+
+    Usage:
+        scheduler = RequestScheduler()
+        scheduler.acquire(("gpt-4", api_key), prompt_tokens, priority=PRIORITY_INTERACTIVE)
+        response = ...  # send the request
+        scheduler.record_usage(("gpt-4", api_key), completion_tokens)
+    """
+
+    def __init__(self, limits: Dict[str, RateLimit] = None):
+        """
+        :param limits: the rate limits by model name prefix. Models without a limit are not
+            paced; by default, no model is.
+        """
+        self.limits = dict(limits or {})
+        self._condition = threading.Condition()
+        self._buckets: Dict[Tuple, Optional[Tuple[TokenBucket, TokenBucket]]] = {}
+        self._queues: Dict[Tuple, List[Tuple[int, int]]] = {}
+        self._sequence = itertools.count()
+
+    def set_limit(self, model_prefix: str, limit: Optional[RateLimit]):
+        """
+        Set the rate limit of the models starting with `model_prefix`. None disables pacing.
+        """
+        with self._condition:
+            self.limits[model_prefix] = limit
+            # the buckets are recreated with the new limit on the next request
+            self._buckets.clear()
+
+    def limit_for(self, model: str) -> Optional[RateLimit]:
+        matches = [prefix for prefix in self.limits if str(model).startswith(prefix)]
+        if not matches:
+            return None
+        return self.limits[max(matches, key=len)]
+
+    def _buckets_for(self, key: Tuple) -> Optional[Tuple[TokenBucket, TokenBucket]]:
+        if key not in self._buckets:
+            limit = self.limit_for(key[0])
+            if limit is None:
+                self._buckets[key] = None
+            else:
+                self._buckets[key] = (
+                    TokenBucket(
+                        limit.requests_per_minute, limit.requests_per_minute / 60
+                    ),
+                    TokenBucket(limit.tokens_per_minute, limit.tokens_per_minute / 60),
+                )
+        return self._buckets[key]
+
+    def acquire(self, key: Tuple, tokens: int, priority: int = PRIORITY_INTERACTIVE):
+        """
+        Block until the request can be sent within the rate limit of the key.
+        :param key: the (model, API key) of the request.
+        :param tokens: the estimated prompt tokens of the request.
+        :param priority: the requests with lower values are served first.
+        """
+        start_time = time.monotonic()
+        with self._condition:
+            buckets = self._buckets_for(key)
+            if buckets is None:
+                return
+            request_bucket, token_bucket = buckets
+            queue = self._queues.setdefault(key, [])
+            entry = (priority, next(self._sequence))
+            heapq.heappush(queue, entry)
+            try:
+                while True:
+                    if queue[0] != entry:
+                        # wait until the requests ahead of this one are sent
+                        self._condition.wait()
+                        continue
+                    delay = max(
+                        request_bucket.delay_for(1), token_bucket.delay_for(tokens)
+                    )
+                    if delay <= 0:
+                        break
+                    # a request with a better priority may arrive in the meantime
+                    self._condition.wait(delay)
+                heapq.heappop(queue)
+                request_bucket.consume(1)
+                token_bucket.consume(tokens)
+            except BaseException:
+                queue.remove(entry)
+                heapq.heapify(queue)
+                raise
+            finally:
+                self._condition.notify_all()
+        waited = time.monotonic() - start_time
+        if waited > 1:
+            logger.info(f"Request to {key[0]} paced by {waited:.1f} seconds")
+
+    def record_usage(self, key: Tuple, tokens: int):
+        """
+        Charge the tokens that were not known when the request was acquired, e.g. the
+        completion tokens.
+        """
+        with self._condition:
+            buckets = self._buckets_for(key)
+            if buckets is not None:
+                buckets[1].consume(tokens)
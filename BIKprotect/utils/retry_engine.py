@@ -0,0 +1,153 @@
+"""
+The retry engine shared by all the LLM backends.
+
+Transient errors are retried with jittered exponential backoff. The policy (number of
+attempts and delays) is selected by the class of the error, and a `Retry-After` header sent
+by the server takes precedence over the backoff, so that a rate limit only costs the time
+the server requires.
+"""
+
+import dataclasses
+import email.utils
+import random
+import time
+from typing import Callable, List, Optional, Tuple, Type
+
+import loguru
+import openai
+from tenacity import AsyncRetrying, Retrying, retry_if_exception
+
+logger = loguru.logger
+
+
+@dataclasses.dataclass
+class RetryPolicy:
+    max_attempts: int = 3  # including the first attempt
+    base_delay: float = 1.0  # the backoff before the second attempt, in seconds
+    max_delay: float = 30.0  # the cap of a single backoff, and of a `Retry-After`
+    honor_retry_after: bool = True
+
+
+def _default_policies() -> List[Tuple[Type[BaseException], RetryPolicy]]:
+    # the first matching class wins, so subclasses must come before their parents
+    policies = [
+        (openai.RateLimitError, RetryPolicy(max_attempts=6, max_delay=60)),
+        (openai.APITimeoutError, RetryPolicy(max_attempts=3, base_delay=1)),
+        (openai.APIConnectionError, RetryPolicy(max_attempts=4, base_delay=0.5)),
+        (openai.InternalServerError, RetryPolicy(max_attempts=3, base_delay=2)),
+        (openai.ConflictError, RetryPolicy(max_attempts=2)),
+    ]
+    try:
+        from google.api_core import exceptions as google_exceptions
+
+        policies += [
+            (google_exceptions.ResourceExhausted, RetryPolicy(max_attempts=6)),
+            (google_exceptions.ServiceUnavailable, RetryPolicy(max_attempts=4)),
+            (google_exceptions.DeadlineExceeded, RetryPolicy(max_attempts=3)),
+            (google_exceptions.InternalServerError, RetryPolicy(max_attempts=3)),
+        ]
+    except ImportError:  # the Gemini backend is not installed
+        pass
+    return policies
+
+
+def get_retry_after(exception: BaseException) -> Optional[float]:
+    """
+    Read the delay requested by the server from the `retry-after-ms` or `retry-after` header.
+    :return: the delay in seconds, or None if the server did not specify one.
+    """
+    response = getattr(exception, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:  # HTTP-date format
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_date.timestamp() - time.time(), 0.0)
+
+
+class RetryEngine:
+    """
+    Retry a callable on transient errors, with per-error-class policies.
+
+    Usage:
+        engine = RetryEngine()
+        response = engine.call(client.chat.completions.create, model=model, messages=history)
+        response = await engine.acall(async_client.chat.completions.create, ...)
+    """
+
+    def __init__(self, policies: List[Tuple[Type[BaseException], RetryPolicy]] = None):
+        self.policies = policies if policies is not None else _default_policies()
+
+    def policy_for(self, exception: BaseException) -> Optional[RetryPolicy]:
+        """
+        :return: the policy of the error, or None if the error should not be retried.
+        """
+        for exception_class, policy in self.policies:
+            if isinstance(exception, exception_class):
+                return policy
+        return None
+
+    def _should_retry(self, exception: BaseException) -> bool:
+        return self.policy_for(exception) is not None
+
+    def _stop(self, retry_state) -> bool:
+        policy = self.policy_for(retry_state.outcome.exception())
+        return policy is None or retry_state.attempt_number >= policy.max_attempts
+
+    def _wait(self, retry_state) -> float:
+        exception = retry_state.outcome.exception()
+        policy = self.policy_for(exception)
+        retry_after = get_retry_after(exception) if policy.honor_retry_after else None
+        if retry_after is not None:
+            delay = min(retry_after, policy.max_delay)
+        else:
+            # exponential backoff with equal jitter, so that concurrent callers spread out
+            backoff = min(
+                policy.base_delay * 2 ** (retry_state.attempt_number - 1),
+                policy.max_delay,
+            )
+            delay = backoff / 2 + random.uniform(0, backoff / 2)
+        return delay
+
+    def _before_sleep(self, retry_state):
+        exception = retry_state.outcome.exception()
+        logger.warning(
+            f"{type(exception).__name__} on attempt {retry_state.attempt_number}. "
+            f"Retrying in {retry_state.next_action.sleep:.1f} seconds"
+        )
+
+    def _retrying_kwargs(self) -> dict:
+        return dict(
+            retry=retry_if_exception(self._should_retry),
+            stop=self._stop,
+            wait=self._wait,
+            before_sleep=self._before_sleep,
+            reraise=True,
+        )
+
+    def call(self, fn: Callable, *args, **kwargs):
+        """
+        Call `fn(*args, **kwargs)`, retrying on transient errors.
+        """
+        return Retrying(**self._retrying_kwargs())(fn, *args, **kwargs)
+
+    async def acall(self, fn: Callable, *args, **kwargs):
+        """
+        Await `fn(*args, **kwargs)`, retrying on transient errors.
+        """
+        return await AsyncRetrying(**self._retrying_kwargs())(fn, *args, **kwargs)
@@ -0,0 +1,52 @@
+from typing import List
+
+from rich.console import Console, Group
+from rich.live import Live
+from rich.spinner import Spinner
+from rich.text import Text
+
+
+class StreamPrinter:
+    """
+    Render a streamed LLM response with rich as the tokens arrive.
+
+    It replaces `console.status` while a response is streamed: the spinner is shown until
+    the first token arrives, and then the tail of the response is shown below it.
+    The display is transient, so the complete response can be printed as usual afterwards.
+
+    Usage:
+        with StreamPrinter(console, "BIKprotect Thinking...") as printer:
+            response = agent.send_message(message, conversation_id, stream_handler=printer)
+    """
+
+    def __init__(self, console: Console, message: str, refresh_per_second: int = 10):
+        self.console = console
+        self.spinner = Spinner("dots", text=Text.from_markup(message))
+        self.refresh_per_second = refresh_per_second
+        self.chunks: List[str] = []
+        self.live = None
+
+    def __call__(self, chunk: str):
+        # only record the chunk; the live display renders at its own refresh rate
+        self.chunks.append(chunk)
+
+    def _render(self):
+        if not self.chunks:
+            return self.spinner
+        # show only the lines that fit in the terminal
+        max_lines = max(self.console.height - 2, 1)
+        lines = "".join(self.chunks).splitlines()[-max_lines:]
+        return Group(self.spinner, Text("\n".join(lines)))
+
+    def __enter__(self):
+        self.live = Live(
+            console=self.console,
+            get_renderable=self._render,
+            refresh_per_second=self.refresh_per_second,
+            transient=True,
+        )
+        self.live.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.live.stop()
@@ -56,6 +56,7 @@ class mainTaskCompleter(Completer):
         "todo",
         "discuss",
         "google",
+        "cancel",
         "help",
         "quit",
     ]
@@ -66,6 +67,7 @@ class mainTaskCompleter(Completer):
         "todo": HTML("Ask <b>BIKprotect</b> for todos."),
         "discuss": HTML("Discuss with <b>BIKprotect</b>."),
         "google": HTML("Search on Google."),
+        "cancel": HTML("Cancel the queued steps."),
         "help": HTML("Show the help page."),
         "quit": HTML("End the current session."),
     }
@@ -73,10 +75,12 @@ class mainTaskCompleter(Completer):
     task_details = """
 Below are the available tasks:
  - next: Continue to the next step by inputting the test results.
+         Use `next --file <path>` to read a large tool output from a file or a named pipe.
  - more: Explain the previous given task with more details.
  - todo: Ask BIKprotect for the task list and what to do next.
  - discuss: Discuss with BIKprotect. You can ask for help, discuss the task, or give any feedbacks.
  - google: Search your question on Google. The results are automatically parsed by Google.
+ - cancel: Cancel the steps that are queued in the background (with --background).
  - help: Show this help page.
  - quit: End the current session."""
 
@@ -95,11 +99,12 @@ Below are the available tasks:
 def main_task_entry(text="> "):
     """
     Entry point for the task prompt. Auto-complete
+    The task may be followed by its arguments, e.g. `next --file nmap.txt`.
     """
     task_completer = mainTaskCompleter()
     while True:
-        result = prompt(text, completer=task_completer)
-        if result not in task_completer.tasks:
+        result = prompt(text, completer=task_completer).strip()
+        if result.split(" ", 1)[0] not in task_completer.tasks:
             print("Invalid task, try again.")
         else:
             return result
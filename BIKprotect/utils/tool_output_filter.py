@@ -0,0 +1,126 @@
+"""
+Remove the noise of security tool outputs before they are summarized by the LLM.
+
+The filter works line by line, so a large output can be streamed from a file or a pipe
+without being held in memory. It drops:
+- progress bars and status lines, e.g. the nmap timing stats and the gobuster progress;
+- the responses that found nothing, e.g. gobuster 404 lines and nmap closed ports;
+- ANSI escape codes, carriage-return redraws, and consecutive repeats of a line.
+A line repeated elsewhere in the output is kept, as the same line may be a finding of
+another host, e.g. the same open port in the sections of two hosts of an nmap scan.
+The dropped lines are counted, and the counts are reported at the end of the output.
+"""
+
+import re
+from collections import Counter
+from typing import Iterable, Iterator, List, Pattern, Tuple
+
+_ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]|\x1b\][^\x07]*\x07")
+
+# (reason, pattern) of the lines to drop
+NOISE_PATTERNS: List[Tuple[str, Pattern]] = [
+    # gobuster / dirb / ffuf: the paths that do not exist
+    (
+        "not found responses",
+        re.compile(r"\(Status: 404\)|\[Status: 404,|^\s*- \S+ \(CODE:404"),
+    ),
+    # nmap: the ports without a service
+    ("closed ports", re.compile(r"^\d+/(tcp|udp)\s+(closed|filtered)\b")),
+    # progress reports of nmap, gobuster, hydra, sqlmap, etc.
+    (
+        "progress",
+        re.compile(
+            r"^Stats: \d+:\d+:\d+ elapsed"
+            r"|Timing: About \d+(\.\d+)?% done"
+            r"|^Progress: \d+ / \d+"
+            r"|^\[STATUS\] [\d.]+ tries/min"
+            r"|^\s*\d{1,3}(\.\d+)?%\s*[|\[]"
+            r"|[\[|][#=>\-. ]{10,}[\]|]\s*\d{1,3}(\.\d+)?%"
+        ),
+    ),
+]
+
+
+class ToolOutputFilter:
+    """
+    Usage:
+        noise_filter = ToolOutputFilter()
+        with open(path) as f:
+            text = "".join(noise_filter.filter_lines(f))
+    """
+
+    def __init__(self, noise_patterns=None):
+        """
+        :param noise_patterns: the (reason, pattern) of the lines to drop.
+        """
+        self.noise_patterns = (
+            NOISE_PATTERNS if noise_patterns is None else noise_patterns
+        )
+        self.dropped = Counter()
+
+    def filter_lines(self, lines: Iterable[str]) -> Iterator[str]:
+        """
+        Filter the lines of a tool output. The lines are yielded with a trailing newline,
+        followed by a summary line of the dropped lines, if any.
+        """
+        self.dropped = Counter()
+        previous = None
+        blank = False
+        for line in lines:
+            # a progress bar redraws the line with carriage returns; keep the final state
+            line = _ANSI_ESCAPE.sub("", line.rstrip("\r\n")).rsplit("\r", 1)[-1]
+            line = line.rstrip()
+            if not line.strip():
+                previous = None
+                # collapse the runs of blank lines
+                if not blank:
+                    blank = True
+                    yield "\n"
+                continue
+            blank = False
+            reason = self._noise_reason(line)
+            if reason is not None:
+                self.dropped[reason] += 1
+                continue
+            # only the runs of a line are collapsed
+            if line.strip() == previous:
+                self.dropped["repeated lines"] += 1
+                continue
+            previous = line.strip()
+            yield line + "\n"
+        if self.dropped:
+            yield f"[{self.summary()}]\n"
+
+    def _noise_reason(self, line: str):
+        for reason, pattern in self.noise_patterns:
+            if pattern.search(line):
+                return reason
+        return None
+
+    def filter_text(self, text: str) -> str:
+        return "".join(self.filter_lines(text.splitlines()))
+
+    def summary(self) -> str:
+        """
+        The description of the dropped lines, e.g. "filtered 1200 lines: 1150 not found responses, 50 progress".
+        """
+        details = ", ".join(
+            f"{count} {reason}" for reason, count in self.dropped.most_common()
+        )
+        return f"filtered {sum(self.dropped.values())} lines: {details}"
+
+
+def read_tool_output(
+    path: str, noise_filter: ToolOutputFilter = None, filter_noise: bool = True
+) -> str:
+    """
+    Read a tool output from a file or a named pipe line by line, and filter it.
+    :param filter_noise: whether to filter the output. Other inputs, e.g. a web page, are
+        read as they are.
+    """
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        if not filter_noise:
+            return f.read()
+        if noise_filter is None:
+            noise_filter = ToolOutputFilter()
+        return "".join(noise_filter.filter_lines(f))
@@ -0,0 +1,293 @@
+"""
+Deterministic parsers of common security tool outputs.
+
+The LLM is not needed to summarize an nmap scan: its open ports and services can be
+extracted exactly, at no cost. Each parser turns the output of a tool into a compact
+summary, or returns None if it does not recognize the output, in which case the output is
+summarized by the LLM as before.
+
+A parser is added with the `register_parser` decorator:
+
+    @register_parser("my-tool")
+    def parse_my_tool(text: str) -> Optional[str]:
+        ...
+"""
+
+import re
+import xml.etree.ElementTree as ElementTree
+from typing import Callable, Dict, Optional, Tuple
+
+import loguru
+
+logger = loguru.logger
+
+ToolParser = Callable[[str], Optional[str]]
+
+# the parsers in the order they are tried
+PARSERS: Dict[str, ToolParser] = {}
+
+
+def register_parser(name: str):
+    def decorator(parser: ToolParser) -> ToolParser:
+        PARSERS[name] = parser
+        return parser
+
+    return decorator
+
+
+def parse_tool_output(text: str) -> Optional[Tuple[str, str]]:
+    """
+    Summarize the tool output with the first parser that recognizes it.
+    :return: the name of the parser and the summary, or None if no parser recognizes it.
+    """
+    for name, parser in PARSERS.items():
+        try:
+            summary = parser(text)
+        except Exception as e:  # a parser must never break the parsing of the input
+            logger.warning(f"The {name} parser failed: {e}")
+            continue
+        if summary is not None:
+            return name, summary
+    return None
+
+
+def _port_line(port: str, protocol: str, state: str, service: str, version: str):
+    line = f"- {port}/{protocol} {state} {service}"
+    return f"{line} {version}" if version else line
+
+
+@register_parser("nmap-xml")
+def parse_nmap_xml(text: str) -> Optional[str]:
+    start = text.find("<nmaprun")
+    if start == -1:
+        return None
+    end = text.rfind("</nmaprun>")
+    if end == -1:
+        # an interrupted scan; leave it to the LLM
+        return None
+    root = ElementTree.fromstring(text[start : end + len("</nmaprun>")])
+    lines = [f"nmap scan: {root.get('args', '')}".rstrip()]
+    for host in root.iter("host"):
+        address = " ".join(element.get("addr") for element in host.findall("address"))
+        hostnames = ", ".join(element.get("name") for element in host.iter("hostname"))
+        status = host.find("status")
+        state = status.get("state") if status is not None else "unknown"
+        lines.append(
+            f"Host {address}" + (f" ({hostnames})" if hostnames else "") + f": {state}"
+        )
+        for port in host.iter("port"):
+            port_state = port.find("state").get("state")
+            if port_state not in ("open", "open|filtered"):
+                continue
+            service = port.find("service")
+            name, version = "unknown", ""
+            if service is not None:
+                name = service.get("name", "unknown")
+                version = " ".join(
+                    service.get(key)
+                    for key in ("product", "version", "extrainfo")
+                    if service.get(key)
+                )
+            lines.append(
+                _port_line(
+                    port.get("portid"),
+                    port.get("protocol"),
+                    port_state,
+                    name,
+                    version,
+                )
+            )
+            for script in port.findall("script"):
+                output = " ".join(script.get("output", "").split())
+                lines.append(f"  {script.get('id')}: {output}")
+        for osmatch in host.iter("osmatch"):
+            lines.append(f"OS: {osmatch.get('name')} ({osmatch.get('accuracy')}%)")
+            break
+    return "\n".join(lines)
+
+
+_GREPABLE_HOST = re.compile(
+    r"^Host: (?P<address>\S+) \((?P<hostname>[^)]*)\)\s+(?P<fields>.*)$"
+)
+
+
+@register_parser("nmap-grepable")
+def parse_nmap_grepable(text: str) -> Optional[str]:
+    if "# Nmap" not in text or "Host: " not in text:
+        return None
+    lines = []
+    for line in text.splitlines():
+        match = _GREPABLE_HOST.match(line)
+        if match is None or "Ports: " not in match.group("fields"):
+            continue
+        host = match.group("address")
+        if match.group("hostname"):
+            host += f" ({match.group('hostname')})"
+        lines.append(f"Host {host}:")
+        ports = match.group("fields").split("Ports: ", 1)[1].split("\t")[0]
+        for entry in ports.split(", "):
+            fields = entry.split("/")
+            if len(fields) < 7 or fields[1] not in ("open", "open|filtered"):
+                continue
+            lines.append(
+                _port_line(
+                    fields[0], fields[2], fields[1], fields[4] or "unknown", fields[6]
+                )
+            )
+    if not lines:
+        return None
+    return "nmap scan:\n" + "\n".join(lines)
+
+
+_NMAP_REPORT = re.compile(r"^Nmap scan report for (?P<host>.+)$")
+_NMAP_PORT_HEADER = re.compile(r"^PORT\s+STATE\s+SERVICE", re.MULTILINE)
+_NMAP_PORT = re.compile(
+    r"^(?P<port>\d+)/(?P<protocol>tcp|udp|sctp)\s+(?P<state>\S+)\s+(?P<service>\S+)\s*(?P<version>.*)$"
+)
+_NMAP_HOST_INFO = re.compile(
+    r"^(Host is up|Not shown:|All \d+ scanned ports|OS details:|Running|Service Info:"
+    r"|MAC Address:|Device type:|OS CPE:|Aggressive OS guesses:|No exact OS matches"
+    r"|Network Distance:|Uptime guess:|rDNS record for|Other addresses for|Warning:)"
+)
+# the lines that describe the scan rather than the target
+_NMAP_SKIPPED = re.compile(
+    r"^(Starting Nmap|Nmap done:|Stats: |.*Timing: About|PORT\s+STATE\s+SERVICE"
+    r"|Service detection performed|OS detection performed|Read data files from"
+    r"|Some closed ports|Initiating |Completed |Scanning |Discovered open port|NSE: "
+    r"|TCP Sequence Prediction:|IP ID Sequence Generation:|\[filtered \d+ lines)"
+)
+_NMAP_TRACEROUTE_HOP = re.compile(r"^(HOP\s+RTT|\d+\s+(\.\.\.|[\d.]+ ms)\s)")
+_NMAP_VULNERABILITY = re.compile(r"VULNERABLE|CVE-\d{4}-\d+")
+
+
+def _nmap_script_line(line: str) -> str:
+    # e.g. "|_http-title: Login" or "|   State: VULNERABLE"; the nesting is kept
+    content = line[1:]
+    if content.startswith(("_", " ")):
+        content = content[1:]
+    return "  " + content
+
+
+@register_parser("nmap")
+def parse_nmap(text: str) -> Optional[str]:
+    if "Nmap scan report for" not in text and not _NMAP_PORT_HEADER.search(text):
+        return None
+    lines = []
+    # the section of the script lines: "port" of an open port, "closed-port",
+    # "host-scripts", or "traceroute"
+    section = None
+    for line in text.splitlines():
+        line = line.rstrip()
+        if not line.strip():
+            section = None
+            continue
+        report = _NMAP_REPORT.match(line)
+        if report is not None:
+            lines.append(f"Host {report.group('host')}:")
+            section = None
+            continue
+        port = _NMAP_PORT.match(line)
+        if port is not None:
+            if port.group("state") in ("open", "open|filtered"):
+                section = "port"
+                lines.append(
+                    _port_line(
+                        port.group("port"),
+                        port.group("protocol"),
+                        port.group("state"),
+                        port.group("service"),
+                        port.group("version").strip(),
+                    )
+                )
+            else:
+                section = "closed-port"
+            continue
+        if line.startswith("|") and section in ("port", "host-scripts"):
+            # the script output, e.g. "|_http-title: Login" or "| smb-vuln-ms17-010:"
+            lines.append(_nmap_script_line(line))
+            continue
+        if line.startswith("|") and section == "closed-port":
+            continue
+        if line == "Host script results:":
+            lines.append(line)
+            section = "host-scripts"
+            continue
+        if line.startswith("TRACEROUTE"):
+            section = "traceroute"
+            continue
+        if section == "traceroute" and _NMAP_TRACEROUTE_HOP.match(line):
+            continue
+        section = None
+        if _NMAP_HOST_INFO.match(line) or _NMAP_VULNERABILITY.search(line):
+            lines.append(line)
+            continue
+        if _NMAP_SKIPPED.match(line):
+            continue
+        # e.g. a service fingerprint; the LLM summarizes what the parser does not model
+        logger.info(f"The nmap parser does not recognize the line: {line[:80]}")
+        return None
+    return "nmap scan:\n" + "\n".join(lines)
+
+
+_GOBUSTER_RESULT = re.compile(
+    r"^(?P<path>/?\S+)\s+\(Status: (?P<status>\d+)\)\s+\[Size: (?P<size>\d+)\]"
+    r"(?:\s+\[--> (?P<redirect>\S+)\])?"
+)
+_GOBUSTER_DNS = re.compile(r"^Found: (?P<domain>\S+)")
+# the target of the scan in the header, e.g. "[+] Url:   http://10.0.0.5"
+_GOBUSTER_TARGET = re.compile(r"^\[\+\] (?P<key>Url|Domain):\s+(?P<target>\S+)")
+
+
+@register_parser("gobuster")
+def parse_gobuster(text: str) -> Optional[str]:
+    if "Gobuster" not in text and "(Status: " not in text and "Found: " not in text:
+        return None
+    target = None
+    results = []
+    for line in text.splitlines():
+        match = _GOBUSTER_TARGET.match(line.strip())
+        if match is not None and target is None:
+            # the paths and the subdomains found are relative to it
+            target = f"{match.group('key')}: {match.group('target')}"
+            continue
+        match = _GOBUSTER_RESULT.match(line.strip())
+        if match is not None:
+            if match.group("status") == "404":
+                continue
+            result = f"- {match.group('path')} ({match.group('status')}, {match.group('size')} bytes)"
+            if match.group("redirect"):
+                result += f" -> {match.group('redirect')}"
+            results.append(result)
+            continue
+        match = _GOBUSTER_DNS.match(line.strip())
+        if match is not None and "Gobuster" in text:
+            results.append(f"- {match.group('domain')}")
+    if not results:
+        return None
+    lines = [f"gobuster found {len(results)} results:"]
+    if target is not None:
+        lines.append(target)
+    return "\n".join(lines + results)
+
+
+# the nikto lines that describe the scan rather than the target
+_NIKTO_NOISE = re.compile(
+    r"^\+ (Start Time|End Time|\d+ host\(s\) tested|\d+ requests?:|Target Port|No CGI Directories found|Scan terminated)"
+)
+
+
+@register_parser("nikto")
+def parse_nikto(text: str) -> Optional[str]:
+    if "- Nikto v" not in text and "+ Target IP:" not in text:
+        return None
+    lines = []
+    seen = set()
+    for line in text.splitlines():
+        line = line.strip()
+        if not line.startswith("+ ") or _NIKTO_NOISE.match(line) or line in seen:
+            continue
+        seen.add(line)
+        lines.append(line)
+    if not lines:
+        return None
+    return "nikto scan:\n" + "\n".join("- " + line[2:] for line in lines)
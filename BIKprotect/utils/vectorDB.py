@@ -1,12 +1,34 @@
 import os
+import re
 import time
-import uuid
 
-import pinecone
-from langchain.document_loaders import TextLoader
-from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.text_splitter import CharacterTextSplitter
-from langchain.vectorstores import Pinecone
+
+from BIKprotect.utils.embedding_pipeline import EmbeddingPipeline, content_hash
+from BIKprotect.utils.embeddings import embedding_dimension, get_embeddings
+from BIKprotect.utils.vector_store import LocalVectorStore, PineconeVectorStore
+
+_IPV4 = re.compile(
+    r"\b(?:(?:25[0-5]|2[0-4]\d|1?\d?\d)\.){3}(?:25[0-5]|2[0-4]\d|1?\d?\d)\b"
+)
+_PORT = re.compile(r"\b(\d{1,5})/(?:tcp|udp)\b|\bport (\d{1,5})\b", re.IGNORECASE)
+
+
+def extract_targets(text: str) -> dict:
+    """
+    The hosts and ports mentioned in a text, as chunk metadata.
+    :return: {"host": [...], "port": [...]}, without the keys that are not found.
+    """
+    targets = {}
+    hosts = sorted(set(_IPV4.findall(text)))
+    if hosts:
+        targets["host"] = hosts
+    ports = sorted(
+        {int(tcp or port) for tcp, port in _PORT.findall(text)} & set(range(1, 65536))
+    )
+    if ports:
+        targets["port"] = [str(port) for port in ports]
+    return targets
 
 
 class customVectorDB:
@@ -24,20 +46,28 @@ class customVectorDB:
 
     """
 
-    def __init__(self, project_name: str, vectordb_name: str):
+    def __init__(
+        self,
+        project_name: str,
+        vectordb_name: str,
+        backend: str = "pinecone",
+        embeddings=None,
+    ):
         """
         Initialize the vectorDB with the project name.
         :param project_name: the unique identifier for the project. It should be the project name.
         :param file_name: the file name to be stored into the vectorDB. It must be provided for proper initialization.
         :param vectordb_name: the name of the vectorDB. It should be the name of the vectorDB to use.
+        :param backend: "pinecone" for a remote Pinecone index, or "local" for a store on the
+            local disk under `vectordb_directory`, which works offline.
+        :param embeddings: the LangChain Embeddings to use, or the name of one: "openai"
+            (the default), "local", or "local:<sentence-transformers model>". See
+            `BIKprotect.utils.embeddings.get_embeddings`.
         """
         # project name should not be empty
         assert project_name != ""
         self.project_name = project_name
 
-        # load configurations
-        pinecone_api_key = os.getenv("PINECONE_API_KEY", None)
-        os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY", None)
         # save the abs directory of the vectorDB on top of the project directory
         self.vectordb_directory = os.path.join(
             os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
@@ -47,26 +77,25 @@ class customVectorDB:
         if not os.path.exists(self.vectordb_directory):
             os.mkdir(self.vectordb_directory)
 
-        # create a local directory to store the context for reference
-        self.uuid = str(uuid.uuid4())
-        self.local_context_directory = os.path.join(
-            self.vectordb_directory, self.project_name + "_" + self.uuid
-        )
-        if not os.path.exists(self.local_context_directory):
-            os.mkdir(self.local_context_directory)
-
-        pinecone.init(api_key=pinecone_api_key, environment="gcp-starter")
-        # First, check if our index already exists. If it doesn't, we create it
-        if self.project_name not in pinecone.list_indexes():
-            # we create a new index
-            pinecone.create_index(
-                name=self.project_name, metric="cosine", dimension=1536
+        if embeddings is None or isinstance(embeddings, str):
+            embeddings = get_embeddings(embeddings or "openai")
+        self.embeddings = embeddings
+        if backend == "local":
+            self.vectorDB = LocalVectorStore(
+                os.path.join(self.vectordb_directory, self.project_name), embeddings
             )
-        # The OpenAI embedding model `text-embedding-ada-002 uses 1536 dimensions`
-        # upload the first document
-        self.vectorDB = Pinecone.from_existing_index(
-            self.project_name, OpenAIEmbeddings()
-        )
+        elif backend == "pinecone":
+            # the index is created with the dimension of the model, e.g. 1536 for ada-002
+            self.vectorDB = PineconeVectorStore(
+                self.project_name, embeddings, dimension=embedding_dimension(embeddings)
+            )
+        else:
+            raise ValueError(f"Unknown vectorDB backend: {backend}")
+        # the texts are split and embedded in memory; the chunks already stored are skipped,
+        # and the pipeline caches the embeddings it computed
+        self.text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+        self.pipeline = EmbeddingPipeline(embeddings)
+        self.stored_hashes = self.vectorDB.stored_hashes()
 
     def __del__(self):
         """
@@ -75,58 +104,71 @@ class customVectorDB:
         """
         pass
 
-    def _save_text(self, _text: str) -> str:
+    def store_file(self, filename: str, metadata: dict = None) -> int:
         """
-        Handler function that saves everything into the temporary folder.
-        :param _text:
-        :return:
-        """
-        #  save the _text into the local context directory
-        filename = str(uuid.uuid4()) + ".txt"
-        # create the file and write the content
-        with open(os.path.join(self.local_context_directory, filename), "w") as f:
-            f.write(_text)
-        return os.path.join(self.local_context_directory, filename)
-
-    def store_file(self, filename: str, metadata: [dict] = None):
-        """
-        Store the file into the vectorDB. Use `Pinecone.add_texts`
+        Store the file into the vectorDB.
         :param filename: the filename of the file to be stored.
-        :param metadata: the metadata of the file to be stored. It is a list of
-        :return: None
+        :param metadata: the metadata of the file to be stored, see `store_text`.
+        :return: the number of new chunks stored.
         """
-        loader = TextLoader(filename)
-        documents = loader.load()
-        text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-        texts = text_splitter.split_documents(documents)
-        self.vectorDB.add_texts([t.page_content for t in texts])
+        with open(filename, errors="replace") as f:
+            return self.store_text(f.read(), metadata=metadata)
 
-    def store_text(self, content: str, metadata: [dict] = None):
+    def store_text(self, content: str, metadata: dict = None) -> int:
         """
-        Store the text into the vectorDB. Use `Pinecone.add_texts`
+        Store the text into the vectorDB.
         :param content: the text to be stored.
-        :return: None
+        :param metadata: the metadata of every chunk of the text, e.g. {"tool": "nmap",
+            "ptt_node": "1.1"}. The hosts and ports a chunk mentions are added to its
+            metadata, unless given, and so is the time it is stored at. The values may be
+            strings, numbers, or lists of strings.
+        :return: the number of new chunks stored. A chunk already stored is skipped, and
+            keeps its first metadata.
         """
-        filename = self._save_text(content)
-        self.store_file(filename, metadata=metadata)
-
-    def retrieval(self, keyword: str, metadata: [dict] = None) -> [dict]:
+        chunks, hashes = [], []
+        for chunk in self.text_splitter.split_text(content):
+            chunk_hash = content_hash(chunk)
+            if chunk_hash in self.stored_hashes or chunk_hash in hashes:
+                continue
+            chunks.append(chunk)
+            hashes.append(chunk_hash)
+        if not chunks:
+            return 0
+        vectors = self.pipeline.embed_documents(chunks)
+        timestamp = int(time.time())
+        metadatas = [
+            {
+                **extract_targets(chunk),
+                "timestamp": timestamp,
+                **(metadata or {}),
+                "hash": chunk_hash,
+            }
+            for chunk, chunk_hash in zip(chunks, hashes)
+        ]
+        self.vectorDB.add_vectors(vectors, chunks, metadatas=metadatas)
+        self.stored_hashes.update(hashes)
+        return len(chunks)
+
+    def retrieval(self, keyword: str, metadata: dict = None, k: int = 4) -> [dict]:
         """
         Retrieve the information from the vectorDB.
         :param keyword: the keyword to be retrieved.
-        :param metadata: the metadata of the keyword to be retrieved.
+        :param metadata: only the chunks whose metadata match it are retrieved, e.g.
+            {"host": "10.0.0.5", "port": ["80", "443"]}. A list matches any of its values;
+            all the keys must match.
+        :param k: the number of chunks to retrieve.
         :return: the retrieval result.
         """
-
-        # TODO: add retrieval for metadata mapping
-        retrieval_result = self.vectorDB.similarity_search(keyword)
+        retrieval_result = self.vectorDB.similarity_search(
+            keyword, k=k, metadata_filter=metadata
+        )
         # note that to get the response text, use result[i].page_content
         # print("Debug", retrieval_result[0].page_content)
         return retrieval_result
 
     def delete_index(self):
         """
-        Delete the index from the pinecone.
+        Delete the index from the backend.
         :return: None
         """
-        pinecone.delete_index(name=self.project_name)
+        self.vectorDB.delete()
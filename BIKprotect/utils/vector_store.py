@@ -0,0 +1,422 @@
+"""
+The storage backends of `customVectorDB`.
+
+- `LocalVectorStore` keeps the vectors in a memory-mapped float32 matrix on the local disk and
+  answers the queries with a vectorized cosine similarity, so that it works offline and a
+  query costs no network round trip. Once the store grows past `ivf_threshold` vectors, an
+  inverted file (IVF) index narrows each query to the clusters closest to it.
+- `PineconeVectorStore` keeps the vectors in a remote Pinecone index.
+
+Both take a LangChain `Embeddings` object, and return LangChain `Document` objects from
+`similarity_search`, so they are interchangeable. Both filter the search by metadata: the
+filter maps a metadata key to a value, or to a list of values of which any may match, and
+all the keys must match. A metadata value may itself be a list, e.g. the ports of a chunk.
+"""
+
+import json
+import math
+import os
+import shutil
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+import loguru
+import numpy as np
+from langchain.schema import Document
+
+from BIKprotect.utils.embedding_pipeline import content_hash
+
+logger = loguru.logger
+
+VECTOR_FILE = "vectors.f32"
+RECORD_FILE = "records.jsonl"
+META_FILE = "meta.json"
+# the number of vectors per Pinecone upsert request
+PINECONE_UPSERT_BATCH = 100
+# the metadata keys that are not filtered on, as their values are unique
+UNINDEXED_METADATA = {"hash", "timestamp", "score"}
+
+
+def _metadata_values(value) -> List[str]:
+    values = value if isinstance(value, (list, tuple, set)) else [value]
+    return [str(v) for v in values]
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class LocalVectorStore:
+    """
+    Usage:
+        store = LocalVectorStore(directory, OpenAIEmbeddings())
+        store.add_texts(["22/tcp open ssh OpenSSH 8.2p1"])
+        documents = store.similarity_search("ssh service", k=4)
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        embeddings,
+        ivf_threshold: int = 20000,
+        nprobe: int = 8,
+    ):
+        """
+        :param directory: the directory of the store. An existing store is reopened.
+        :param embeddings: the LangChain Embeddings used to embed the texts and the queries.
+        :param ivf_threshold: the number of vectors from which the IVF index is used.
+        :param nprobe: the number of IVF clusters searched by a query.
+        """
+        self.directory = directory
+        self.embeddings = embeddings
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.dimension = None
+        self._count = 0
+        self._capacity = 0
+        self._vectors: Optional[np.memmap] = None
+        self._records: List[dict] = []
+        # the IVF index: the centroids, the rows of each cluster, and the store size it was built at
+        self._centroids: Optional[np.ndarray] = None
+        self._clusters: List[List[int]] = []
+        self._ivf_size = 0
+        # the inverted index of the metadata: (key, value) -> the rows
+        self._inverted: Dict[Tuple[str, str], Set[int]] = defaultdict(set)
+        self._load()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        if not os.path.exists(self._path(META_FILE)):
+            return
+        with open(self._path(META_FILE)) as f:
+            meta = json.load(f)
+        self.dimension = meta["dimension"]
+        # the count is written last, so the vectors and records beyond it are incomplete
+        self._count = meta["count"]
+        size = 0
+        with open(self._path(RECORD_FILE), "rb") as f:
+            for line in f:
+                if len(self._records) == self._count:
+                    break
+                self._records.append(json.loads(line))
+                size += len(line)
+        # drop the incomplete records, so that the next ones are appended after the count
+        if os.path.getsize(self._path(RECORD_FILE)) > size:
+            logger.warning(
+                f"Dropped the records beyond the first {self._count} of {self.directory}"
+            )
+            os.truncate(self._path(RECORD_FILE), size)
+        for row, record in enumerate(self._records):
+            self._index_metadata(row, record["metadata"])
+        self._capacity = os.path.getsize(self._path(VECTOR_FILE)) // (
+            4 * self.dimension
+        )
+        self._open_vectors()
+
+    def _open_vectors(self):
+        self._vectors = np.memmap(
+            self._path(VECTOR_FILE),
+            dtype=np.float32,
+            mode="r+",
+            shape=(self._capacity, self.dimension),
+        )
+
+    def _ensure_capacity(self, size: int):
+        if size <= self._capacity:
+            return
+        # grow geometrically; the file is extended with zeros without copying
+        self._capacity = max(size, 2 * self._capacity, 1024)
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        with open(self._path(VECTOR_FILE), "ab"):
+            pass
+        os.truncate(self._path(VECTOR_FILE), self._capacity * self.dimension * 4)
+        self._open_vectors()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add_texts(self, texts: List[str], metadatas: List[dict] = None) -> List[int]:
+        """
+        Embed the texts and add them to the store.
+        :return: the row ids of the texts.
+        """
+        if not texts:
+            return []
+        vectors = self.embeddings.embed_documents(list(texts))
+        return self.add_vectors(vectors, texts, metadatas)
+
+    def add_vectors(
+        self, vectors, texts: List[str], metadatas: List[dict] = None
+    ) -> List[int]:
+        """
+        Add the embedded texts to the store.
+        :return: the row ids of the texts.
+        """
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        if metadatas is None:
+            metadatas = [{} for _ in texts]
+        with self._lock:
+            if self.dimension is None:
+                self.dimension = vectors.shape[1]
+            elif vectors.shape[1] != self.dimension:
+                raise ValueError(
+                    f"The store holds {self.dimension}-dim vectors, got {vectors.shape[1]}"
+                )
+            start = self._count
+            self._ensure_capacity(start + len(vectors))
+            self._vectors[start : start + len(vectors)] = vectors
+            self._vectors.flush()
+            with open(self._path(RECORD_FILE), "a") as f:
+                for text, metadata in zip(texts, metadatas):
+                    record = {"text": text, "metadata": metadata}
+                    f.write(json.dumps(record) + "\n")
+                    self._index_metadata(len(self._records), metadata)
+                    self._records.append(record)
+            self._count += len(vectors)
+            self._write_meta()
+            if self._centroids is not None:
+                self._assign_to_clusters(vectors, start)
+        return list(range(start, start + len(vectors)))
+
+    def _write_meta(self):
+        # replace the file at once, so that a crash does not leave it half written
+        temp_path = self._path(META_FILE + ".tmp")
+        with open(temp_path, "w") as f:
+            json.dump({"dimension": self.dimension, "count": self._count}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self._path(META_FILE))
+
+    def _index_metadata(self, row: int, metadata: dict):
+        for key, value in metadata.items():
+            if key in UNINDEXED_METADATA:
+                continue
+            for v in _metadata_values(value):
+                self._inverted[(key, v)].add(row)
+
+    def filter_rows(self, metadata_filter: dict) -> np.ndarray:
+        """
+        The rows whose metadata match the filter, from the inverted index.
+        :param metadata_filter: {key: value or list of values}.
+        :return: the sorted rows.
+        """
+        rows = None
+        with self._lock:
+            for key, value in metadata_filter.items():
+                matching = set()
+                for v in _metadata_values(value):
+                    matching |= self._inverted.get((key, v), set())
+                rows = matching if rows is None else rows & matching
+                if not rows:
+                    break
+        return np.array(sorted(rows or ()), dtype=np.int64)
+
+    def stored_hashes(self) -> Set[str]:
+        """
+        The content hashes of the stored texts, see `customVectorDB.store_text`.
+        """
+        return {
+            record["metadata"]["hash"]
+            for record in self._records
+            if "hash" in record["metadata"]
+        }
+
+    def _assign_to_clusters(self, vectors: np.ndarray, start: int):
+        for offset, cluster in enumerate(
+            np.argmax(vectors @ self._centroids.T, axis=1)
+        ):
+            self._clusters[cluster].append(start + offset)
+
+    def _build_ivf(self):
+        """
+        Cluster the vectors with spherical k-means on a sample, and assign all the rows.
+        """
+        vectors = self._vectors[: self._count]
+        nlist = int(math.sqrt(self._count))
+        rng = np.random.default_rng(0)
+        sample = np.array(
+            vectors[
+                np.sort(
+                    rng.choice(self._count, min(self._count, nlist * 40), replace=False)
+                )
+            ]
+        )
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(10):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for cluster in range(nlist):
+                members = sample[assignment == cluster]
+                if len(members):
+                    centroids[cluster] = members.mean(axis=0)
+            centroids = _normalize(centroids)
+        self._centroids = centroids
+        self._clusters = [[] for _ in range(nlist)]
+        # assign the rows in blocks, so that the scores of all the rows are not held at once
+        block_size = 65536
+        for start in range(0, self._count, block_size):
+            self._assign_to_clusters(
+                np.asarray(vectors[start : start + block_size]), start
+            )
+        self._ivf_size = self._count
+        logger.info(f"Built an IVF index of {nlist} clusters on {self._count} vectors")
+
+    def _candidates(self, query: np.ndarray, k: int) -> Optional[np.ndarray]:
+        """
+        The rows to score for the query, or None to score all the rows.
+        """
+        if self._count < self.ivf_threshold:
+            return None
+        # rebuild the index once the store doubled, as the clusters drift
+        if self._centroids is None or self._count >= 2 * self._ivf_size:
+            self._build_ivf()
+        nprobe = min(self.nprobe, len(self._centroids))
+        closest = np.argpartition(-(self._centroids @ query), nprobe - 1)[:nprobe]
+        candidates = np.concatenate(
+            [np.asarray(self._clusters[cluster], dtype=np.int64) for cluster in closest]
+        )
+        return candidates if len(candidates) >= k else None
+
+    def search_by_vector(
+        self, vector, k: int = 4, candidates: np.ndarray = None
+    ) -> List[Tuple[int, float]]:
+        """
+        Find the rows most similar to the vector.
+        :param vector: the query vector.
+        :param k: the number of rows to return.
+        :param candidates: the rows to search; by default, the IVF candidates or all the rows.
+        :return: the (row, cosine similarity) of the closest rows, the closest first.
+        """
+        if self._count == 0:
+            return []
+        query = _normalize(np.asarray(vector, dtype=np.float32))
+        with self._lock:
+            if candidates is None:
+                candidates = self._candidates(query, k)
+            if candidates is None:
+                scores = self._vectors[: self._count] @ query
+                rows = None
+            else:
+                scores = self._vectors[candidates] @ query
+                rows = candidates
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (
+                int(top_index if rows is None else rows[top_index]),
+                float(scores[top_index]),
+            )
+            for top_index in top
+        ]
+
+    def similarity_search(
+        self, query: str, k: int = 4, metadata_filter: dict = None
+    ) -> List[Document]:
+        """
+        :param metadata_filter: only the texts whose metadata match it are searched.
+        """
+        candidates = None
+        if metadata_filter:
+            # the filter is applied before the search, so only the matching rows are scored
+            candidates = self.filter_rows(metadata_filter)
+            if len(candidates) == 0:
+                return []
+        results = self.search_by_vector(
+            self.embeddings.embed_query(query), k, candidates=candidates
+        )
+        return [self.document(row, score) for row, score in results]
+
+    def document(self, row: int, score: float = None) -> Document:
+        record = self._records[row]
+        metadata = dict(record["metadata"])
+        if score is not None:
+            metadata["score"] = score
+        return Document(page_content=record["text"], metadata=metadata)
+
+    def delete(self):
+        """
+        Delete the store from the disk.
+        """
+        with self._lock:
+            self._vectors = None
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self._records, self._count, self._capacity = [], 0, 0
+            self._inverted.clear()
+            self.dimension, self._centroids = None, None
+
+
+class PineconeVectorStore:
+    """
+    The vectors are stored in a remote Pinecone index, one index per project.
+    """
+
+    def __init__(self, index_name: str, embeddings, dimension: int = 1536):
+        """
+        :param index_name: the name of the Pinecone index. It is created if it does not exist.
+        :param embeddings: the LangChain Embeddings used to embed the texts and the queries.
+        :param dimension: the dimension of the embeddings.
+        """
+        # imported here, so that the local store works without the Pinecone client
+        import pinecone
+        from langchain.vectorstores import Pinecone
+
+        self.index_name = index_name
+        self.embeddings = embeddings
+        self._pinecone = pinecone
+        pinecone.init(
+            api_key=os.getenv("PINECONE_API_KEY", None), environment="gcp-starter"
+        )
+        # First, check if our index already exists. If it doesn't, we create it
+        if index_name not in pinecone.list_indexes():
+            pinecone.create_index(name=index_name, metric="cosine", dimension=dimension)
+        self.vectorDB = Pinecone.from_existing_index(index_name, embeddings)
+
+    def add_texts(self, texts: List[str], metadatas: List[dict] = None):
+        return self.vectorDB.add_texts(texts, metadatas=metadatas)
+
+    def add_vectors(self, vectors, texts: List[str], metadatas: List[dict] = None):
+        """
+        Upsert the embedded texts. The ids are the content hashes, when given in the
+        metadata, so that storing a text again overwrites it instead of duplicating it.
+        """
+        if metadatas is None:
+            metadatas = [{} for _ in texts]
+        records = []
+        for vector, text, metadata in zip(vectors, texts, metadatas):
+            record_id = metadata.get("hash") or content_hash(text)
+            # the LangChain Pinecone store reads the text from the metadata
+            records.append((record_id, list(vector), {**metadata, "text": text}))
+        for start in range(0, len(records), PINECONE_UPSERT_BATCH):
+            self.vectorDB._index.upsert(
+                vectors=records[start : start + PINECONE_UPSERT_BATCH]
+            )
+        return [record[0] for record in records]
+
+    def stored_hashes(self) -> Set[str]:
+        # a remote index is not listed; the upserts by hash keep it free of duplicates
+        return set()
+
+    def similarity_search(
+        self, query: str, k: int = 4, metadata_filter: dict = None
+    ) -> List[Document]:
+        pinecone_filter = None
+        if metadata_filter:
+            # $in matches a list-valued field if any of its elements is in the list
+            pinecone_filter = {
+                key: {"$in": _metadata_values(value)}
+                for key, value in metadata_filter.items()
+            }
+        return self.vectorDB.similarity_search(query, k=k, filter=pinecone_filter)
+
+    def delete(self):
+        self._pinecone.delete_index(name=self.index_name)
@@ -0,0 +1,220 @@
+"""
+An in-process fake of the OpenAI chat completion API, to benchmark BIKprotect without a key.
+
+The server answers `POST .../chat/completions` with the reply of a responder function, after
+a configurable latency. It supports streamed responses (server-sent events), and it can
+reject every n-th request with a 429 and a `Retry-After` header to exercise the retry path.
+Every request is recorded, with its token counts, so that the cost of a run can be measured.
+
+Usage:
+    with MockOpenAIServer(latency=0.2) as server:
+        client = OpenAI(base_url=server.base_url, api_key="mock")
+        ...
+        print(server.stats())
+"""
+
+import dataclasses
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List
+
+from BIKprotect.utils.llm_api import count_text_tokens
+
+Responder = Callable[[List[Dict]], str]
+
+
+def echo_responder(messages: List[Dict]) -> str:
+    return "echo: " + str(messages[-1]["content"])
+
+
+@dataclasses.dataclass
+class RequestRecord:
+    start: float
+    end: float = None
+    status: int = 200
+    stream: bool = False
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "MockOpenAIServer"
+
+    def log_message(self, format, *args):
+        pass  # the requests are recorded instead
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if not self.path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        record = self.server.record_request(stream=bool(body.get("stream")))
+        if self.server.should_rate_limit():
+            record.status = 429
+            retry_after_ms = int(self.server.retry_after * 1000)
+            self._send_json(
+                429,
+                {
+                    "error": {
+                        "message": "Rate limit reached (mock server)",
+                        "type": "requests",
+                        "code": "rate_limit_exceeded",
+                    }
+                },
+                headers={
+                    "retry-after-ms": str(retry_after_ms),
+                    "retry-after": str(max(1, retry_after_ms // 1000)),
+                },
+            )
+            record.end = time.time()
+            return
+        messages = body.get("messages", [])
+        content = self.server.responder(messages)
+        record.prompt_tokens = sum(
+            count_text_tokens(str(message.get("content", ""))) + 4
+            for message in messages
+        )
+        record.completion_tokens = count_text_tokens(content)
+        time.sleep(self.server.latency)
+        if record.stream:
+            self._send_stream(body.get("model"), content)
+        else:
+            self._send_json(200, self._completion(body.get("model"), content, record))
+        record.end = time.time()
+
+    @staticmethod
+    def _completion(model, content, record: RequestRecord) -> dict:
+        return {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": record.prompt_tokens,
+                "completion_tokens": record.completion_tokens,
+                "total_tokens": record.prompt_tokens + record.completion_tokens,
+            },
+        }
+
+    def _send_json(self, status: int, payload: dict, headers: Dict[str, str] = None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, model, content: str):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        # the stream ends when the connection is closed
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        # one chunk per word, as the real API sends about one token per chunk
+        words = content.split(" ")
+        for i, word in enumerate(words):
+            delta = word if i == 0 else " " + word
+            chunk = {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {"index": 0, "delta": {"content": delta}, "finish_reason": None}
+                ],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(self.server.stream_chunk_delay)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        responder: Responder = echo_responder,
+        latency: float = 0.0,
+        stream_chunk_delay: float = 0.0,
+        rate_limit_every: int = 0,
+        retry_after: float = 0.05,
+    ):
+        """
+        :param responder: returns the reply to the messages of a request.
+        :param latency: the delay before a response is sent, in seconds.
+        :param stream_chunk_delay: the delay between the chunks of a streamed response.
+        :param rate_limit_every: reject every n-th request with a 429; 0 disables it.
+        :param retry_after: the delay requested by the 429 responses, in seconds.
+        """
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.responder = responder
+        self.latency = latency
+        self.stream_chunk_delay = stream_chunk_delay
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.requests: List[RequestRecord] = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def record_request(self, stream: bool) -> RequestRecord:
+        record = RequestRecord(start=time.time(), stream=stream)
+        with self._lock:
+            self.requests.append(record)
+        return record
+
+    def should_rate_limit(self) -> bool:
+        if not self.rate_limit_every:
+            return False
+        with self._lock:
+            return len(self.requests) % self.rate_limit_every == 0
+
+    def stats(self, since: int = 0) -> Dict[str, int]:
+        """
+        Sum up the requests received after the first `since` requests.
+        """
+        with self._lock:
+            requests = self.requests[since:]
+        completed = [record for record in requests if record.status == 200]
+        return {
+            "requests": len(requests),
+            "rate_limited": len(requests) - len(completed),
+            "prompt_tokens": sum(record.prompt_tokens for record in completed),
+            "completion_tokens": sum(record.completion_tokens for record in completed),
+        }
+
+    def start(self) -> "MockOpenAIServer":
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="mock-openai", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> "MockOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,292 @@
+"""
+Replay a recorded BIKprotect session against the mock OpenAI server, and report the latency
+and the token cost of each step.
+
+The inputs of the session (the task description and the tool outputs of the `next` steps)
+are read from a log saved by BIKprotect. The default is
+`benchmarks/fixtures/multi_step_session_log.txt`, a recorded test of seven steps with nmap,
+gobuster, nikto, web page, FTP and comment inputs. Each step runs the input through
+`input_parsing_handler`, `reasoning_handler` and `test_generation_handler`, as `next`
+followed by `more` does, within the same status display. With `--stream`, the responses are
+streamed and rendered as in an interactive session. The mock server answers with the
+responses recorded in the log, in the formats the prompts request.
+
+Usage:
+    python -m benchmarks.replay_session --latency 0.2 --repeat 5
+    python -m benchmarks.replay_session --log logs/sample_BIKprotect_log.txt --stream
+"""
+
+import argparse
+import dataclasses
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+from benchmarks.mock_openai_server import MockOpenAIServer
+
+DEFAULT_SESSION_LOG = os.path.join(
+    os.path.dirname(__file__), "fixtures", "multi_step_session_log.txt"
+)
+
+
+def load_session(log_path: str) -> Tuple[str, List[Tuple[str, str]]]:
+    """
+    Read the inputs of a recorded session.
+    :return: the task description, and the (source, text) of the `next` steps.
+    """
+    with open(log_path) as f:
+        history = json.load(f)
+    task_description = history["user"][0][1]
+    steps = []
+    # the inputs are logged as "Source: <source>\n<text>", under "user" in the current
+    # format and under "exception" in older logs
+    entries = sorted(
+        itertools.chain.from_iterable(history.values()), key=lambda entry: entry[0]
+    )
+    for _, text in entries:
+        if not text.startswith("Source: "):
+            continue
+        source, _, content = text[len("Source: ") :].partition("\n")
+        if content.startswith("File: "):
+            path = content[len("File: ") :].strip()
+            if not os.path.exists(path):
+                continue
+            with open(path, errors="replace") as f:
+                content = f.read()
+        steps.append((source.strip(), content))
+    return task_description, steps
+
+
+class SessionResponder:
+    """
+    Answer the requests of the three sessions with the responses recorded in the log.
+    The reasoning replies follow the format requested by the prompt (PTT edits, sections).
+    """
+
+    def __init__(self, log_path: str):
+        from BIKprotect.prompts.prompt_class import BIKprotectPrompt
+
+        with open(log_path) as f:
+            history = json.load(f)
+        self.prompts = BIKprotectPrompt
+        self.recorded = {
+            source: itertools.cycle(
+                [text for _, text in history.get(source, [])] or ["OK"]
+            )
+            for source in ("reasoning", "generation", "input_parsing")
+        }
+
+    def _session(self, messages: List[Dict]) -> str:
+        contents = [str(message.get("content", "")) for message in messages]
+        for prompt, session in (
+            (self.prompts.reasoning_session_init, "reasoning"),
+            (self.prompts.generation_session_init, "generation"),
+            (self.prompts.input_parsing_init, "input_parsing"),
+        ):
+            if prompt in contents:
+                return session
+        # the stateless chunk summaries of the map-reduce parsing
+        return "input_parsing"
+
+    def __call__(self, messages: List[Dict]) -> str:
+        request = str(messages[-1].get("content", ""))
+        if request in (
+            self.prompts.reasoning_session_init,
+            self.prompts.generation_session_init,
+            self.prompts.input_parsing_init,
+        ):
+            return "Understood. I am ready to help."
+        session = self._session(messages)
+        response = next(self.recorded[session])
+        if session != "reasoning":
+            return response
+        if "Reply only with the edits to the PTT" in request:
+            ptt_revision = "NO CHANGE"
+        else:
+            ptt_revision = response
+        if "=== NEXT TASK ===" in request:
+            next_task = response.strip().split("\n\n")[-1]
+            return f"=== PTT ===\n{ptt_revision}\n=== NEXT TASK ===\n{next_task}"
+        return ptt_revision
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    The q-th percentile (0-100) of the values, by the nearest-rank method.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(q / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+@dataclasses.dataclass
+class StepResult:
+    latencies: Dict[str, float]  # the seconds spent in each handler
+    requests: int  # the completed API calls
+    rate_limited: int
+    prompt_tokens: int
+    completion_tokens: int
+
+    @property
+    def total_latency(self) -> float:
+        return sum(self.latencies.values())
+
+
+def _timed(latencies: Dict[str, float], name: str, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    latencies[name] = time.perf_counter() - start
+    return result
+
+
+def run_step(handler, server: MockOpenAIServer, source: str, text: str) -> StepResult:
+    since = len(server.requests)
+    latencies = {}
+    # the handlers stream through the printer of the status, as in `_next_step`
+    with handler._status("[bold green] Replaying..."):
+        parsed = _timed(
+            latencies,
+            "input_parsing",
+            handler.input_parsing_handler,
+            text,
+            source,
+            handler._input_needs_summary(text),
+        )
+        reasoning = _timed(latencies, "reasoning", handler.reasoning_handler, parsed)
+        _timed(latencies, "generation", handler.test_generation_handler, reasoning)
+    stats = server.stats(since)
+    return StepResult(
+        latencies=latencies,
+        requests=stats["requests"] - stats["rate_limited"],
+        rate_limited=stats["rate_limited"],
+        prompt_tokens=stats["prompt_tokens"],
+        completion_tokens=stats["completion_tokens"],
+    )
+
+
+def build_handler(server: MockOpenAIServer, args, log_dir: str):
+    """
+    Create a BIKprotect instance whose models are served by the mock server.
+    """
+    os.environ.setdefault("OPENAI_API_KEY", "mock-key")
+    from BIKprotect.utils.APIs import module_import
+    from BIKprotect.utils.BIKprotect_gpt import BIKprotect
+
+    for model in (args.reasoning_model, args.parsing_model):
+        config_class = getattr(
+            module_import, module_import.module_mapping[model]["config_name"]
+        )
+        config_class.api_base = server.base_url
+    return BIKprotect(
+        log_dir=log_dir,
+        reasoning_model=args.reasoning_model,
+        parsing_model=args.parsing_model,
+        parsing_mode=args.parsing_mode,
+        stream=args.stream,
+        ptt_mode=args.ptt_mode,
+        reasoning_mode=args.reasoning_mode,
+        local_parsers=not args.no_local_parsers,
+    )
+
+
+def format_report(init_latency: float, results: List[StepResult]) -> str:
+    lines = [f"session initialization: {init_latency:.3f}s", ""]
+    lines.append(f"{'':<16}{'p50':>10}{'p95':>10}")
+    for name in ("input_parsing", "reasoning", "generation"):
+        values = [result.latencies[name] for result in results]
+        lines.append(
+            f"{name:<16}{percentile(values, 50):>9.3f}s{percentile(values, 95):>9.3f}s"
+        )
+    values = [result.total_latency for result in results]
+    lines.append(
+        f"{'step':<16}{percentile(values, 50):>9.3f}s{percentile(values, 95):>9.3f}s"
+    )
+    steps = len(results)
+    lines += [
+        "",
+        f"steps: {steps}",
+        f"calls per step: {sum(r.requests for r in results) / steps:.2f}"
+        f" ({sum(r.rate_limited for r in results)} rate limited in total)",
+        f"prompt tokens per step: {sum(r.prompt_tokens for r in results) / steps:.0f}",
+        f"completion tokens per step: {sum(r.completion_tokens for r in results) / steps:.0f}",
+    ]
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--log", type=str, default=DEFAULT_SESSION_LOG)
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="replay the steps this many times"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.1, help="the response latency in seconds"
+    )
+    parser.add_argument(
+        "--stream_chunk_delay",
+        type=float,
+        default=0.0,
+        help="the delay between the chunks of a streamed response in seconds",
+    )
+    parser.add_argument(
+        "--rate_limit_every",
+        type=int,
+        default=0,
+        help="reject every n-th request with a 429; 0 disables it",
+    )
+    parser.add_argument("--retry_after", type=float, default=0.05)
+    parser.add_argument("--reasoning_model", type=str, default="gpt-4-turbo")
+    parser.add_argument("--parsing_model", type=str, default="gpt-4-turbo")
+    parser.add_argument("--parsing_mode", type=str, default="map-reduce")
+    parser.add_argument("--ptt_mode", type=str, default="diff")
+    parser.add_argument("--reasoning_mode", type=str, default="single")
+    parser.add_argument("--stream", action="store_true", default=False)
+    parser.add_argument("--no_local_parsers", action="store_true", default=False)
+    parser.add_argument(
+        "--json", type=str, default=None, help="also write the results to this file"
+    )
+    args = parser.parse_args()
+
+    task_description, steps = load_session(args.log)
+    if not steps:
+        sys.exit(f"No `next` step is recorded in {args.log}")
+    server = MockOpenAIServer(
+        responder=SessionResponder(args.log),
+        latency=args.latency,
+        stream_chunk_delay=args.stream_chunk_delay,
+        rate_limit_every=args.rate_limit_every,
+        retry_after=args.retry_after,
+    )
+    with server, tempfile.TemporaryDirectory() as log_dir:
+        handler = build_handler(server, args, log_dir)
+        start = time.perf_counter()
+        handler.initialize(init_description=task_description)
+        init_latency = time.perf_counter() - start
+        results = [
+            run_step(handler, server, source, text)
+            for _ in range(args.repeat)
+            for source, text in steps
+        ]
+    report = format_report(init_latency, results)
+    print("\n" + report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "args": vars(args),
+                    "init_latency": init_latency,
+                    "steps": [dataclasses.asdict(result) for result in results],
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,744 @@
+import asyncio
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+from typing import Dict, List
+
+import httpx
+
+from BIKprotect.utils import llm_api
+from BIKprotect.utils.APIs import client_pool
+from BIKprotect.utils.APIs.module_import import ModelCapabilities, capabilities_for
+from BIKprotect.utils.compression import compress_text
+from BIKprotect.utils.context_manager import ContextManager
+from BIKprotect.utils.conversation_store import ConversationStore
+from BIKprotect.utils.llm_api import LLMAPI, Conversation
+from BIKprotect.utils.llm_cache import LLMResponseCache
+from BIKprotect.utils.llm_worker import (
+    LLMWorker,
+    RequestCancelled,
+    check_cancelled,
+    with_cancel_token,
+)
+from BIKprotect.utils.prefetch import PrefetchBudget, Prefetcher
+from BIKprotect.utils.rate_limiter import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_INTERACTIVE,
+    RateLimit,
+    RequestScheduler,
+)
+
+
+class EchoAPI(LLMAPI):
+    """
+    A local backend that echoes the latest message, so that no API key is required.
+    """
+
+    def __init__(self):
+        self.name = "echo"
+        self.model = "gpt-4"
+        self.log_dir = "logs"
+        self.history_length = 5
+        self.conversation_dict: Dict[str, Conversation] = {}
+
+    def _chat_completion(self, history: List, **kwargs) -> str:
+        return "echo: " + history[-1]["content"]
+
+
+class TestTokenLedger(unittest.TestCase):
+    def test_encoder_is_cached(self):
+        self.assertIs(llm_api.get_encoder("gpt-4"), llm_api.get_encoder("gpt-4"))
+
+    def test_ledger_matches_full_count(self):
+        api = EchoAPI()
+        _, conversation_id = api.send_new_message("hello, this is the init prompt")
+        for i in range(3):
+            api.send_message(f"message number {i}", conversation_id)
+        conversation = api.conversation_dict[conversation_id]
+        self.assertEqual(len(conversation.message_list), 4)
+        expected = sum(
+            api._count_message_tokens(m.ask) + api._count_message_tokens(m.answer)
+            for m in conversation.message_list
+        )
+        self.assertEqual(conversation.token_count, expected)
+        self.assertEqual(
+            conversation.window_token_count(2),
+            sum(m.token_count for m in conversation.message_list[-2:]),
+        )
+
+
+class TestContextManager(unittest.TestCase):
+    def test_budget_follows_capabilities(self):
+        api = EchoAPI()
+        api.capabilities = ModelCapabilities(context_window=128000, max_output=4096)
+        self.assertEqual(api.context_manager.budget, 123904)
+        history = [{"role": "user", "content": "the latest message"}]
+        self.assertEqual(
+            api._token_compression(history, num_tokens=100000), "the latest message"
+        )
+        # nothing to compress locally, and the message itself fits in the budget
+        self.assertEqual(
+            api._token_compression(history, num_tokens=130000), "the latest message"
+        )
+
+    def test_budget_of_a_model_without_capabilities(self):
+        api = EchoAPI()
+        api.name = "gpt-4o-2024-05-13"  # the model of the GPT4O config class
+        self.assertEqual(api.context_manager.budget, 123904)
+        self.assertEqual(capabilities_for("gpt-4-o").context_window, 128000)
+        self.assertIsNone(capabilities_for("echo"))
+
+    def test_history_is_packed_by_budget(self):
+        api = EchoAPI()
+        api.history_length = 10
+        api._context_manager = ContextManager(context_window=1200)
+        _, conversation_id = api.send_new_message("the session init prompt")
+        ptt = "1. Reconnaissance - (completed)\n1.1 Port scan - (to-do)"
+        api.send_message(ptt, conversation_id)
+        for i in range(6):
+            api.send_message(f"tool output {i} " + "word " * 100, conversation_id)
+        conversation = api.conversation_dict[conversation_id]
+        # the PTT message is found when it is recorded, not by scanning the history
+        self.assertEqual(conversation.ptt_index, 1)
+        chat_message, num_tokens = api._build_chat_message(
+            conversation, [{"role": "user", "content": "next"}]
+        )
+        contents = [message["content"] for message in chat_message]
+        self.assertEqual(contents[1], "the session init prompt")
+        self.assertIn(ptt, contents)
+        self.assertIn("earlier messages are omitted", contents[5])
+        self.assertIn("echo: tool output 5 " + "word " * 100, contents)
+        self.assertNotIn("tool output 0 " + "word " * 100, contents)
+        self.assertLessEqual(num_tokens, api.context_manager.budget)
+        self.assertEqual(num_tokens, api._count_token(chat_message))
+
+
+class SlowEchoAPI(EchoAPI):
+    def _chat_completion(self, history: List, **kwargs) -> str:
+        time.sleep(0.2)
+        return super()._chat_completion(history, **kwargs)
+
+
+class TestAsyncAPI(unittest.TestCase):
+    def test_new_sessions_run_concurrently(self):
+        agents = [SlowEchoAPI() for _ in range(3)]
+
+        async def start_all():
+            return await asyncio.gather(
+                *(agent.asend_new_message("init") for agent in agents)
+            )
+
+        start_time = time.time()
+        results = asyncio.run(start_all())
+        self.assertLess(time.time() - start_time, 0.5)
+        for agent, (response, conversation_id) in zip(agents, results):
+            self.assertEqual(response, "echo: init")
+            self.assertIn(conversation_id, agent.conversation_dict)
+
+    def test_asend_message_updates_conversation(self):
+        api = EchoAPI()
+        _, conversation_id = api.send_new_message("init")
+        response = asyncio.run(api.asend_message("hello", conversation_id))
+        self.assertEqual(response, "echo: hello")
+        self.assertEqual(len(api.conversation_dict[conversation_id].message_list), 2)
+
+    def test_async_clients_are_closed_with_their_loop(self):
+        async def use_clients():
+            client = client_pool.get_async_openai_client("http://localhost/v1", "key")
+            azure_client = client_pool.get_async_azure_openai_client(
+                "https://example.openai.azure.com", "key", "2024-02-01"
+            )
+            http_client = client_pool.get_async_http_client()
+            # the clients of a loop are shared
+            self.assertIs(
+                client,
+                client_pool.get_async_openai_client("http://localhost/v1", "key"),
+            )
+            self.assertIs(azure_client._client, http_client)
+            await client_pool.aclose_async_clients()
+            self.assertNotIn(asyncio.get_running_loop(), client_pool._async_clients)
+            return http_client
+
+        self.assertTrue(asyncio.run(use_clients()).is_closed)
+
+
+class TestClientPool(unittest.TestCase):
+    def make_agent(self, model: str, api_base: str, proxies: dict = None):
+        from BIKprotect.utils.APIs.chatgpt_api import ChatGPTAPI
+
+        class Config:
+            error_wait_time = 0
+            log_dir = self.log_dir.name
+
+        Config.model, Config.api_base = model, api_base
+        if proxies is not None:
+            Config.proxies = proxies
+        with unittest.mock.patch.dict(os.environ, {"OPENAI_API_KEY": "pool-key"}):
+            return ChatGPTAPI(Config)
+
+    def setUp(self):
+        self.log_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.log_dir.cleanup()
+
+    def test_agents_share_the_sync_client(self):
+        api_base = "http://localhost:9/v1"
+        reasoning, generation, parsing = (
+            self.make_agent(model, api_base)
+            for model in ["gpt-4o", "gpt-4o-mini", "gpt-3.5-turbo-16k"]
+        )
+        self.assertIs(reasoning.client, generation.client)
+        self.assertIs(reasoning.client, parsing.client)
+        self.assertIs(reasoning.client._client, client_pool.get_http_client())
+        # another host gets its own client on the same connection pool
+        other = self.make_agent("gpt-4o", "http://localhost:10/v1")
+        self.assertIsNot(other.client, reasoning.client)
+        self.assertIs(other.client._client, reasoning.client._client)
+
+    def test_proxies_of_the_config_are_used(self):
+        api_base = "http://localhost:9/v1"
+        proxies = {"http": "", "https": "http://127.0.0.1:3128"}
+        proxied = self.make_agent("gpt-4o", api_base, proxies)
+        self.assertIsNot(proxied.client, self.make_agent("gpt-4o", api_base).client)
+        # the empty proxies of the default config are not used
+        direct = self.make_agent("gpt-4o", api_base, {"http": "", "https": ""})
+        self.assertIs(direct.client._client, client_pool.get_http_client())
+        mounts = {
+            pattern.pattern: transport
+            for pattern, transport in proxied.client._client._mounts.items()
+        }
+        self.assertIsInstance(mounts["https://"], httpx.HTTPTransport)
+        self.assertNotIn("http://", mounts)
+
+
+class TestLLMWorker(unittest.TestCase):
+    def test_cancel_aborts_the_job(self):
+        api = SlowEchoAPI()
+        _, conversation_id = api.send_new_message("init")
+        worker = LLMWorker()
+
+        def job():
+            for i in range(10):
+                api.send_message(f"message {i}", conversation_id)
+
+        running = worker.submit(job, description="slow job")
+        queued = worker.submit(job, description="queued job")
+        time.sleep(0.3)
+        self.assertEqual(worker.cancel_all(), 2)
+        self.assertIsInstance(running.future.exception(timeout=1), RequestCancelled)
+        self.assertTrue(queued.future.cancelled())
+        # the request in flight is discarded, and the next ones are not sent
+        self.assertLess(len(api.conversation_dict[conversation_id].message_list), 4)
+        self.assertEqual(worker.pending_jobs, 0)
+
+    def test_cancel_only_affects_the_job_and_its_helpers(self):
+        worker = LLMWorker()
+        started, release = threading.Event(), threading.Event()
+        helper_results = []
+
+        def helper():
+            try:
+                check_cancelled()
+                helper_results.append("ran")
+            except RequestCancelled:
+                helper_results.append("cancelled")
+
+        def job():
+            started.set()
+            release.wait(timeout=5)
+            bound = with_cancel_token(helper)
+            threads = [threading.Thread(target=bound), threading.Thread(target=helper)]
+            for thread in threads:
+                thread.start()
+                thread.join()
+            check_cancelled()
+
+        running = worker.submit(job, description="blocked job")
+        started.wait(timeout=1)
+        worker.cancel_all()
+        # the requests of the other threads go on
+        check_cancelled()
+        release.set()
+        self.assertIsInstance(running.future.exception(timeout=1), RequestCancelled)
+        self.assertEqual(helper_results, ["cancelled", "ran"])
+
+
+class StreamingEchoAPI(EchoAPI):
+    def _chat_completion_stream(self, history: List, **kwargs):
+        for word in self._chat_completion(history).split(" "):
+            yield word + " "
+
+
+class TestStreaming(unittest.TestCase):
+    def test_stream_handler_receives_chunks(self):
+        api = StreamingEchoAPI()
+        _, conversation_id = api.send_new_message("init")
+        chunks = []
+        response = api.send_message(
+            "hello world", conversation_id, stream_handler=chunks.append
+        )
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual("".join(chunks), response)
+        last_message = api.conversation_dict[conversation_id].message_list[-1]
+        self.assertEqual(last_message.answer[0]["content"], response)
+
+
+class CountingEchoAPI(EchoAPI):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def _chat_completion(self, history: List, **kwargs) -> str:
+        self.calls += 1
+        return super()._chat_completion(history, **kwargs)
+
+
+class TestCompression(unittest.TestCase):
+    def test_local_compression(self):
+        trace = "Traceback (most recent call last):\n" + "".join(
+            f'  File "app.py", line {i}, in handler\n    call()\n' for i in range(20)
+        )
+        hex_dump = "".join(
+            f"{i * 16:08x}: 4142 4344 4546 4748 494a 4b4c 4d4e 4f50  ABCDEFGHIJKLMNOP\n"
+            for i in range(50)
+        )
+        text = (
+            "PORT     STATE  SERVICE\n"
+            + trace
+            + "\n\n\n"
+            + hex_dump
+            + "key: "
+            + "ab" * 500
+        )
+        compressed = compress_text(text)
+        self.assertIn("PORT STATE SERVICE", compressed)
+        # the frames kept at both ends of the trace
+        self.assertEqual(compressed.count("call()"), 4)
+        self.assertIn("[... 32 stack trace lines omitted ...]", compressed)
+        self.assertIn("[... 46 hex dump lines omitted ...]", compressed)
+        self.assertIn("...[1000 chars]", compressed)
+        self.assertNotIn("\n\n\n", compressed)
+
+    def test_repeated_lines_of_several_hosts_are_kept(self):
+        text = (
+            "Nmap scan report for 10.0.0.5\n22/tcp open ssh\n22/tcp open ssh\n"
+            "Nmap scan report for 10.0.0.6\n22/tcp open ssh\n"
+        )
+        self.assertEqual(
+            compress_text(text),
+            "Nmap scan report for 10.0.0.5\n22/tcp open ssh\n"
+            "Nmap scan report for 10.0.0.6\n22/tcp open ssh",
+        )
+
+    def test_request_is_compressed_before_sending(self):
+        api = CountingEchoAPI()
+        api._context_manager = ContextManager(context_window=400)
+        _, conversation_id = api.send_new_message("init")
+        message = "\n".join(["Not Found: /admin"] * 300 + ["Found: /login"])
+        response = api.send_message(message, conversation_id)
+        self.assertEqual(response, "echo: Not Found: /admin\nFound: /login")
+        self.assertEqual(api.calls, 2)
+        # the conversation keeps the original message
+        recorded = api.conversation_dict[conversation_id].message_list[-1]
+        self.assertEqual(recorded.ask[-1]["content"], message)
+
+    def test_llm_summary_includes_the_message(self):
+        api = CountingEchoAPI()
+        api._context_manager = ContextManager(context_window=400)
+        _, conversation_id = api.send_new_message("init")
+        message = " ".join(f"word{i}" for i in range(1000))
+        response = api.send_message(message, conversation_id)
+        # the summary request is echoed, and the echo is sent as the compressed message
+        self.assertEqual(api.calls, 3)
+        self.assertIn("The message is:", response)
+        self.assertIn("word0", response)
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "llm_cache.sqlite3")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_identical_requests_hit_the_cache(self):
+        cache = LLMResponseCache(self.db_path)
+        api = CountingEchoAPI()
+        api.enable_response_cache(cache)
+        first = api.send_stateless_message("scan results")
+        second = api.send_stateless_message("scan results \r\n")
+        self.assertEqual(first, second)
+        self.assertEqual(api.calls, 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.close()
+
+    def test_gemini_requests_go_through_the_cache(self):
+        from BIKprotect.config.chat_config import GeminiConfig
+        from BIKprotect.utils.APIs.gemini_api import GeminiAPI
+
+        class FakeChat:
+            def __init__(self, model, history):
+                self.model = model
+                self.history = history
+
+            def send_message(self, message, **kwargs):
+                self.model.requests.append((message, self.history))
+                return unittest.mock.Mock(text="echo: " + message)
+
+        class FakeGeminiModel:
+            def __init__(self):
+                self.requests = []
+
+            def start_chat(self, history):
+                return FakeChat(self, history)
+
+        with unittest.mock.patch.dict(os.environ, {"GOOGLE_API_KEY": "key"}):
+            api = GeminiAPI(GeminiConfig(log_dir=self.tmp_dir.name))
+        api.model = FakeGeminiModel()
+        cache = LLMResponseCache(self.db_path)
+        api.enable_response_cache(cache)
+        _, conversation_id = api.send_new_message("init")
+        self.assertEqual(api.send_message("scan", conversation_id), "echo: scan")
+        self.assertEqual(api.send_new_message("init")[0], "echo: init")
+        self.assertEqual(len(api.model.requests), 2)
+        # the history is converted to alternating Gemini turns
+        message, history = api.model.requests[1]
+        self.assertEqual(message, "scan")
+        self.assertEqual(
+            [turn["role"] for turn in history], ["user", "model", "user", "model"]
+        )
+        self.assertEqual(history[-1]["parts"]["text"], "echo: init")
+        cache.close()
+
+    def test_eviction(self):
+        cache = LLMResponseCache(self.db_path, max_entries=2)
+        for i in range(3):
+            cache.put(f"key-{i}", f"response-{i}")
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("key-0"))
+        cache.max_age = 0
+        self.assertIsNone(cache.get("key-2"))
+        cache.evict()
+        self.assertEqual(len(cache), 0)
+        cache.close()
+
+
+class TestConversationStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _record_session(self):
+        store = ConversationStore(self.tmp_dir.name)
+        api = EchoAPI()
+        api.enable_conversation_store(store)
+        _, conversation_id = api.send_new_message("init")
+        for i in range(3):
+            api.send_message(f"message {i}", conversation_id)
+        store.close()
+        return conversation_id, api.conversation_dict[conversation_id]
+
+    def test_resume_conversation(self):
+        conversation_id, original = self._record_session()
+        store = ConversationStore(self.tmp_dir.name)
+        api = EchoAPI()
+        api.enable_conversation_store(store)
+        self.assertFalse(api.load_conversation("unknown"))
+        self.assertTrue(api.load_conversation(conversation_id))
+        resumed = api.conversation_dict[conversation_id]
+        self.assertEqual(resumed.token_count, original.token_count)
+        self.assertEqual(list(resumed.message_list), original.message_list)
+        # the resumed conversation continues with its history
+        api.send_message("message 3", conversation_id)
+        self.assertEqual(len(resumed.message_list), 5)
+        store.close()
+
+    def test_ptt_index_is_resumed_from_the_index(self):
+        store = ConversationStore(self.tmp_dir.name)
+        api = EchoAPI()
+        api.enable_conversation_store(store)
+        _, conversation_id = api.send_new_message("init")
+        api.send_message(
+            "1. Recon - (completed)\n1.1 Port scan - (to-do)", conversation_id
+        )
+        api.send_message("message", conversation_id)
+        store.close()
+        for rebuild in (False, True):
+            if rebuild:
+                os.remove(os.path.join(self.tmp_dir.name, ConversationStore.index_file))
+            store = ConversationStore(self.tmp_dir.name)
+            resumed = store.load(conversation_id)
+            self.assertEqual(resumed.ptt_index, 1)
+            # no message is read from the disk to find it
+            self.assertEqual(len(resumed.message_list._cache), 0)
+            store.close()
+
+    def test_index_is_rebuilt(self):
+        conversation_id, original = self._record_session()
+        os.remove(os.path.join(self.tmp_dir.name, ConversationStore.index_file))
+        store = ConversationStore(self.tmp_dir.name)
+        resumed = store.load(conversation_id)
+        self.assertEqual(resumed.message_list[-1], original.message_list[-1])
+        store.close()
+
+
+class TestPrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.api = CountingEchoAPI()
+        _, self.conversation_id = self.api.send_new_message("init")
+
+    def test_prefetched_response_is_committed(self):
+        prefetcher = Prefetcher(self.api, self.conversation_id)
+        prefetcher.start("details of task 1.3")
+        response = prefetcher.take("details of task 1.3")
+        self.assertEqual(response, "echo: details of task 1.3")
+        self.assertEqual(self.api.calls, 2)
+        message_list = self.api.conversation_dict[self.conversation_id].message_list
+        self.assertEqual(message_list[-1].answer[0]["content"], response)
+        prefetcher.close()
+
+    def test_other_request_discards_the_prefetch(self):
+        prefetcher = Prefetcher(self.api, self.conversation_id, max_wasted_tokens=1)
+        prefetcher.start("details of task 1.3")
+        self.assertIsNone(prefetcher.take("todo"))
+        prefetcher._executor.shutdown(wait=True)
+        self.assertGreater(prefetcher.wasted_tokens, 0)
+        self.assertTrue(prefetcher.budget_exhausted)
+        # the conversation is not modified by the discarded prefetch
+        self.assertEqual(
+            len(self.api.conversation_dict[self.conversation_id].message_list), 1
+        )
+
+    def test_stale_prefetch_is_not_used(self):
+        prefetcher = Prefetcher(self.api, self.conversation_id)
+        prefetcher.start("details of task 1.3")
+        self.api.send_message("another message", self.conversation_id)
+        self.assertIsNone(prefetcher.take("details of task 1.3"))
+        prefetcher.close()
+
+    def test_prefetchers_share_the_budget(self):
+        # `more` and `todo` are both prefetched after `next`; only one of them is used
+        _, other_conversation_id = self.api.send_new_message("init")
+        budget = PrefetchBudget(max_wasted_tokens=1)
+        more = Prefetcher(self.api, self.conversation_id, budget=budget)
+        todo = Prefetcher(self.api, other_conversation_id, budget=budget)
+        more.start("details of task 1.3")
+        todo.start("todo")
+        self.assertEqual(todo.take("todo"), "echo: todo")
+        self.assertIsNone(more.take("another request"))
+        more._executor.shutdown(wait=True)
+        self.assertGreater(todo.wasted_tokens, 0)
+        self.assertTrue(todo.budget_exhausted)
+        more.close()
+        todo.close()
+
+
+class TestRequestScheduler(unittest.TestCase):
+    def test_unknown_model_is_not_paced(self):
+        scheduler = RequestScheduler()
+        start_time = time.time()
+        for _ in range(100):
+            scheduler.acquire(("echo", None), 10**6)
+        self.assertLess(time.time() - start_time, 0.5)
+
+    def test_requests_are_not_paced_by_default(self):
+        # the limits depend on the tier of the account, so they must be given
+        scheduler = RequestScheduler()
+        start_time = time.time()
+        for _ in range(10):
+            scheduler.acquire(("gpt-4o", None), 100000)
+            scheduler.record_usage(("gpt-4o", None), 4096)
+        self.assertLess(time.time() - start_time, 0.5)
+
+    def test_interactive_requests_go_first(self):
+        scheduler = RequestScheduler(
+            {"echo": RateLimit(requests_per_minute=6000, tokens_per_minute=600)}
+        )
+        key = ("echo", None)
+        scheduler.acquire(key, 600)  # drain the token bucket, refilled at 10/s
+        served = []
+
+        def request(name, priority):
+            scheduler.acquire(key, 5, priority)
+            served.append(name)
+
+        background = threading.Thread(
+            target=request, args=("background", PRIORITY_BACKGROUND)
+        )
+        interactive = threading.Thread(
+            target=request, args=("interactive", PRIORITY_INTERACTIVE)
+        )
+        start_time = time.time()
+        background.start()
+        time.sleep(0.1)
+        interactive.start()
+        background.join()
+        interactive.join()
+        self.assertEqual(served, ["interactive", "background"])
+        self.assertGreater(time.time() - start_time, 0.9)
+
+
+class TestMockServer(unittest.TestCase):
+    def test_chatgpt_api_against_mock_server(self):
+        from benchmarks.mock_openai_server import MockOpenAIServer
+        from BIKprotect.utils.APIs.chatgpt_api import ChatGPTAPI
+
+        with MockOpenAIServer(
+            rate_limit_every=2, retry_after=0.01
+        ) as server, tempfile.TemporaryDirectory() as log_dir:
+
+            class Config:
+                model = "gpt-4o-2024-05-13"
+                api_base = server.base_url
+                error_wait_time = 0
+                log_dir = None
+
+            Config.log_dir = log_dir
+            with unittest.mock.patch.dict(os.environ, {"OPENAI_API_KEY": "mock-key"}):
+                api = ChatGPTAPI(Config)
+            _, conversation_id = api.send_new_message("hello")
+            response = api.send_message("the first", conversation_id)
+            self.assertEqual(response, "echo: the first")
+            chunks = []
+            response = api.send_message(
+                "the second message", conversation_id, stream_handler=chunks.append
+            )
+            self.assertEqual(response, "echo: the second message")
+            self.assertEqual(len(chunks), 4)
+            stats = server.stats()
+            self.assertEqual(stats["requests"] - stats["rate_limited"], 3)
+            self.assertGreater(stats["rate_limited"], 0)
+            self.assertGreater(stats["prompt_tokens"], 0)
+
+    def test_cancel_closes_the_response_in_flight(self):
+        from benchmarks.mock_openai_server import MockOpenAIServer
+        from BIKprotect.utils.APIs.chatgpt_api import ChatGPTAPI
+
+        with MockOpenAIServer(
+            stream_chunk_delay=2
+        ) as server, tempfile.TemporaryDirectory() as log_dir:
+
+            class Config:
+                model = "gpt-4o-2024-05-13"
+                api_base = server.base_url
+                error_wait_time = 0
+                log_dir = None
+
+            Config.log_dir = log_dir
+            with unittest.mock.patch.dict(os.environ, {"OPENAI_API_KEY": "mock-key"}):
+                api = ChatGPTAPI(Config)
+            worker = LLMWorker()
+            # without a stream handler, the job streams the response anyway
+            job = worker.submit(
+                api.send_new_message,
+                "a message with a long response",
+                description="long request",
+            )
+            time.sleep(0.3)
+            start = time.perf_counter()
+            worker.cancel_all()
+            self.assertIsInstance(job.future.exception(timeout=2), RequestCancelled)
+            # the job does not wait for the remaining chunks of the response
+            self.assertLess(time.perf_counter() - start, 1)
+            self.assertEqual(server.stats()["requests"], 1)
+
+    def test_started_session_is_persisted(self):
+        import types
+
+        from benchmarks.mock_openai_server import MockOpenAIServer
+        from benchmarks.replay_session import build_handler
+        from BIKprotect.utils.APIs import module_import
+
+        config_class = getattr(
+            module_import, module_import.module_mapping["gpt-4-turbo"]["config_name"]
+        )
+        args = types.SimpleNamespace(
+            reasoning_model="gpt-4-turbo",
+            parsing_model="gpt-4-turbo",
+            parsing_mode="map-reduce",
+            stream=False,
+            ptt_mode="diff",
+            reasoning_mode="single",
+            no_local_parsers=False,
+        )
+        with MockOpenAIServer() as server, tempfile.TemporaryDirectory() as log_dir:
+            with unittest.mock.patch.dict(
+                os.environ, {"OPENAI_API_KEY": "mock-key"}
+            ), unittest.mock.patch.object(config_class, "api_base", None):
+                handler = build_handler(server, args, log_dir)
+                handler.initialize(init_description="the target is 10.0.0.5")
+            store_dir = os.path.join(log_dir, "conversations")
+            for file_name in (
+                ConversationStore.data_file,
+                ConversationStore.index_file,
+            ):
+                path = os.path.join(store_dir, file_name)
+                self.assertTrue(os.path.exists(path))
+                self.assertGreater(os.path.getsize(path), 0)
+            # the three sessions can be resumed from the store
+            store = ConversationStore(store_dir)
+            for session_id in (
+                handler.test_generation_session_id,
+                handler.test_reasoning_session_id,
+                handler.input_parsing_session_id,
+            ):
+                self.assertIn(session_id, store)
+            store.close()
+            handler.conversation_store.close()
+
+    def test_replayed_step_is_streamed(self):
+        import types
+
+        from benchmarks.mock_openai_server import MockOpenAIServer
+        from benchmarks.replay_session import (
+            DEFAULT_SESSION_LOG,
+            SessionResponder,
+            build_handler,
+            load_session,
+            run_step,
+        )
+        from BIKprotect.utils.APIs import module_import
+
+        task_description, steps = load_session(DEFAULT_SESSION_LOG)
+        self.assertEqual(len(steps), 7)
+        config_class = getattr(
+            module_import, module_import.module_mapping["gpt-4-turbo"]["config_name"]
+        )
+        args = types.SimpleNamespace(
+            reasoning_model="gpt-4-turbo",
+            parsing_model="gpt-4-turbo",
+            parsing_mode="map-reduce",
+            stream=True,
+            ptt_mode="diff",
+            reasoning_mode="single",
+            no_local_parsers=False,
+        )
+        with MockOpenAIServer(
+            responder=SessionResponder(DEFAULT_SESSION_LOG)
+        ) as server, tempfile.TemporaryDirectory() as log_dir:
+            with unittest.mock.patch.dict(
+                os.environ, {"OPENAI_API_KEY": "mock-key"}
+            ), unittest.mock.patch.object(config_class, "api_base", None):
+                handler = build_handler(server, args, log_dir)
+                handler.console.file = io.StringIO()
+                handler.initialize(init_description=task_description)
+                since = len(server.requests)
+                source, text = steps[0]
+                run_step(handler, server, source, text)
+            # the reasoning and generation requests of the step are streamed
+            step_requests = server.requests[since:]
+            self.assertEqual(len(step_requests), 2)
+            self.assertTrue(all(request.stream for request in step_requests))
+            handler.conversation_store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import types
+import unittest
+
+from BIKprotect.prompts.prompt_class import BIKprotectPrompt
+from BIKprotect.utils.ptt import (
+    COMPLETED,
+    NOT_APPLICABLE,
+    PTT,
+    contains_ptt,
+    split_reasoning_response,
+)
+
+SAMPLE_PTT = """Here is the updated PTT:
+1. Reconnaissance - [to-do]
+   1.1 Passive Information Gathering - (completed)
+   1.2 Active Information Gathering - (completed)
+   1.3 Identify Open Ports and Services - (to-do)
+       1.3.1 Perform a full port scan - (to-do)
+       1.3.2 Determine the purpose of each open port - (to-do)
+2. Exploitation - [not applicable]
+"""
+
+
+class TestPTT(unittest.TestCase):
+    def test_parse(self):
+        ptt = PTT.parse(SAMPLE_PTT)
+        self.assertEqual(len(ptt), 7)
+        self.assertEqual([node.node_id for node in ptt.roots], ["1", "2"])
+        self.assertEqual(ptt.nodes["1.3.1"].parent, ptt.nodes["1.3"])
+        self.assertEqual(
+            ptt.nodes["1.3"].description, "Identify Open Ports and Services"
+        )
+        self.assertEqual(ptt.nodes["1.1"].status, COMPLETED)
+        self.assertEqual(ptt.nodes["2"].status, NOT_APPLICABLE)
+        self.assertTrue(contains_ptt(SAMPLE_PTT))
+        self.assertFalse(contains_ptt("1. Run nmap\n2. Run nikto"))
+
+    def test_render_round_trip(self):
+        ptt = PTT.parse(SAMPLE_PTT)
+        rendered = ptt.render()
+        self.assertIn("      1.3.1 Perform a full port scan - [to-do]", rendered)
+        self.assertEqual(PTT.parse(rendered).render(), rendered)
+
+    def test_apply_edits(self):
+        ptt = PTT.parse(SAMPLE_PTT)
+        applied = ptt.apply_edits(
+            "The port scan found a web server.\n"
+            "COMPLETE 1.3.1\n"
+            "ADD 1.3.3 Enumerate the web directories on port 80\n"
+            "NA 1.3.2\n"
+            "COMPLETE 9.9\n"
+        )
+        self.assertEqual(len(applied), 3)
+        self.assertEqual(ptt.nodes["1.3.1"].status, COMPLETED)
+        self.assertEqual(ptt.nodes["1.3.2"].status, NOT_APPLICABLE)
+        self.assertEqual(ptt.nodes["1.3.3"].parent, ptt.nodes["1.3"])
+        self.assertEqual([node.node_id for node in ptt.todo_nodes()], ["1.3.3"])
+        ptt.complete("1.3.3")
+        # the parent tasks are completed with their last sub-task
+        self.assertEqual(ptt.nodes["1.3"].status, COMPLETED)
+        self.assertEqual(ptt.nodes["1"].status, COMPLETED)
+        self.assertEqual(ptt.todo_nodes(), [])
+
+    def test_find_task(self):
+        ptt = PTT.parse(SAMPLE_PTT)
+        task = ptt.find_task(
+            "Apache 2.4.41 runs on port 80.\nPerform task 1.3.2: run `nmap -sV -p80`."
+        )
+        self.assertEqual(task.node_id, "1.3.2")
+        self.assertIsNone(ptt.find_task("Check 10.0.0.5 with nikto 2.5.0."))
+        # a bare number is not a task id
+        self.assertIsNone(ptt.find_task("Select 1 sub-task and run nikto on port 2."))
+        # the root tasks are mentioned by their description
+        self.assertEqual(
+            ptt.find_task("Task 1: Reconnaissance of the target.").node_id, "1"
+        )
+        # the task mentioned by both its id and its description is taken
+        task = ptt.find_task(
+            "The to-do tasks are 1.3.1 and 1.3.2.\n"
+            "Next: 1.3.1 Perform a full port scan with `nmap -p-`."
+        )
+        self.assertEqual(task.node_id, "1.3.1")
+        # several tasks without a description are ambiguous
+        self.assertIsNone(ptt.find_task("Perform 1.3.1, then 1.3.2."))
+
+    def test_diff_mode_only_revises_with_test_results(self):
+        from BIKprotect.utils.BIKprotect_gpt import BIKprotect
+
+        prompts = BIKprotectPrompt()
+        handler = types.SimpleNamespace(
+            ptt_mode="diff", ptt=PTT.parse(SAMPLE_PTT), prompts=prompts
+        )
+        instruction, content, is_diff = BIKprotect._ptt_update_prompt(
+            handler, "22/tcp open ssh"
+        )
+        self.assertEqual(instruction, prompts.process_results_diff)
+        self.assertIn("1.3.1 Perform a full port scan", content)
+        self.assertTrue(is_diff)
+        # the questions of the tester ask for the whole task tree
+        for question in (prompts.ask_todo, prompts.discussion + "is ssh vulnerable?"):
+            instruction, content, is_diff = BIKprotect._ptt_update_prompt(
+                handler, question
+            )
+            self.assertEqual(instruction, prompts.process_results)
+            self.assertEqual(content, question)
+            self.assertFalse(is_diff)
+
+    def test_split_reasoning_response(self):
+        ptt_section, task_section = split_reasoning_response(
+            "=== PTT ===\nCOMPLETE 1.3.1\n\n**=== NEXT TASK ===**\n1.3.2 Check port 80."
+        )
+        self.assertEqual(ptt_section, "COMPLETE 1.3.1")
+        self.assertEqual(task_section, "1.3.2 Check port 80.")
+        self.assertEqual(
+            split_reasoning_response("COMPLETE 1.3.1\nThen check port 80."),
+            (None, None),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,181 @@
+import asyncio
+import email.utils
+import time
+import types
+import unittest
+import unittest.mock
+
+import httpx
+import openai
+
+from BIKprotect.utils.retry_engine import RetryEngine, RetryPolicy, get_retry_after
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+
+def status_error(error_class, status_code: int, headers: dict = None):
+    response = httpx.Response(status_code, headers=headers or {}, request=REQUEST)
+    return error_class(f"status {status_code}", response=response, body=None)
+
+
+def retry_state(exception, attempt_number: int):
+    # the part of a tenacity RetryCallState read by the engine
+    return types.SimpleNamespace(
+        outcome=types.SimpleNamespace(exception=lambda: exception),
+        attempt_number=attempt_number,
+    )
+
+
+class FailingCall:
+    """
+    Raise the errors in turn, then return "ok".
+    """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+class TestRetryAfter(unittest.TestCase):
+    def test_seconds(self):
+        error = status_error(openai.RateLimitError, 429, {"retry-after": "7"})
+        self.assertEqual(get_retry_after(error), 7.0)
+
+    def test_http_date(self):
+        date = email.utils.formatdate(time.time() + 20, usegmt=True)
+        error = status_error(openai.RateLimitError, 429, {"retry-after": date})
+        self.assertAlmostEqual(get_retry_after(error), 20, delta=1.5)
+        # a date in the past requires no delay
+        date = email.utils.formatdate(time.time() - 60, usegmt=True)
+        error = status_error(openai.RateLimitError, 429, {"retry-after": date})
+        self.assertEqual(get_retry_after(error), 0.0)
+
+    def test_milliseconds_take_precedence(self):
+        error = status_error(
+            openai.RateLimitError, 429, {"retry-after-ms": "250", "retry-after": "7"}
+        )
+        self.assertEqual(get_retry_after(error), 0.25)
+
+    def test_missing_or_invalid(self):
+        self.assertIsNone(get_retry_after(status_error(openai.RateLimitError, 429)))
+        error = status_error(openai.RateLimitError, 429, {"retry-after": "soon"})
+        self.assertIsNone(get_retry_after(error))
+        self.assertIsNone(get_retry_after(openai.APITimeoutError(request=REQUEST)))
+
+    def test_retry_after_is_capped(self):
+        engine = RetryEngine()
+        error = status_error(openai.RateLimitError, 429, {"retry-after": "600"})
+        self.assertEqual(engine._wait(retry_state(error, 1)), 60)
+        error = status_error(openai.RateLimitError, 429, {"retry-after-ms": "1500"})
+        self.assertEqual(engine._wait(retry_state(error, 1)), 1.5)
+
+
+@unittest.mock.patch("tenacity.nap.time.sleep")
+class TestRetryEngine(unittest.TestCase):
+    def test_max_attempts_of_each_error_class(self, sleep):
+        errors = {
+            openai.RateLimitError: lambda: status_error(openai.RateLimitError, 429),
+            openai.APITimeoutError: lambda: openai.APITimeoutError(request=REQUEST),
+            openai.APIConnectionError: lambda: openai.APIConnectionError(
+                request=REQUEST
+            ),
+            openai.InternalServerError: lambda: status_error(
+                openai.InternalServerError, 500
+            ),
+            openai.ConflictError: lambda: status_error(openai.ConflictError, 409),
+        }
+        expected_attempts = {
+            openai.RateLimitError: 6,
+            openai.APITimeoutError: 3,
+            openai.APIConnectionError: 4,
+            openai.InternalServerError: 3,
+            openai.ConflictError: 2,
+        }
+        engine = RetryEngine()
+        for error_class, make_error in errors.items():
+            with self.subTest(error_class=error_class.__name__):
+                self.assertEqual(
+                    engine.policy_for(make_error()).max_attempts,
+                    expected_attempts[error_class],
+                )
+                call = FailingCall(*(make_error() for _ in range(10)))
+                with self.assertRaises(error_class):
+                    engine.call(call)
+                self.assertEqual(call.calls, expected_attempts[error_class])
+
+    def test_transient_error_is_retried(self, sleep):
+        call = FailingCall(
+            status_error(openai.RateLimitError, 429, {"retry-after-ms": "10"}),
+            openai.APIConnectionError(request=REQUEST),
+        )
+        self.assertEqual(RetryEngine().call(call), "ok")
+        self.assertEqual(call.calls, 3)
+        # the first delay is the one requested by the server
+        self.assertEqual(sleep.call_args_list[0].args[0], 0.01)
+
+    def test_non_retryable_error_is_raised_at_once(self, sleep):
+        for error in [
+            status_error(openai.BadRequestError, 400),
+            status_error(openai.AuthenticationError, 401),
+            ValueError("not an API error"),
+        ]:
+            with self.subTest(error=type(error).__name__):
+                call = FailingCall(error)
+                with self.assertRaises(type(error)):
+                    RetryEngine().call(call)
+                self.assertEqual(call.calls, 1)
+        sleep.assert_not_called()
+
+    def test_async_call(self, sleep):
+        call = FailingCall(status_error(openai.InternalServerError, 500))
+
+        async def acall():
+            return call()
+
+        engine = RetryEngine(
+            [(openai.InternalServerError, RetryPolicy(max_attempts=2, base_delay=0))]
+        )
+        self.assertEqual(asyncio.run(engine.acall(acall)), "ok")
+        self.assertEqual(call.calls, 2)
+
+
+class TestBackoff(unittest.TestCase):
+    def test_jittered_delay_bounds(self):
+        policy = RetryPolicy(max_attempts=10, base_delay=1.0, max_delay=30.0)
+        engine = RetryEngine([(openai.APITimeoutError, policy)])
+        error = openai.APITimeoutError(request=REQUEST)
+        for attempt_number in range(1, 9):
+            backoff = min(2 ** (attempt_number - 1), 30.0)
+            delays = [
+                engine._wait(retry_state(error, attempt_number)) for _ in range(200)
+            ]
+            with self.subTest(attempt_number=attempt_number):
+                # equal jitter: between half the backoff and the backoff
+                self.assertGreaterEqual(min(delays), backoff / 2)
+                self.assertLessEqual(max(delays), backoff)
+                self.assertGreater(max(delays) - min(delays), 0)
+
+    def test_jitter_extremes(self):
+        policy = RetryPolicy(base_delay=2.0, max_delay=30.0)
+        engine = RetryEngine([(openai.APITimeoutError, policy)])
+        error = openai.APITimeoutError(request=REQUEST)
+        with unittest.mock.patch("random.uniform", side_effect=lambda a, b: a):
+            self.assertEqual(engine._wait(retry_state(error, 3)), 4.0)
+        with unittest.mock.patch("random.uniform", side_effect=lambda a, b: b):
+            self.assertEqual(engine._wait(retry_state(error, 3)), 8.0)
+
+    def test_retry_after_is_ignored_when_disabled(self):
+        policy = RetryPolicy(base_delay=1.0, honor_retry_after=False)
+        engine = RetryEngine([(openai.RateLimitError, policy)])
+        error = status_error(openai.RateLimitError, 429, {"retry-after": "20"})
+        self.assertLessEqual(engine._wait(retry_state(error, 1)), 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,281 @@
+import io
+import os
+import tempfile
+import types
+import unittest
+
+from rich.console import Console
+
+from BIKprotect.utils.chunker import chunk_text
+from BIKprotect.utils.llm_api import count_text_tokens
+from BIKprotect.utils.tool_output_filter import ToolOutputFilter, read_tool_output
+from BIKprotect.utils.tool_parsers import parse_tool_output
+
+GOBUSTER_OUTPUT = (
+    "===============================================================\n"
+    "Gobuster v3.6\n"
+    "===============================================================\n"
+    "[+] Url:                     http://10.0.0.5\n"
+    "[+] Method:                  GET\n"
+    "[+] Threads:                 10\n"
+    "===============================================================\n"
+    + "".join(
+        f"/page{i}                (Status: 404) [Size: 274]\n" for i in range(500)
+    )
+    + "/admin                (Status: 301) [Size: 312]\n"
+    + "\rProgress: 100 / 4615 (2.17%)\rProgress: 4615 / 4615 (100.00%)\n"
+    "===============================================================\n"
+)
+
+NMAP_OUTPUT = """Starting Nmap 7.94 ( https://nmap.org )
+Stats: 0:00:12 elapsed; 0 hosts completed (1 up), 1 undergoing SYN Stealth Scan
+SYN Stealth Scan Timing: About 45.00% done; ETC: 10:01 (0:00:15 remaining)
+PORT     STATE    SERVICE VERSION
+22/tcp   open     ssh     OpenSSH 8.2p1
+25/tcp   filtered smtp
+80/tcp   open     http    Apache httpd 2.4.41
+113/tcp  closed   ident
+
+
+Nmap done: 1 IP address (1 host up) scanned in 27.31 seconds
+"""
+
+NMAP_MULTI_HOST_OUTPUT = """Starting Nmap 7.94 ( https://nmap.org )
+Nmap scan report for 10.0.0.5
+Host is up (0.0010s latency).
+PORT   STATE SERVICE VERSION
+22/tcp open  ssh     OpenSSH 8.2p1
+80/tcp open  http    Apache httpd 2.4.41
+
+Nmap scan report for 10.0.0.6
+Host is up (0.0010s latency).
+PORT   STATE SERVICE VERSION
+22/tcp open  ssh     OpenSSH 8.2p1
+80/tcp open  http    Apache httpd 2.4.41
+
+Nmap done: 2 IP addresses (2 hosts up) scanned in 12.05 seconds
+"""
+
+NMAP_VULN_OUTPUT = """Starting Nmap 7.94 ( https://nmap.org )
+Nmap scan report for 10.0.0.7
+Host is up (0.00050s latency).
+PORT    STATE SERVICE      VERSION
+135/tcp open  msrpc        Microsoft Windows RPC
+445/tcp open  microsoft-ds Microsoft Windows 7 - 10 microsoft-ds
+Service Info: Host: WIN7; OS: Windows; CPE: cpe:/o:microsoft:windows
+
+Host script results:
+| smb-vuln-ms17-010:
+|   VULNERABLE:
+|   Remote Code Execution vulnerability in Microsoft SMBv1 servers (ms17-010)
+|     State: VULNERABLE
+|     IDs:  CVE:CVE-2017-0143
+|_    Risk factor: HIGH
+
+Nmap done: 1 IP address (1 host up) scanned in 15.20 seconds
+"""
+
+NMAP_XML_OUTPUT = """<?xml version="1.0" encoding="UTF-8"?>
+<nmaprun scanner="nmap" args="nmap -sV -oX - 10.0.0.5">
+<host><status state="up"/>
+<address addr="10.0.0.5" addrtype="ipv4"/>
+<hostnames><hostname name="target.htb" type="user"/></hostnames>
+<ports>
+<port protocol="tcp" portid="22"><state state="open"/><service name="ssh" product="OpenSSH" version="8.2p1"/></port>
+<port protocol="tcp" portid="80"><state state="open"/><service name="http" product="Apache httpd" version="2.4.41"/>
+<script id="http-title" output="Login page"/></port>
+<port protocol="tcp" portid="113"><state state="closed"/><service name="ident"/></port>
+</ports></host>
+</nmaprun>
+"""
+
+NMAP_GREPABLE_OUTPUT = """# Nmap 7.94 scan initiated as: nmap -sV -oG - 10.0.0.5
+Host: 10.0.0.5 ()\tStatus: Up
+Host: 10.0.0.5 ()\tPorts: 22/open/tcp//ssh//OpenSSH 8.2p1/, 113/closed/tcp//ident///\tIgnored State: filtered (998)
+# Nmap done at Mon Jan  1 10:00:00 2024 -- 1 IP address (1 host up) scanned in 7.12 seconds
+"""
+
+NIKTO_OUTPUT = """- Nikto v2.5.0
+---------------------------------------------------------------------------
++ Target IP:          10.0.0.5
++ Target Port:        80
++ Start Time:         2024-01-01 10:00:00 (GMT0)
+---------------------------------------------------------------------------
++ Server: Apache/2.4.41 (Ubuntu)
++ /: The X-Frame-Options header is not present.
++ /: The X-Frame-Options header is not present.
++ /admin/: Directory indexing found.
++ 8102 requests: 0 error(s) and 3 item(s) reported on remote host
++ End Time:           2024-01-01 10:05:00 (GMT0) (300 seconds)
+"""
+
+
+class TestToolParsers(unittest.TestCase):
+    def test_nmap_formats(self):
+        expected_ports = ["- 22/tcp open ssh OpenSSH 8.2p1"]
+        for text in (NMAP_OUTPUT, NMAP_XML_OUTPUT, NMAP_GREPABLE_OUTPUT):
+            parser_name, summary = parse_tool_output(text)
+            self.assertTrue(parser_name.startswith("nmap"))
+            for port in expected_ports:
+                self.assertIn(port, summary)
+            self.assertNotIn("113", summary)
+        _, summary = parse_tool_output(NMAP_XML_OUTPUT)
+        self.assertIn("Host 10.0.0.5 (target.htb): up", summary)
+        self.assertIn("  http-title: Login page", summary)
+
+    def test_nmap_host_scripts(self):
+        parser_name, summary = parse_tool_output(NMAP_VULN_OUTPUT)
+        self.assertEqual(parser_name, "nmap")
+        self.assertIn("Host script results:", summary)
+        self.assertIn("  smb-vuln-ms17-010:", summary)
+        self.assertIn("      State: VULNERABLE", summary)
+        self.assertIn("CVE-2017-0143", summary)
+        # the repeated ports of several hosts are all kept
+        _, summary = parse_tool_output(NMAP_MULTI_HOST_OUTPUT)
+        self.assertEqual(summary.count("- 22/tcp open ssh OpenSSH 8.2p1"), 2)
+
+    def test_nmap_unknown_content_is_left_to_the_llm(self):
+        text = NMAP_OUTPUT.replace(
+            "\n\n\n",
+            "\n1 service unrecognized despite returning data.\n"
+            "SF-Port8080-TCP:V=7.94%I=7%D=1/1%Time=65%P=x86_64-pc-linux-gnu\n\n",
+        )
+        self.assertIsNone(parse_tool_output(text))
+
+    def test_gobuster_and_nikto(self):
+        filtered = ToolOutputFilter().filter_text(GOBUSTER_OUTPUT)
+        self.assertEqual(
+            parse_tool_output(filtered),
+            (
+                "gobuster",
+                "gobuster found 1 results:\n"
+                "Url: http://10.0.0.5\n"
+                "- /admin (301, 312 bytes)",
+            ),
+        )
+        # the subdomains of the dns mode keep their domain
+        dns_output = (
+            "Gobuster v3.6\n"
+            "[+] Domain:     example.com\n"
+            "[+] Threads:    10\n"
+            "Found: admin.example.com\n"
+            "Found: mail.example.com\n"
+        )
+        self.assertEqual(
+            parse_tool_output(dns_output),
+            (
+                "gobuster",
+                "gobuster found 2 results:\n"
+                "Domain: example.com\n"
+                "- admin.example.com\n"
+                "- mail.example.com",
+            ),
+        )
+        parser_name, summary = parse_tool_output(NIKTO_OUTPUT)
+        self.assertEqual(parser_name, "nikto")
+        self.assertEqual(summary.count("X-Frame-Options"), 1)
+        self.assertIn("- /admin/: Directory indexing found.", summary)
+        self.assertNotIn("Start Time", summary)
+
+    def test_fitting_input_is_not_summarized(self):
+        from BIKprotect.utils.BIKprotect_gpt import BIKprotect
+
+        handler = types.SimpleNamespace(local_parsers=True)
+        text = "hydra found no valid password"
+        self.assertEqual(
+            BIKprotect.input_parsing_handler(
+                handler, text, source="tool", summarize=False
+            ),
+            text,
+        )
+
+    def test_unrecognized_output(self):
+        self.assertIsNone(parse_tool_output("hydra found no valid password"))
+        self.assertIsNone(parse_tool_output("<nmaprun scanner='nmap'><host>"))
+
+
+class TestToolOutputFilter(unittest.TestCase):
+    def test_gobuster_noise_is_dropped(self):
+        noise_filter = ToolOutputFilter()
+        filtered = noise_filter.filter_text(GOBUSTER_OUTPUT)
+        self.assertIn("/admin", filtered)
+        self.assertNotIn("Status: 404", filtered)
+        self.assertNotIn("Progress", filtered)
+        self.assertEqual(noise_filter.dropped["not found responses"], 500)
+        self.assertEqual(noise_filter.dropped["progress"], 2)
+        # the separators are not consecutive, so they are kept
+        self.assertEqual(filtered.count("=" * 63), 4)
+        self.assertIn("filtered 502 lines", filtered)
+
+    def test_consecutive_repeats_are_collapsed(self):
+        noise_filter = ToolOutputFilter()
+        filtered = noise_filter.filter_text("[*] waiting\n" * 5 + "[+] found admin\n")
+        self.assertEqual(filtered.count("[*] waiting"), 1)
+        self.assertEqual(noise_filter.dropped["repeated lines"], 4)
+
+    def test_repeated_lines_of_several_hosts_are_kept(self):
+        filtered = ToolOutputFilter().filter_text(NMAP_MULTI_HOST_OUTPUT)
+        self.assertEqual(filtered, NMAP_MULTI_HOST_OUTPUT)
+
+    def test_nmap_noise_is_dropped(self):
+        filtered = ToolOutputFilter().filter_text(NMAP_OUTPUT)
+        self.assertIn("22/tcp   open     ssh     OpenSSH 8.2p1", filtered)
+        self.assertNotIn("Stats:", filtered)
+        self.assertNotIn("Timing", filtered)
+        self.assertNotIn("closed", filtered.split("[filtered")[0])
+        self.assertNotIn("25/tcp", filtered)
+        self.assertNotIn("\n\n\n", filtered)
+
+    def test_read_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "nmap.txt")
+            with open(path, "w") as f:
+                f.write(NMAP_OUTPUT)
+            self.assertEqual(
+                read_tool_output(path), ToolOutputFilter().filter_text(NMAP_OUTPUT)
+            )
+            # only a tool output is filtered
+            self.assertEqual(read_tool_output(path, filter_noise=False), NMAP_OUTPUT)
+
+    def test_next_arguments(self):
+        from BIKprotect.utils.BIKprotect_gpt import BIKprotect
+
+        handler = types.SimpleNamespace(console=Console(file=io.StringIO()))
+        self.assertIsNone(BIKprotect._parse_input_file(handler, ""))
+        self.assertEqual(
+            BIKprotect._parse_input_file(handler, '--file "scan results.txt"'),
+            "scan results.txt",
+        )
+        # an unbalanced quote prints the usage instead of raising
+        self.assertIs(BIKprotect._parse_input_file(handler, '--file "x'), False)
+        self.assertIn("Usage", handler.console.file.getvalue())
+
+
+class TestChunker(unittest.TestCase):
+    def test_records_are_kept_whole(self):
+        records = [
+            "\n".join(f"host {i} port {port}/tcp open" for port in range(20))
+            for i in range(30)
+        ]
+        chunks = chunk_text("\n\n\n".join(records), 400)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(count_text_tokens(chunk), 400)
+            for record in chunk.split("\n\n"):
+                self.assertIn(record, records)
+        self.assertEqual("\n\n".join(chunks), "\n\n".join(records))
+
+    def test_large_record_and_line(self):
+        record = "\n".join(f"line {i}" for i in range(300))
+        long_line = "x" * 5000
+        chunks = chunk_text(record + "\n\n" + long_line, 200)
+        for chunk in chunks:
+            self.assertLessEqual(count_text_tokens(chunk), 200)
+        text = "\n".join(chunks)
+        self.assertIn("line 0\nline 1\n", text)
+        self.assertEqual(text.count("x"), 5000)
+        self.assertEqual(chunk_text("", 200), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
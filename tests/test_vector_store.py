@@ -0,0 +1,302 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import types
+import unittest
+from typing import List
+
+import numpy as np
+
+from BIKprotect.utils.embedding_pipeline import EmbeddingPipeline
+from BIKprotect.utils.embeddings import LocalEmbeddings, embedding_dimension
+from BIKprotect.utils.memory import FindingMemory
+from BIKprotect.utils.vector_store import LocalVectorStore
+from BIKprotect.utils.vectorDB import customVectorDB
+
+
+class HashEmbeddings:
+    """
+    A deterministic bag-of-words embedding, so that no embedding API is required.
+    """
+
+    dimension = 64
+
+    def __init__(self, chunk_size: int = 1000):
+        self.chunk_size = chunk_size
+        self.batches = []  # the sizes of the embedding requests
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for word in text.lower().split():
+            digest = hashlib.md5(word.encode()).digest()
+            vector[int.from_bytes(digest[:4], "little") % self.dimension] += 1.0
+        return vector.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.batches.append(len(texts))
+        return [self.embed_query(text) for text in texts]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_documents(texts)
+
+
+class TestLocalVectorStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_search_and_reopen(self):
+        store = LocalVectorStore(self.tmp_dir.name, HashEmbeddings())
+        store.add_texts(
+            [
+                "22/tcp open ssh OpenSSH 8.2p1",
+                "80/tcp open http Apache httpd 2.4.41",
+                "the admin panel is at /admin",
+            ],
+            metadatas=[{"port": 22}, {"port": 80}, {}],
+        )
+        result = store.similarity_search("apache http", k=1)[0]
+        self.assertEqual(result.page_content, "80/tcp open http Apache httpd 2.4.41")
+        self.assertEqual(result.metadata["port"], 80)
+        reopened = LocalVectorStore(self.tmp_dir.name, HashEmbeddings())
+        self.assertEqual(len(reopened), 3)
+        self.assertEqual(
+            reopened.similarity_search("openssh ssh", k=1)[0].page_content,
+            "22/tcp open ssh OpenSSH 8.2p1",
+        )
+
+    def test_records_of_an_interrupted_write_are_dropped(self):
+        store = LocalVectorStore(self.tmp_dir.name, HashEmbeddings())
+        store.add_texts(["ssh open", "http open"])
+        # a crash after the records were written, but before the count was
+        with open(os.path.join(self.tmp_dir.name, "records.jsonl"), "a") as f:
+            f.write('{"text": "ftp open", "metadata": {}}\n{"text": "sm')
+        store = LocalVectorStore(self.tmp_dir.name, HashEmbeddings())
+        self.assertEqual(len(store), 2)
+        store.add_texts(["smb open"])
+        store = LocalVectorStore(self.tmp_dir.name, HashEmbeddings())
+        self.assertEqual(
+            [store.document(row).page_content for row in range(len(store))],
+            ["ssh open", "http open", "smb open"],
+        )
+        self.assertEqual(
+            store.similarity_search("smb", k=1)[0].page_content, "smb open"
+        )
+        self.assertEqual(os.listdir(self.tmp_dir.name).count("meta.json.tmp"), 0)
+
+    def test_ivf_index(self):
+        rng = np.random.default_rng(1)
+        centers = rng.normal(size=(20, 32))
+        vectors = centers[rng.integers(0, 20, 3000)] + 0.05 * rng.normal(
+            size=(3000, 32)
+        )
+        store = LocalVectorStore(self.tmp_dir.name, None, ivf_threshold=1000)
+        store.add_vectors(vectors[:2000], [str(i) for i in range(2000)])
+        self.assertEqual(store.search_by_vector(vectors[5], k=1)[0][0], 5)
+        self.assertIsNotNone(store._centroids)
+        # the vectors added after the index is built are assigned to its clusters
+        store.add_vectors(vectors[2000:2500], [str(i) for i in range(2000, 2500)])
+        self.assertEqual(store.search_by_vector(vectors[2100], k=1)[0][0], 2100)
+        self.assertEqual(sum(len(c) for c in store._clusters), 2500)
+
+    def test_metadata_filter(self):
+        store = LocalVectorStore(self.tmp_dir.name, HashEmbeddings())
+        store.add_texts(
+            ["ssh open", "http open", "ssh closed"],
+            metadatas=[
+                {"host": "10.0.0.1", "port": ["22"]},
+                {"host": "10.0.0.1", "port": ["80", "443"]},
+                {"host": "10.0.0.2", "port": ["22"]},
+            ],
+        )
+        self.assertEqual(store.filter_rows({"port": "22"}).tolist(), [0, 2])
+        self.assertEqual(
+            store.filter_rows({"host": "10.0.0.1", "port": [443, 22]}).tolist(), [0, 1]
+        )
+        # the inverted index is rebuilt when the store is reopened
+        store = LocalVectorStore(self.tmp_dir.name, HashEmbeddings())
+        result = store.similarity_search(
+            "ssh", k=4, metadata_filter={"host": "10.0.0.2"}
+        )
+        self.assertEqual([d.page_content for d in result], ["ssh closed"])
+        self.assertEqual(
+            store.similarity_search("ssh", metadata_filter={"port": "21"}), []
+        )
+
+
+class TestEmbeddingPipeline(unittest.TestCase):
+    def test_batches_and_cache(self):
+        embeddings = HashEmbeddings(chunk_size=4)
+        pipeline = EmbeddingPipeline(embeddings, max_concurrency=2)
+        texts = [f"port {i} open" for i in range(10)]
+        vectors = pipeline.embed_documents(texts + texts[:3])
+        self.assertEqual(vectors[10], vectors[0])
+        self.assertEqual(vectors[4], embeddings.embed_query(texts[4]))
+        # the duplicates are embedded once, in batches of the provider's batch size
+        self.assertEqual(sorted(embeddings.batches[:3]), [2, 4, 4])
+        embeddings.batches.clear()
+        pipeline.embed_documents(texts[5:] + ["port 80 open"])
+        self.assertEqual(embeddings.batches, [1])
+        self.assertEqual(pipeline.embedded, 11)
+
+
+class HashSentenceModel:
+    """
+    A model with the interface of a SentenceTransformer, so that sentence-transformers is
+    not required.
+    """
+
+    def __init__(self):
+        self.encoded = []
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return HashEmbeddings.dimension
+
+    def encode(self, texts, batch_size, normalize_embeddings, show_progress_bar):
+        self.encoded.extend(texts)
+        return np.array(HashEmbeddings().embed_documents(texts))
+
+
+class TestLocalEmbeddings(unittest.TestCase):
+    def test_dimension_and_batches(self):
+        model = HashSentenceModel()
+        embeddings = LocalEmbeddings(model, batch_size=3)
+        self.assertEqual(embedding_dimension(embeddings), 64)
+        texts = [f"port {i} open" for i in range(8)]
+        vectors = embeddings.embed_documents(texts)
+        self.assertEqual(len(vectors), 8)
+        self.assertEqual(vectors[5], embeddings.embed_query(texts[5]))
+        self.assertEqual(sorted(model.encoded), sorted(texts + texts[5:6]))
+
+    def test_pipeline_caches_the_embeddings(self):
+        model = HashSentenceModel()
+        pipeline = EmbeddingPipeline(LocalEmbeddings(model, batch_size=3))
+        texts = [f"port {i} open" for i in range(8)]
+        vectors = pipeline.embed_documents(texts + texts[:2])
+        self.assertEqual(len(vectors), 10)
+        self.assertEqual(vectors[8], vectors[0])
+        pipeline.embed_documents(texts[:4])
+        # each text is encoded once, on the parallel batches
+        self.assertEqual(sorted(model.encoded), sorted(texts))
+
+    def test_missing_dependency(self):
+        try:
+            import sentence_transformers  # noqa: F401
+
+            self.skipTest("sentence-transformers is installed")
+        except ImportError:
+            pass
+        with self.assertRaises(ImportError):
+            LocalEmbeddings("all-MiniLM-L6-v2")
+
+
+class TestCustomVectorDB(unittest.TestCase):
+    def test_local_backend(self):
+        vector_db = customVectorDB(
+            "test_project",
+            "vectordb_test",
+            backend="local",
+            embeddings=HashEmbeddings(),
+        )
+        try:
+            self.assertEqual(vector_db.store_text("Port 445 runs Samba smbd 4.6.2"), 1)
+            # the chunks already stored are neither embedded nor stored again
+            self.assertEqual(vector_db.store_text("Port 445 runs Samba smbd 4.6.2"), 0)
+            self.assertEqual(len(vector_db.vectorDB), 1)
+            result = vector_db.retrieval("samba smbd")
+            self.assertIn("Samba", result[0].page_content)
+            vector_db.store_text(
+                "Nmap scan report for 10.0.0.7\n445/tcp open microsoft-ds",
+                metadata={"tool": "nmap", "ptt_node": "1.2"},
+            )
+            result = vector_db.retrieval("samba smbd", metadata={"host": "10.0.0.7"})
+            self.assertEqual(len(result), 1)
+            self.assertEqual(result[0].metadata["port"], ["445"])
+            self.assertEqual(result[0].metadata["tool"], "nmap")
+            self.assertEqual(
+                len(vector_db.retrieval("samba", metadata={"ptt_node": "1.2"})), 1
+            )
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = os.path.join(tmp_dir, "nikto.txt")
+                with open(path, "w") as f:
+                    f.write("+ /backup/: Directory indexing found.")
+                self.assertEqual(vector_db.store_file(path), 1)
+                self.assertEqual(vector_db.store_file(path), 0)
+        finally:
+            vector_db.delete_index()
+            shutil.rmtree(vector_db.vectordb_directory)
+
+
+class TestFindingMemory(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.vector_db = customVectorDB(
+            "memory_test",
+            os.path.join(self.tmp_dir.name, "vectordb"),
+            backend="local",
+            embeddings=HashEmbeddings(),
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_recall_within_budget(self):
+        memory = FindingMemory(self.vector_db, top_k=4, token_budget=30)
+        self.assertEqual(memory.recall("ssh on 10.0.0.5"), [])
+        memory.remember("10.0.0.5 port 22 runs OpenSSH 7.2p2 with password login")
+        memory.remember("10.0.0.5 port 80 runs Apache 2.4.18 with /admin exposed")
+        memory.remember(" ".join(["filler"] * 100) + " ssh")
+        findings = memory.recall("brute force the ssh password login of 10.0.0.5")
+        self.assertEqual(
+            findings[0], "10.0.0.5 port 22 runs OpenSSH 7.2p2 with password login"
+        )
+        # the long finding does not fit in the budget
+        self.assertTrue(all("filler" not in finding for finding in findings))
+        # a finding the input already contains is not recalled
+        self.assertNotIn(
+            findings[0], memory.recall(findings[0] + "\nthe login is admin:admin")
+        )
+
+    def test_memory_of_a_resumed_session(self):
+        from BIKprotect.prompts.prompt_class import BIKprotectPrompt
+        from BIKprotect.utils.BIKprotect_gpt import BIKprotect
+
+        vectordb_dir = os.path.join(self.tmp_dir.name, "vectordb")
+
+        def start_session():
+            handler = types.SimpleNamespace(
+                test_reasoning_session_id="reasoning-session",
+                memory_embeddings=HashEmbeddings(),
+                memory_top_k=4,
+                memory_token_budget=1000,
+                reasoningAgent=types.SimpleNamespace(name="gpt-4"),
+                prompts=BIKprotectPrompt,
+                input_parser_name="nmap",
+                recommended_task_id="1.3.1",
+            )
+            BIKprotect._enable_memory(handler, vectordb_dir)
+            return handler
+
+        handler = start_session()
+        text = BIKprotect._with_earlier_findings(
+            handler, "10.0.0.5 port 22 runs OpenSSH 7.2p2", "tool"
+        )
+        self.assertEqual(text, "10.0.0.5 port 22 runs OpenSSH 7.2p2")
+        stored = handler.memory.vector_db.retrieval(
+            "OpenSSH", metadata={"tool": "nmap", "ptt_node": "1.3.1"}
+        )
+        self.assertEqual(len(stored), 1)
+        # the resumed session opens the same store, and recalls the earlier finding
+        handler = start_session()
+        text = BIKprotect._with_earlier_findings(
+            handler, "brute force the OpenSSH login of 10.0.0.5", "user-comments"
+        )
+        self.assertIn("10.0.0.5 port 22 runs OpenSSH 7.2p2", text)
+        self.assertTrue(text.startswith(BIKprotectPrompt.memory_findings))
+
+
+if __name__ == "__main__":
+    unittest.main()